@@ -19,8 +19,12 @@ Se habilito nuevamente el 7 de agosto de 2022
 """
 
 import logging, os, sys, traceback, json, glob, shutil, time, zipfile, smtplib
+import base64, csv, hashlib, fnmatch, io, math, random, struct, urllib.parse
+import concurrent.futures, threading, sqlite3
 import arcpy
+import numpy as np
 import requests
+import requests.adapters
 import datetime, collections
 import pytz
 from arcpy import env
@@ -28,6 +32,16 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from collections import Counter
 
+# Protege las métricas de descarga que actualizan los hilos
+metrics_lock = threading.Lock()
+# Protege el archivo de latencias por host de los mirrors
+mirror_stats_lock = threading.Lock()
+
+
+# Descarga abortada porque otro mirror ya entregó el archivo
+class DownloadCancelled(Exception):
+    pass
+
 ################################################################################
 ################################################################################
 '''
@@ -81,34 +95,245 @@ def group_by_count(table_or_fc, fields):
     return counter
 
 
+##################################################################
+##################################################################
+'''
+Lectura de encabezados de shapefile sin arcpy
+
+El .dbf (dBASE III) tiene un encabezado de 32 bytes con el número de registros, seguido
+de un descriptor de 32 bytes por campo terminado en 0x0D. El .shp tiene un encabezado
+fijo de 100 bytes con el tipo de geometría, el tamaño del archivo y la extensión.
+'''
+# Tipo de geometría Point del .shp, cada registro ocupa 8 bytes de encabezado + 20 de contenido
+SHP_POINT = 1
+SHP_POINT_RECORD_SIZE = 28
+
+
+def read_dbf_header(f):
+    header = f.read(32)
+    if len(header) < 32:
+        raise Exception("Encabezado dbf incompleto")
+    records, header_length, record_length = struct.unpack('<IHH', header[4:12])
+    fields = []
+    offset = 1  # el primer byte de cada registro es la marca de borrado
+    while True:
+        descriptor = f.read(32)
+        if not descriptor or descriptor[0:1] == b'\x0d':
+            break
+        if len(descriptor) < 32:
+            raise Exception("Descriptor de campo dbf incompleto")
+        name = descriptor[:11].split(b'\x00')[0].decode('ascii', 'replace').strip()
+        field_type = descriptor[11:12].decode('ascii', 'replace')
+        length, decimals = descriptor[16], descriptor[17]
+        fields.append({'name': name, 'type': field_type, 'length': length, 'decimals': decimals,
+                       'offset': offset})
+        offset += length
+    return {'records': records, 'header_length': header_length, 'record_length': record_length,
+            'fields': fields}
+
+
+def read_shp_header(f):
+    header = f.read(100)
+    if len(header) < 100:
+        raise Exception("Encabezado shp incompleto")
+    file_code, = struct.unpack('>i', header[0:4])
+    if file_code != 9994:
+        raise Exception("El archivo no es un shapefile (file code {})".format(file_code))
+    file_length, = struct.unpack('>i', header[24:28])
+    shape_type, = struct.unpack('<i', header[32:36])
+    bbox = struct.unpack('<4d', header[36:68])
+    return {'shape_type': shape_type, 'file_bytes': file_length * 2, 'bbox': bbox}
+
+
+def read_shapefile_info(shp_path, zip_path=None):
+    """
+    Lee el número de registros, los campos y la extensión de un shapefile desde los
+    encabezados del .dbf y del .shp
+
+    Args:
+        shp_path: Ruta del .shp, o nombre del .shp dentro de zip_path
+        zip_path: Zip que contiene el shapefile, None para leer desde disco
+
+    Returns:
+        dict: records, fields, shape_type, bbox (xmin, ymin, xmax, ymax) y shp_records
+        (registros según el tamaño del .shp, solo para geometría Point)
+    """
+    base = os.path.splitext(shp_path)[0]
+    if zip_path:
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            members = {name.lower(): name for name in zip_ref.namelist()}
+            dbf_member = members.get((base + '.dbf').lower())
+            if dbf_member is None:
+                raise Exception("No se encontró {}.dbf en {}".format(base, zip_path))
+            with zip_ref.open(dbf_member) as f:
+                dbf_info = read_dbf_header(f)
+            with zip_ref.open(members.get(shp_path.lower(), shp_path)) as f:
+                shp_info = read_shp_header(f)
+    else:
+        dbf_path = next((base + ext for ext in ('.dbf', '.DBF') if os.path.isfile(base + ext)), None)
+        if dbf_path is None:
+            raise Exception("No se encontró {}.dbf".format(base))
+        with open(dbf_path, 'rb') as f:
+            dbf_info = read_dbf_header(f)
+        with open(shp_path, 'rb') as f:
+            shp_info = read_shp_header(f)
+
+    shp_records = None
+    if shp_info['shape_type'] == SHP_POINT:
+        shp_records = (shp_info['file_bytes'] - 100) // SHP_POINT_RECORD_SIZE
+        if shp_records != dbf_info['records']:
+            logging.warning("{}: el .shp tiene {} geometrías y el .dbf {} registros".format(
+                shp_path, shp_records, dbf_info['records']))
+    return {'records': dbf_info['records'], 'fields': dbf_info['fields'], 'shape_type': shp_info['shape_type'],
+            'bbox': shp_info['bbox'], 'shp_records': shp_records}
+
+
+##################################################################
+##################################################################
+'''
+Cargar un shapefile de puntos de la NASA como columnas de numpy
+
+Los registros del .dbf tienen ancho fijo y los del .shp de puntos ocupan 28 bytes,
+por lo que ambos se leen con un dtype estructurado sobre el archivo mapeado en
+memoria (np.memmap) o sobre el contenido del zip (np.frombuffer), sin pasar por
+arcpy. Los registros con la marca de borrado del .dbf ('*') se descartan, igual que sus
+geometrías. Solo se decodifican los campos solicitados:
+    N / F: float64 (vacío = nan)
+    D: datetime64[D] (vacío = NaT)
+    L: bool
+    C y otros: str sin espacios
+Las coordenadas se entregan en las columnas SHAPE@X y SHAPE@Y.
+'''
+def decode_dbf_column(raw, field_type):
+    values = np.char.strip(raw)
+    if field_type in ('N', 'F'):
+        empty = (values == b'') | (np.char.strip(values, b'*') == b'')
+        return np.where(empty, b'nan', values).astype(np.float64)
+    if field_type == 'D':
+        empty = values == b''
+        numbers = np.where(empty, b'19700101', values).astype(np.int64)
+        months = (numbers // 10000 - 1970) * 12 + (numbers // 100) % 100 - 1
+        dates = months.astype('datetime64[M]').astype('datetime64[D]') + (numbers % 100 - 1)
+        dates[empty] = np.datetime64('NaT')
+        return dates
+    if field_type == 'L':
+        return np.isin(values, (b'T', b't', b'Y', b'y'))
+    return np.char.decode(values, 'latin-1')
+
+
+def read_shp_points(shp_buffer, records, shx_buffer=None):
+    point_dtype = np.dtype([('number', '>i4'), ('length', '>i4'), ('shape_type', '<i4'),
+                            ('x', '<f8'), ('y', '<f8')])
+    if len(shp_buffer) - 100 == records * SHP_POINT_RECORD_SIZE:
+        points = np.frombuffer(shp_buffer, dtype=point_dtype, count=records, offset=100)
+        if np.all(points['shape_type'] == SHP_POINT):
+            return points['x'].copy(), points['y'].copy()
+    if shx_buffer is None:
+        raise Exception("El .shp no tiene registros Point de tamaño fijo y no se encontró el .shx")
+    # Registros nulos o de tamaño variable, se ubican con los offsets del .shx
+    offsets = np.frombuffer(shx_buffer, dtype='>i4', count=records * 2, offset=100)[0::2].astype(np.int64) * 2
+    data_bytes = np.frombuffer(shp_buffer, dtype=np.uint8)
+    shape_types = data_bytes[(offsets + 8)[:, None] + np.arange(4)].copy().view('<i4').ravel()
+    x = data_bytes[(offsets + 12)[:, None] + np.arange(8)].copy().view('<f8').ravel()
+    y = data_bytes[(offsets + 20)[:, None] + np.arange(8)].copy().view('<f8').ravel()
+    x[shape_types != SHP_POINT] = np.nan
+    y[shape_types != SHP_POINT] = np.nan
+    return x, y
+
+
+def load_shapefile_columns(shp_path, fields=None, zip_path=None):
+    """
+    Carga los atributos y coordenadas de un shapefile de puntos como arreglos de numpy
+
+    Args:
+        shp_path: Ruta del .shp, o nombre del .shp dentro de zip_path
+        fields: Campos a cargar (LATITUDE, ACQ_DATE, ...), None para todos
+        zip_path: Zip que contiene el shapefile, None para leer desde disco
+
+    Returns:
+        collections.OrderedDict: nombre del campo -> np.ndarray, más SHAPE@X y SHAPE@Y, sin
+        los registros marcados como borrados
+    """
+    base = os.path.splitext(shp_path)[0]
+    if zip_path:
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            members = {name.lower(): name for name in zip_ref.namelist()}
+            dbf_member = members.get((base + '.dbf').lower())
+            if dbf_member is None:
+                raise Exception("No se encontró {}.dbf en {}".format(base, zip_path))
+            dbf_buffer = zip_ref.read(dbf_member)
+            shp_buffer = zip_ref.read(members.get(shp_path.lower(), shp_path))
+            shx_member = members.get((base + '.shx').lower())
+            shx_buffer = zip_ref.read(shx_member) if shx_member else None
+    else:
+        def existing(ext):
+            return next((base + e for e in (ext, ext.upper()) if os.path.isfile(base + e)), None)
+
+        dbf_path = existing('.dbf')
+        if dbf_path is None:
+            raise Exception("No se encontró {}.dbf".format(base))
+        shx_path = existing('.shx')
+        dbf_buffer = np.memmap(dbf_path, dtype=np.uint8, mode='r') if os.path.getsize(dbf_path) else b''
+        shp_buffer = np.memmap(shp_path, dtype=np.uint8, mode='r')
+        shx_buffer = np.memmap(shx_path, dtype=np.uint8, mode='r') if shx_path else None
+
+    header = read_dbf_header(io.BytesIO(bytes(dbf_buffer[:32 + 32 * 256])))
+    records = header['records']
+    dbf_fields = header['fields']
+    if fields is not None:
+        wanted = [name.upper() for name in fields]
+        dbf_fields = [field for field in dbf_fields if field['name'].upper() in wanted]
+    record_dtype = np.dtype({'names': [field['name'] for field in dbf_fields],
+                             'formats': ['S{}'.format(field['length']) for field in dbf_fields],
+                             'offsets': [field['offset'] for field in dbf_fields],
+                             'itemsize': header['record_length']})
+    table = np.frombuffer(dbf_buffer, dtype=record_dtype, count=records, offset=header['header_length'])
+    flag_dtype = np.dtype({'names': ['flag'], 'formats': ['S1'], 'offsets': [0], 'itemsize': header['record_length']})
+    live = np.frombuffer(dbf_buffer, dtype=flag_dtype, count=records, offset=header['header_length'])['flag'] != b'*'
+
+    columns = collections.OrderedDict()
+    for field in dbf_fields:
+        columns[field['name']] = decode_dbf_column(table[field['name']][live], field['type'])
+    x, y = read_shp_points(shp_buffer, records, shx_buffer)
+    columns['SHAPE@X'], columns['SHAPE@Y'] = x[live], y[live]
+    return columns
+
+
 ##################################################################
 ##################################################################
 '''
 Contar registros de un shapefile dentro de un directorio
 '''
-def count_shapefile_records(directory):
+def count_shapefile_records(directory, shp_name=None):
     """
-    Busca el primer archivo .shp en un directorio y cuenta sus registros
+    Busca un archivo .shp en un directorio y cuenta sus registros
 
     Args:
         directory: Ruta del directorio donde buscar el shapefile
+        shp_name: Nombre del shapefile a contar. Si no se indica se usa el primer .shp encontrado
 
     Returns:
         int: Número de registros, o -1 si no se encuentra shapefile o hay error
     """
     try:
-        # Buscar archivos .shp en el directorio
-        shp_files = glob.glob(os.path.join(directory, "*.shp"))
+        if shp_name:
+            shp_path = os.path.join(directory, shp_name)
+            if not os.path.isfile(shp_path):
+                logging.warning("No se encontró archivo {} en {}".format(shp_name, directory))
+                return -1
+        else:
+            # Buscar archivos .shp en el directorio
+            shp_files = glob.glob(os.path.join(directory, "*.shp"))
 
-        if not shp_files:
-            logging.warning("No se encontró archivo .shp en {}".format(directory))
-            return -1
+            if not shp_files:
+                logging.warning("No se encontró archivo .shp en {}".format(directory))
+                return -1
 
-        shp_path = shp_files[0]
+            shp_path = shp_files[0]
         logging.debug("Shapefile encontrado: {}".format(shp_path))
 
-        # Contar registros
-        count = int(arcpy.GetCount_management(shp_path)[0])
+        # El conteo se toma del encabezado del .dbf, sin abrir arcpy
+        count = read_shapefile_info(shp_path)['records']
         logging.info("Registros encontrados en shapefile: {}".format(count))
 
         return count
@@ -120,249 +345,721 @@ def count_shapefile_records(directory):
 ##################################################################
 ##################################################################
 '''
-descargar los shps de la nasa
+Crear la sesión http compartida para las descargas de la nasa
+
+La sesión mantiene un pool de conexiones por host (firms / firms2) que reutilizan
+los hilos de descarga, evitando abrir una conexión TLS nueva por cada petición.
+Los reintentos se manejan por sensor en download_sensor_file.
 '''
-def download_nasa_files(data):
-    try:
-        logging.debug("***********************************")
-        logging.debug("** download_nasa_files **")
-        logging.debug("***********************************")
-        current_day_temp_dir = data['current_day_temp_dir']
-        url_modis = data['url_modis']
-        url_vnp = data['url_vnp']
-        url_noaa = data['url_noaa']
+def create_http_session(data):
+    pool_size = max(4, int(data.get('download_max_workers', 4)) * 2)
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
 
-        url_modis_2 = data['url_modis_2']
-        url_vnp_2 = data['url_vnp_2']
-        url_noaa_2 = data['url_noaa_2']
-        url_noaa_21 = data['url_noaa_21']
 
-        logging.debug("url_modis : {} ".format(url_modis))
-        logging.debug("url_vnp : {} ".format(url_vnp))
-        logging.debug("url_noaa : {} ".format(url_noaa))
+##################################################################
+##################################################################
+'''
+Timeout (conexión, lectura) de una petición, limitado por el tiempo que falta
+para el plazo global de la descarga (download_deadline_seconds)
+'''
+def get_request_timeout(data, deadline=None):
+    connect_timeout = float(data.get('download_connect_timeout', 10))
+    read_timeout = float(data.get('download_read_timeout', 60))
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise Exception("Se superó el plazo máximo de descarga (download_deadline_seconds)")
+        connect_timeout = min(connect_timeout, remaining)
+        read_timeout = min(read_timeout, remaining)
+    return (connect_timeout, read_timeout)
 
-        logging.debug("url_modis_2 : {} ".format(url_modis_2))
-        logging.debug("url_vnp_2 : {} ".format(url_vnp_2))
-        logging.debug("url_noaa_2 : {} ".format(url_noaa_2))
-        logging.debug("url_noaa_21 : {} ".format(url_noaa_21))
 
-        #######################################################################################
-        ## MODIS
-        #######################################################################################
-        # check file
-        try:
-            logging.debug('check file....')
-            r = requests.head(url_modis)
-            logging.debug(r.status_code)
-            if r.status_code != 200:
-                # logging.debug(r.headers['content-type'])
-                logging.debug(r.headers)
-                logging.debug('switch to server 2....')
-                url_modis = url_modis_2
-                logging.debug("url_modis : {} ".format(url_modis))
+##################################################################
+##################################################################
+'''
+Espera antes de reintentar: backoff exponencial con jitter, sin superar el plazo global
+'''
+def backoff_delay(data, attempt, deadline=None):
+    base = float(data.get('download_backoff_seconds', 2))
+    cap = float(data.get('download_backoff_max_seconds', 60))
+    delay = min(cap, base * (2 ** attempt))
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    if deadline is not None:
+        delay = min(delay, max(0, deadline - time.monotonic()))
+    return delay
 
-            logging.debug('Beginning file download....')
 
-            modis_zip_path = os.path.join(current_day_temp_dir, "modis.zip")
+##################################################################
+##################################################################
+'''
+Descargar un archivo por bloques directamente a disco
 
-            logging.debug("**************")
-            logging.debug("modis_zip_path : {} ".format(modis_zip_path))
-            logging.debug("**************")
+El archivo se escribe por partes de download_chunk_size_kb, de modo que nunca se
+mantiene completo en memoria. El tamaño y los checksums se calculan mientras se
+escribe, así la validación no requiere leer de nuevo el archivo.
+'''
+def stream_download(session, url, dest_path, chunk_size=1024 * 1024, max_size=None, verify=True,
+                    request_headers=None, timeout=None, deadline=None, cancel_event=None):
+    """
+    Descarga una url en dest_path
 
-            r = requests.get(url_modis)
-            logging.debug(r.status_code)
-            logging.debug(r.headers['content-type'])
-            # logging.debug(r.encoding)
-            with open(modis_zip_path, 'wb') as f:
-                f.write(r.content)
-            with zipfile.ZipFile(modis_zip_path, 'r') as zip_ref:
-                zip_ref.extractall(current_day_temp_dir)
-
-            # Validar que el shapefile tenga registros
-            record_count = count_shapefile_records(current_day_temp_dir)
-            logging.info("MODIS: Registros antes de usar URL alterna: {}".format(record_count))
-            
-            if record_count == 0:
-                logging.warning("MODIS: Shapefile descargado tiene 0 registros. Intentando con URL alterna...")
-                # Usar URL alterna
-                url_modis = url_modis_2
-                logging.info("Descargando desde URL alterna: {}".format(url_modis))
-
-                r = requests.get(url_modis)
-                logging.debug(r.status_code)
-                logging.debug(r.headers['content-type'])
-                with open(modis_zip_path, 'wb') as f:
-                    f.write(r.content)
-                with zipfile.ZipFile(modis_zip_path, 'r') as zip_ref:
-                    zip_ref.extractall(current_day_temp_dir)
-
-                # Validar nuevamente
-                record_count = count_shapefile_records(current_day_temp_dir)
-                logging.info("MODIS: Registros después de usar URL alterna: {}".format(record_count))
-        except Exception as e:
-            logging.debug('No se puede descargar información para MODIS, {}'.format(e))
+    Args:
+        session: Sesión http (create_http_session)
+        url: Url del archivo
+        dest_path: Ruta destino, se escribe primero en dest_path + '.part'
+        chunk_size: Tamaño en bytes de cada bloque
+        max_size: Tamaño máximo permitido en bytes, None para no limitar
+        verify: Validar el tamaño contra Content-Length y el md5 contra Content-MD5
+        request_headers: Encabezados adicionales de la petición (If-None-Match, If-Modified-Since)
+        timeout: Tupla (conexión, lectura) en segundos
+        deadline: Plazo global (time.monotonic) para terminar la descarga
+        cancel_event: threading.Event, si se activa la descarga se aborta con DownloadCancelled
 
-        #######################################################################################
-        ## suomi
-        #######################################################################################
-        # check file
-        try:
-            logging.debug('check file....')
-            r = requests.head(url_vnp)
+    Returns:
+        dict: status_code, bytes, sha256 y headers de la respuesta. Con status_code 304
+        no se escribe ningún archivo
+    """
+    part_path = dest_path + '.part'
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    size = 0
+    # Si la descarga falla, vence el plazo o se cancela no queda el .part en disco
+    try:
+        with session.get(url, stream=True, headers=request_headers, timeout=timeout) as r:
             logging.debug(r.status_code)
-            if r.status_code != 200:
-                # logging.debug(r.headers['content-type'])
-                logging.debug(r.headers)
-                logging.debug('switch to server 2....')
-                url_vnp = url_vnp_2
-                logging.debug("url_vnp : {} ".format(url_vnp))
+            logging.debug(r.headers.get('content-type'))
+            if r.status_code == 304:
+                return {'status_code': 304, 'bytes': 0, 'sha256': None, 'headers': dict(r.headers)}
+            r.raise_for_status()
+            with open(part_path, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    if not chunk:
+                        continue
+                    f.write(chunk)
+                    sha256.update(chunk)
+                    md5.update(chunk)
+                    size += len(chunk)
+                    if max_size and size > max_size:
+                        raise Exception("El archivo {} supera el tamaño máximo de {} bytes".format(url, max_size))
+                    if deadline is not None and time.monotonic() > deadline:
+                        raise Exception("Se superó el plazo máximo de descarga para {}".format(url))
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise DownloadCancelled("Descarga de {} cancelada".format(url))
+            headers = dict(r.headers)
+
+        if verify:
+            # Con Content-Encoding el Content-Length corresponde al contenido comprimido
+            content_length = r.headers.get('content-length')
+            if content_length and 'content-encoding' not in r.headers and int(content_length) != size:
+                raise Exception("Descarga incompleta de {}: {} de {} bytes".format(url, size, content_length))
+            content_md5 = r.headers.get('content-md5')
+            if content_md5 and base64.b64decode(content_md5) != md5.digest():
+                raise Exception("El checksum md5 de {} no coincide".format(url))
+
+        os.replace(part_path, dest_path)
+        logging.debug("{} bytes descargados, sha256: {}".format(size, sha256.hexdigest()))
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+    return {'status_code': r.status_code, 'bytes': size, 'sha256': sha256.hexdigest(), 'headers': headers}
 
-            vpn_zip_path = os.path.join(current_day_temp_dir, "vnp.zip")
-            logging.debug("**************")
-            logging.debug("vpn_zip_path : {} ".format(vpn_zip_path))
-            logging.debug("**************")
 
-            logging.debug('Beginning file download....')
-            r = requests.get(url_vnp)
+'''
+Lanza DownloadCancelled si cancel_event está activo, para que el mirror perdedor de una
+carrera no siga con pasos posteriores a la descarga (cache, extracción, latencias)
+'''
+def check_cancelled(cancel_event, url):
+    if cancel_event is not None and cancel_event.is_set():
+        raise DownloadCancelled("Descarga de {} cancelada".format(url))
 
-            logging.debug(r.status_code)
-            logging.debug(r.headers['content-type'])
-            # logging.debug(r.encoding)
-            with open(vpn_zip_path, 'wb') as f:
-                f.write(r.content)
-            with zipfile.ZipFile(vpn_zip_path, 'r') as zip_ref:
-                zip_ref.extractall(current_day_temp_dir)
-
-            # Validar que el shapefile tenga registros
-            record_count = count_shapefile_records(current_day_temp_dir)
-            logging.info("SUOMI-NPP: Registros antes de usar URL alterna: {}".format(record_count))
-            if record_count == 0:
-                logging.warning("SUOMI-NPP: Shapefile descargado tiene 0 registros. Intentando con URL alterna...")
-                # Usar URL alterna
-                url_vnp = url_vnp_2
-                logging.info("Descargando desde URL alterna: {}".format(url_vnp))
-
-                r = requests.get(url_vnp)
-                logging.debug(r.status_code)
-                logging.debug(r.headers['content-type'])
-                with open(vpn_zip_path, 'wb') as f:
-                    f.write(r.content)
-                with zipfile.ZipFile(vpn_zip_path, 'r') as zip_ref:
-                    zip_ref.extractall(current_day_temp_dir)
-
-                # Validar nuevamente
-                record_count = count_shapefile_records(current_day_temp_dir)
-                logging.info("SUOMI-NPP: Registros después de usar URL alterna: {}".format(record_count))
+
+##################################################################
+##################################################################
+'''
+Directorio de la cache de descargas (download_cache_dir), se crea si no existe
+'''
+def get_cache_dir(data):
+    cache_dir = data.get('download_cache_dir') or os.path.join(data['temp_dir'], 'cache_descargas')
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+##################################################################
+##################################################################
+'''
+Descargar un archivo usando la cache local de descargas
+
+La cache guarda por cada url el último archivo descargado (con la extensión de la url)
+junto con su ETag y Last-Modified. La petición se envía con If-None-Match /
+If-Modified-Since y si la NASA responde 304 (archivo sin cambios) se reutiliza el archivo
+de la cache. Un 304 sin copia en la cache se trata como un MISS y se repite la petición
+sin encabezados condicionales.
+'''
+def cached_download(data, session, url, dest_path, chunk_size=1024 * 1024, max_size=None, verify=True,
+                    deadline=None, cancel_event=None):
+    timeout = get_request_timeout(data, deadline)
+    if not data.get('download_cache', True):
+        return stream_download(session, url, dest_path, chunk_size, max_size, verify, None, timeout, deadline,
+                               cancel_event)
+
+    cache_dir = get_cache_dir(data)
+    cache_key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    extension = os.path.splitext(urllib.parse.urlparse(url).path)[1].lower() or '.zip'
+    cache_file_path = os.path.join(cache_dir, cache_key + extension)
+    cache_meta_path = os.path.join(cache_dir, cache_key + '.json')
+
+    cache_meta = None
+    if os.path.isfile(cache_file_path) and os.path.isfile(cache_meta_path):
+        try:
+            with open(cache_meta_path) as f:
+                cache_meta = json.load(f)
         except Exception as e:
-            logging.debug('No se puede descargar información para suomi, {}'.format(e))
+            logging.warning("Cache de descargas: metadatos inválidos para {}, {}".format(url, e))
+
+    request_headers = {}
+    if cache_meta:
+        if cache_meta.get('etag'):
+            request_headers['If-None-Match'] = cache_meta['etag']
+        if cache_meta.get('last_modified'):
+            request_headers['If-Modified-Since'] = cache_meta['last_modified']
+
+    download = stream_download(session, url, dest_path, chunk_size, max_size, verify, request_headers, timeout,
+                               deadline, cancel_event)
+    if download['status_code'] == 304 and not cache_meta:
+        logging.warning("Cache de descargas: {} respondió 304 sin copia en la cache, se repite la petición".format(url))
+        download = stream_download(session, url, dest_path, chunk_size, max_size, verify,
+                                   {'Cache-Control': 'no-cache'}, timeout, deadline, cancel_event)
+        if download['status_code'] == 304:
+            raise Exception("{} respondió 304 sin encabezados condicionales".format(url))
+    check_cancelled(cancel_event, url)
+    metrics = data['download_metrics']
+    if download['status_code'] == 304:
+        shutil.copyfile(cache_file_path, dest_path)
+        download['bytes'] = cache_meta['bytes']
+        download['sha256'] = cache_meta['sha256']
+        download['cache'] = 'hit'
+        with metrics_lock:
+            metrics['cache_hits'] += 1
+            metrics['bytes_saved'] += cache_meta['bytes']
+        logging.info("Cache de descargas: HIT {} ({} bytes reutilizados)".format(url, cache_meta['bytes']))
+        return download
+
+    # Archivo nuevo o modificado, se actualiza la cache
+    shutil.copyfile(dest_path, cache_file_path + '.part')
+    os.replace(cache_file_path + '.part', cache_file_path)
+    cache_meta = {'url': url,
+                  'etag': download['headers'].get('ETag'),
+                  'last_modified': download['headers'].get('Last-Modified'),
+                  'bytes': download['bytes'],
+                  'sha256': download['sha256'],
+                  'fetched': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+    with open(cache_meta_path, 'w') as f:
+        json.dump(cache_meta, f, indent=2)
+    download['cache'] = 'miss'
+    with metrics_lock:
+        metrics['cache_misses'] += 1
+        metrics['bytes_downloaded'] += download['bytes']
+    logging.info("Cache de descargas: MISS {} ({} bytes descargados)".format(url, download['bytes']))
+    return download
 
-        #######################################################################################
-        ## noaa
-        #######################################################################################
-        # check file
+
+##################################################################
+##################################################################
+'''
+Tamaño de bloque y tamaño máximo en bytes de una descarga
+'''
+def get_download_limits(data):
+    chunk_size = int(data.get('download_chunk_size_kb', 1024)) * 1024
+    max_size_mb = data.get('download_max_size_mb')
+    max_size = int(max_size_mb) * 1024 * 1024 if max_size_mb else None
+    return chunk_size, max_size
+
+
+##################################################################
+##################################################################
+'''
+Descargar un zip de la nasa y extraerlo, retorna el nombre del shp contenido en el zip
+que cumple con shp_pattern y la información de la descarga
+'''
+def fetch_and_extract(data, session, url, zip_path, extract_dir, shp_pattern='*.shp', deadline=None,
+                      cancel_event=None):
+    logging.debug("Descargando {} en {} ".format(url, zip_path))
+    chunk_size, max_size = get_download_limits(data)
+    download = cached_download(data, session, url, zip_path, chunk_size, max_size,
+                               data.get('download_verify', True), deadline, cancel_event)
+    check_cancelled(cancel_event, url)
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        zip_ref.extractall(extract_dir)
+        shp_names = [name for name in zip_ref.namelist() if name.lower().endswith('.shp')]
+    if not shp_names:
+        logging.warning("El archivo {} no contiene shapefile".format(zip_path))
+        return None, download
+    matches = [name for name in shp_names if fnmatch.fnmatch(os.path.basename(name).lower(), shp_pattern.lower())]
+    if not matches:
+        logging.warning("Ningún shapefile de {} cumple con el patrón {}, se usa {}".format(
+            zip_path, shp_pattern, shp_names[0]))
+        matches = shp_names
+    try:
+        info = read_shapefile_info(matches[0], zip_path)
+        logging.debug("{}: {} registros, extensión {}, campos {}".format(
+            matches[0], info['records'], info['bbox'], [field['name'] for field in info['fields']]))
+    except Exception as e:
+        logging.warning("No se pudo leer el encabezado de {} en {}, {}".format(matches[0], zip_path, e))
+    return matches[0], download
+
+
+##################################################################
+##################################################################
+'''
+Registro de sensores
+
+Cada sensor se describe con:
+    name: Nombre para el log
+    data_key: Llave de data donde se guarda la ruta del shp descargado (shp_modis, ...)
+    url: Url principal del zip
+    url_2: Url alterna (mirror), opcional
+    subdir: Subdirectorio de current_day_temp_dir donde se extrae el zip
+    shp_pattern: Patrón del nombre del shapefile esperado dentro del zip
+    instrument: Valor del campo INSTRUMENT de sus registros (MODIS, VIIRS_SOUMI, ...)
+    confidence: 'modis' si CONFIDENCE es numérico (0-100) y se clasifica en low / nominal / high,
+        'viirs' si ya es categórico
+    pozos_distance: Distancia en metros de exclusión de pozos de hidrocarburos, según la
+        resolución del píxel del sensor (1000 para MODIS, 375 para VIIRS)
+    csv_url, csv_url_2: Urls del mismo archivo en formato CSV (input_format = csv). Si no se
+        indican se derivan de url / url_2 cambiando /shapes/zips/*.zip por /csv/*.csv
+
+Si config.json tiene la llave "sensors" se usa esa lista, de lo contrario el registro se
+arma con las llaves url_modis, url_vnp, url_noaa, url_noaa_21 (y sus alternas _2).
+'''
+def get_sensor_registry(data):
+    if data.get('sensors'):
+        sensors = [dict(sensor) for sensor in data['sensors']]
+    else:
+        sensors = [
+            {'name': 'MODIS', 'data_key': 'shp_modis', 'url': data['url_modis'],
+             'url_2': data['url_modis_2'], 'subdir': 'modis', 'shp_pattern': 'MODIS*.shp',
+             'instrument': 'MODIS', 'confidence': 'modis', 'pozos_distance': 1000},
+            {'name': 'SUOMI-NPP', 'data_key': 'shp_vnp', 'url': data['url_vnp'],
+             'url_2': data['url_vnp_2'], 'subdir': 'vnp', 'shp_pattern': 'SUOMI_VIIRS*.shp',
+             'instrument': 'VIIRS_SOUMI', 'confidence': 'viirs', 'pozos_distance': 375},
+            {'name': 'NOAA-20', 'data_key': 'shp_noaa', 'url': data['url_noaa'],
+             'url_2': data['url_noaa_2'], 'subdir': 'noaa', 'shp_pattern': 'J1_VIIRS*.shp',
+             'instrument': 'VIIRS_NOAA', 'confidence': 'viirs', 'pozos_distance': 375},
+            {'name': 'NOAA-21', 'data_key': 'shp_noaa_21', 'url': data['url_noaa_21'],
+             'url_2': data.get('url_noaa_21_2'), 'subdir': 'noaa_21', 'shp_pattern': 'J2_VIIRS*.shp',
+             'instrument': 'VIIRS_NOAA_21', 'confidence': 'viirs', 'pozos_distance': 375},
+        ]
+    for sensor in sensors:
+        sensor.setdefault('url_2', None)
+        sensor.setdefault('subdir', sensor['data_key'].replace('shp_', '', 1))
+        sensor.setdefault('shp_pattern', '*.shp')
+        sensor.setdefault('instrument', sensor['name'].upper())
+        sensor.setdefault('confidence', 'viirs')
+        sensor.setdefault('pozos_distance', None)
+        sensor.setdefault('csv_url', derive_csv_url(sensor['url']))
+        sensor.setdefault('csv_url_2', derive_csv_url(sensor['url_2']))
+    return sensors
+
+
+'''
+Url del archivo CSV equivalente a un zip de shapefiles de FIRMS, None si la url no sigue
+el esquema de FIRMS (por ejemplo el archivo vacío de documentos.siatac.co)
+'''
+def derive_csv_url(url):
+    if url and '/shapes/zips/' in url and url.lower().endswith('.zip'):
+        return url.replace('/shapes/zips/', '/csv/')[:-4] + '.csv'
+    return None
+
+
+##################################################################
+##################################################################
+'''
+Latencias por host de los mirrors (firms / firms2)
+
+Se guardan entre ejecuciones en download_mirror_stats_file como un promedio móvil
+exponencial (EWMA) del tiempo de respuesta del HEAD de cada host. Un host que no
+responde suma una penalización igual a los timeouts de conexión y lectura.
+'''
+def get_mirror_stats_path(data):
+    return data.get('download_mirror_stats_file') or os.path.join(get_cache_dir(data), 'mirror_latency.json')
+
+
+def load_mirror_stats(data):
+    try:
+        with open(get_mirror_stats_path(data)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def update_mirror_latency(data, url, latency):
+    host = urllib.parse.urlsplit(url).netloc
+    alpha = float(data.get('download_mirror_ewma_alpha', 0.3))
+    if latency is None:
+        sample = float(data.get('download_connect_timeout', 10)) + float(data.get('download_read_timeout', 60))
+    else:
+        sample = latency
+    with mirror_stats_lock:
+        stats = load_mirror_stats(data)
+        entry = stats.get(host) or {'ewma': sample, 'samples': 0, 'failures': 0}
+        if entry['samples'] > 0:
+            entry['ewma'] = alpha * sample + (1 - alpha) * entry['ewma']
+        entry['samples'] += 1
+        if latency is None:
+            entry['failures'] += 1
+        entry['updated'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        stats[host] = entry
+        stats_path = get_mirror_stats_path(data)
+        with open(stats_path + '.part', 'w') as f:
+            json.dump(stats, f, indent=2)
+        os.replace(stats_path + '.part', stats_path)
+    logging.debug("Latencia {}: {} (EWMA {:.3f} s)".format(host, latency, entry['ewma']))
+
+
+'''
+Ordenar las urls de un sensor de la más rápida a la más lenta según las latencias guardadas,
+los hosts sin historial conservan el orden de config.json
+'''
+def order_mirrors(data, urls):
+    stats = load_mirror_stats(data)
+
+    def latency(url):
+        entry = stats.get(urllib.parse.urlsplit(url).netloc)
+        return entry['ewma'] if entry else float('inf')
+
+    return sorted(urls, key=latency)
+
+
+##################################################################
+##################################################################
+'''
+Carrera entre mirrors
+
+Ambos mirrors se consultan al mismo tiempo, cada uno se descarga y extrae en su
+propio subdirectorio (mirror_1, mirror_2). El primero que entrega un shapefile con
+registros gana y la descarga del otro se cancela: se aborta en su siguiente bloque y
+no extrae, no usa la cache ni registra latencias; la carrera espera a que termine para
+que no escriba nada después. El mirror históricamente más
+lento arranca su descarga download_mirror_hedge_seconds después, salvo que el
+preferido falle antes.
+'''
+def race_mirrors(data, sensor, session, sensor_dir, deadline=None):
+    name = sensor['name']
+    urls = order_mirrors(data, [sensor['url'], sensor['url_2']])
+    hedge_seconds = float(data.get('download_mirror_hedge_seconds', 1))
+    logging.debug("{}: carrera entre mirrors {}".format(name, urls))
+    cancel_event = threading.Event()
+    # Se activa cuando el mirror preferido termina (con o sin éxito)
+    preferred_done = threading.Event()
+
+    def run(index, url):
         try:
-            logging.debug('check file....')
-            r = requests.head(url_noaa)
-            logging.debug(r.status_code)
-            if r.status_code != 200:
-                # logging.debug(r.headers['content-type'])
-                logging.debug(r.headers)
-                logging.debug('switch to server 2....')
-                url_noaa = url_noaa_2
-                logging.debug("url_noaa : {} ".format(url_noaa))
+            mirror_dir = os.path.join(sensor_dir, 'mirror_{}'.format(index + 1))
+            os.makedirs(mirror_dir, exist_ok=True)
+            start_time = time.monotonic()
+            try:
+                r = session.head(url, timeout=get_request_timeout(data, deadline))
+                available = r.status_code == 200
+            except requests.exceptions.RequestException as e:
+                logging.debug('{}: check file {} falló, {}'.format(name, url, e))
+                available = False
+            check_cancelled(cancel_event, url)
+            update_mirror_latency(data, url, time.monotonic() - start_time if available else None)
+            if not available:
+                raise Exception("{}: el mirror {} no está disponible".format(name, url))
+            if index > 0 and hedge_seconds > 0:
+                preferred_done.wait(hedge_seconds)
+            check_cancelled(cancel_event, url)
+            zip_path = os.path.join(mirror_dir, sensor['subdir'] + '.zip')
+            shp_name, download = fetch_and_extract(data, session, url, zip_path, mirror_dir, sensor['shp_pattern'],
+                                                   deadline, cancel_event)
+            record_count = count_shapefile_records(mirror_dir, shp_name)
+            shp_path = os.path.join(mirror_dir, shp_name) if shp_name else ""
+            return url, shp_path, record_count, download
+        finally:
+            if index == 0:
+                preferred_done.set()
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(urls))
+    pending = [executor.submit(run, index, url) for index, url in enumerate(urls)]
+    outcomes = []
+    errors = []
+    winner = None
+    try:
+        while pending and winner is None:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                try:
+                    outcome = future.result()
+                except DownloadCancelled:
+                    continue
+                except Exception as e:
+                    logging.debug('{}: {}'.format(name, e))
+                    errors.append(str(e))
+                    continue
+                outcomes.append(outcome)
+                if winner is None and outcome[1] and outcome[2] > 0:
+                    winner = outcome
+    finally:
+        # La descarga perdedora se aborta en su siguiente bloque o antes de extraer o registrar
+        # latencias; se espera a que termine para que no escriba después de la carrera
+        cancel_event.set()
+        executor.shutdown(wait=True)
 
-            logging.debug('Beginning file download....')
-            r = requests.get(url_noaa)
+    if winner is not None:
+        logging.info("{}: mirror ganador {} ({} registros)".format(name, winner[0], winner[2]))
+        return winner
+    for outcome in outcomes:
+        if outcome[1]:
+            logging.warning("{}: Shapefile descargado tiene 0 registros en todos los mirrors.".format(name))
+            return outcome
+    raise Exception("{}: ningún mirror entregó el archivo. {}".format(name, "; ".join(errors)))
 
-            noaa_zip_path = os.path.join(current_day_temp_dir, "noaa.zip")
-            logging.debug("**************")
-            logging.debug("noaa_zip_path : {} ".format(noaa_zip_path))
-            logging.debug("**************")
 
-            logging.debug(r.status_code)
-            logging.debug(r.headers['content-type'])
-            # logging.debug(r.encoding)
-            with open(noaa_zip_path, 'wb') as f:
-                f.write(r.content)
-            with zipfile.ZipFile(noaa_zip_path, 'r') as zip_ref:
-                zip_ref.extractall(current_day_temp_dir)
-
-            # Validar que el shapefile tenga registros
-            record_count = count_shapefile_records(current_day_temp_dir)
-            logging.info("NOAA-20: Registros antes de usar URL alterna: {}".format(record_count))
-            if record_count == 0:
-                logging.warning("NOAA-20: Shapefile descargado tiene 0 registros. Intentando con URL alterna...")
-                # Usar URL alterna
-                url_noaa = url_noaa_2
-                logging.info("Descargando desde URL alterna: {}".format(url_noaa))
-
-                r = requests.get(url_noaa)
-                logging.debug(r.status_code)
-                logging.debug(r.headers['content-type'])
-                with open(noaa_zip_path, 'wb') as f:
-                    f.write(r.content)
-                with zipfile.ZipFile(noaa_zip_path, 'r') as zip_ref:
-                    zip_ref.extractall(current_day_temp_dir)
-
-                # Validar nuevamente
-                record_count = count_shapefile_records(current_day_temp_dir)
-                logging.info("NOAA-20: Registros después de usar URL alterna: {}".format(record_count))
-        except Exception as e:
-            logging.debug('No se puede descargar información para noaa, {}'.format(e))
+##################################################################
+##################################################################
+'''
+Descarga del archivo CSV de un sensor (input_format = csv)
 
-        #######################################################################################
-        ## noaa-21
-        #######################################################################################
-        # check file
+El CSV se descarga con la misma cache y validaciones que los zips, primero desde
+csv_url y luego desde csv_url_2 si la principal falla o llega sin registros. El
+archivo no se convierte aquí, normalize_sensors lo lee fila a fila (iter_firms_csv).
+'''
+# Columnas mínimas que debe tener el CSV de FIRMS
+FIRMS_CSV_REQUIRED = ['latitude', 'longitude', 'acq_date', 'acq_time']
+
+
+def count_csv_records(csv_path):
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        header = [column.strip().lower() for column in next(reader, [])]
+        missing = [column for column in FIRMS_CSV_REQUIRED if column not in header]
+        if missing:
+            raise Exception("El CSV {} no tiene las columnas {}".format(csv_path, missing))
+        return sum(1 for row in reader if row)
+
+
+def download_sensor_csv(data, sensor, session, sensor_dir, deadline=None):
+    name = sensor['name']
+    urls = [sensor['csv_url']]
+    if sensor.get('csv_url_2') and sensor['csv_url_2'] != sensor['csv_url']:
+        urls.append(sensor['csv_url_2'])
+    csv_path = os.path.join(sensor_dir, sensor['subdir'] + '.csv')
+    chunk_size, max_size = get_download_limits(data)
+    outcome = None
+    error = None
+    for url in urls:
         try:
-            logging.debug('check file....')
-            r = requests.head(url_noaa_21)
-            logging.debug(r.status_code)
-            if r.status_code != 200:
-                # logging.debug(r.headers['content-type'])
-                logging.debug(r.headers)
-                logging.debug('switch to server 2.... the same')
-                logging.debug("url_noaa_21 : {} ".format(url_noaa_21))
+            logging.debug('{}: descargando CSV {}'.format(name, url))
+            download = cached_download(data, session, url, csv_path, chunk_size, max_size,
+                                       data.get('download_verify', True), deadline)
+            record_count = count_csv_records(csv_path)
+            logging.info("{}: {} registros en {}".format(name, record_count, url))
+            outcome = (url, csv_path, record_count, download)
+            if record_count > 0:
+                return outcome
+        except DownloadCancelled:
+            raise
+        except Exception as e:
+            logging.debug('{}: no se pudo descargar {}, {}'.format(name, url, e))
+            error = e
+    if outcome is None:
+        raise error
+    logging.warning("{}: CSV descargado tiene 0 registros.".format(name))
+    return outcome
+
+
+##################################################################
+##################################################################
+'''
+Un intento de descarga del shp de un sensor, usando la url alterna cuando la principal
+no responde o cuando el shp descargado no tiene registros. Con download_mirror_race
+ambas urls compiten (race_mirrors). Con input_format = csv se intenta primero el CSV
+del sensor y el shapefile queda como respaldo.
+'''
+def download_sensor_attempt(data, sensor, session, sensor_dir, deadline=None):
+    name = sensor['name']
+    url = sensor['url']
+    url_2 = sensor['url_2']
+    shp_pattern = sensor['shp_pattern']
+    if data.get('input_format', 'shapefile') == 'csv':
+        if sensor.get('csv_url'):
+            try:
+                return download_sensor_csv(data, sensor, session, sensor_dir, deadline)
+            except Exception as e:
+                logging.warning("{}: no se pudo descargar el CSV, se usa el shapefile. {}".format(name, e))
+        else:
+            logging.info("{}: no tiene url CSV, se usa el shapefile".format(name))
+    if data.get('download_mirror_race', False) and url_2 and url_2 != url:
+        return race_mirrors(data, sensor, session, sensor_dir, deadline)
+
+    # check file
+    logging.debug('{}: check file....'.format(name))
+    try:
+        r = session.head(url, timeout=get_request_timeout(data, deadline))
+        status_code = r.status_code
+        logging.debug(status_code)
+        if status_code != 200:
+            logging.debug(r.headers)
+    except requests.exceptions.RequestException as e:
+        logging.debug('{}: check file falló, {}'.format(name, e))
+        status_code = None
+    if status_code != 200:
+        if url_2:
+            logging.debug('{}: switch to server 2....'.format(name))
+            url = url_2
+        else:
+            logging.debug('{}: switch to server 2.... the same'.format(name))
+        logging.debug("{} url : {} ".format(name, url))
+
+    zip_path = os.path.join(sensor_dir, sensor['subdir'] + '.zip')
+    logging.debug("**************")
+    logging.debug("{} zip_path : {} ".format(name, zip_path))
+    logging.debug("**************")
+
+    logging.debug('{}: Beginning file download....'.format(name))
+    shp_name, download = fetch_and_extract(data, session, url, zip_path, sensor_dir, shp_pattern, deadline)
+
+    # Validar que el shapefile tenga registros
+    record_count = count_shapefile_records(sensor_dir, shp_name)
+    logging.info("{}: Registros antes de usar URL alterna: {}".format(name, record_count))
+
+    if record_count == 0:
+        if url_2 and url != url_2:
+            logging.warning("{}: Shapefile descargado tiene 0 registros. Intentando con URL alterna...".format(name))
+            url = url_2
+            logging.info("Descargando desde URL alterna: {}".format(url))
+            shp_name, download = fetch_and_extract(data, session, url, zip_path, sensor_dir, shp_pattern,
+                                                   deadline)
+
+            # Validar nuevamente
+            record_count = count_shapefile_records(sensor_dir, shp_name)
+            logging.info("{}: Registros después de usar URL alterna: {}".format(name, record_count))
+        else:
+            logging.warning("{}: Shapefile descargado tiene 0 registros.".format(name))
+            logging.info("{} no tiene URL alterna configurada. Continuando con archivo vacío.".format(name))
+    shp_path = os.path.join(sensor_dir, shp_name) if shp_name else ""
+    return url, shp_path, record_count, download
 
-            logging.debug('Beginning file download....')
-            r = requests.get(url_noaa_21)
 
-            noaa21_zip_path = os.path.join(current_day_temp_dir, "noaa_21.zip")
-            logging.debug("**************")
-            logging.debug("noaa21_zip_path : {} ".format(noaa21_zip_path))
-            logging.debug("**************")
+##################################################################
+##################################################################
+'''
+Descargar el shp de un sensor
 
-            logging.debug(r.status_code)
-            logging.debug(r.headers['content-type'])
-
-            with open(noaa21_zip_path, 'wb') as f:
-                f.write(r.content)
-            with zipfile.ZipFile(noaa21_zip_path, 'r') as zip_ref:
-                zip_ref.extractall(current_day_temp_dir)
-
-            # Validar que el shapefile tenga registros
-            record_count = count_shapefile_records(current_day_temp_dir)
-            logging.info("NOAA-21: Registros antes de usar URL alterna: {}".format(record_count))
-            if record_count == 0:
-                logging.warning("NOAA-21: Shapefile descargado tiene 0 registros.")
-                logging.info("NOAA-21 no tiene URL alterna configurada. Continuando con archivo vacío.")
+Cada sensor se reintenta de forma independiente hasta download_sensor_retries veces,
+esperando entre intentos con backoff exponencial y jitter (backoff_delay). Ningún
+intento continúa después del plazo global de la descarga.
+'''
+def download_sensor_file(data, sensor, session, deadline=None):
+    """
+    Descarga y valida el archivo de un sensor
+
+    Args:
+        data: Configuración de la ejecución
+        sensor: Entrada del registro de sensores (ver get_sensor_registry)
+        session: Sesión http compartida (create_http_session)
+        deadline: Plazo global (time.monotonic) de la etapa de descarga
+
+    Returns:
+        dict: Resultado de la descarga (shp, url, records, bytes, sha256, cache, attempts, seconds, error)
+    """
+    # Cada sensor se extrae en su propio directorio
+    sensor_dir = os.path.join(data['current_day_temp_dir'], sensor['subdir'])
+    os.makedirs(sensor_dir, exist_ok=True)
+    name = sensor['name']
+    sensor_retries = max(1, int(data.get('download_sensor_retries', 3)))
+    result = {'sensor': name, 'shp': "", 'url': sensor['url'], 'records': -1, 'bytes': 0, 'sha256': None,
+              'cache': None, 'attempts': 0, 'seconds': 0, 'error': None}
+    start_time = time.time()
+    for attempt in range(sensor_retries):
+        result['attempts'] = attempt + 1
+        try:
+            url, shp_path, record_count, download = download_sensor_attempt(data, sensor, session, sensor_dir,
+                                                                            deadline)
+            result['url'] = url
+            result['records'] = record_count
+            result['bytes'] = download['bytes']
+            result['sha256'] = download['sha256']
+            result['cache'] = download.get('cache')
+            result['error'] = None
+            if shp_path:
+                result['shp'] = shp_path
+                break
         except Exception as e:
-            logging.debug('No se puede descargar información para noaa 21, {}'.format(e))
+            logging.debug('No se puede descargar información para {} (intento {}), {}'.format(name, attempt + 1, e))
+            result['error'] = str(e)
+
+        if attempt + 1 < sensor_retries:
+            if deadline is not None and time.monotonic() >= deadline:
+                logging.warning("{}: se superó el plazo de descarga, no se reintenta".format(name))
+                break
+            delay = backoff_delay(data, attempt, deadline)
+            logging.debug("{}: reintento en {:.1f} segundos".format(name, delay))
+            time.sleep(delay)
+    result['seconds'] = round(time.time() - start_time, 2)
+    logging.info("{}: descarga finalizada en {} segundos ({} intentos)".format(name, result['seconds'],
+                                                                                result['attempts']))
+    return result
+
+
+##################################################################
+##################################################################
+'''
+descargar los shps de la nasa
+
+Los sensores se descargan en paralelo (download_concurrent), el número de
+descargas simultáneas se limita con download_max_workers. Todas las descargas
+comparten una sesión http con pool de conexiones.
+'''
+def download_nasa_files(data, deadline=None):
+    try:
+        logging.debug("***********************************")
+        logging.debug("** download_nasa_files **")
+        logging.debug("***********************************")
+        sensors = get_sensor_registry(data)
+        for sensor in sensors:
+            logging.debug("{} url : {} ".format(sensor['name'], sensor['url']))
+            logging.debug("{} url_2 : {} ".format(sensor['name'], sensor['url_2']))
+            logging.debug("{} subdir : {} , shp_pattern : {} ".format(sensor['name'], sensor['subdir'],
+                                                                     sensor['shp_pattern']))
+
+        download_concurrent = data.get('download_concurrent', True)
+        max_workers = max(1, int(data.get('download_max_workers', 4)))
+        logging.debug("download_concurrent : {} ".format(download_concurrent))
+        logging.debug("download_max_workers : {} ".format(max_workers))
+
+        data.setdefault('download_metrics', {'cache_hits': 0, 'cache_misses': 0,
+                                             'bytes_downloaded': 0, 'bytes_saved': 0})
+        start_time = time.time()
+        with create_http_session(data) as session:
+            if download_concurrent and max_workers > 1:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(sensors))) as executor:
+                    results = list(executor.map(
+                        lambda sensor: download_sensor_file(data, sensor, session, deadline), sensors))
+            else:
+                results = [download_sensor_file(data, sensor, session, deadline) for sensor in sensors]
 
         #######################################################################################
         ## FIND SHPS
         #######################################################################################
         logging.debug("***********************************")
-        for shp in glob.iglob(os.path.join(current_day_temp_dir, '*.shp')):
-            logging.debug(shp)
-            if "MODIS".lower() in shp.lower():
-                data['shp_modis'] = shp
-            elif "SUOMI_VIIRS".lower() in shp.lower():
-                data['shp_vnp'] = shp
-            elif "J1_VIIRS".lower() in shp.lower():
-                data['shp_noaa'] = shp
-            elif "J2_VIIRS".lower() in shp.lower():
-                data['shp_noaa_21'] = shp
+        download_results = data.setdefault('download_results', {})
+        for sensor, result in zip(sensors, results):
+            logging.debug("{} : {} ({} registros, {} s)".format(sensor['name'], result['shp'],
+                                                               result['records'], result['seconds']))
+            download_results[sensor['data_key']] = result
+            if result['shp']:
+                data[sensor['data_key']] = result['shp']
+        data['download_seconds'] = round(time.time() - start_time, 2)
+        logging.info("Descarga de sensores finalizada en {} segundos".format(data['download_seconds']))
+        metrics = data['download_metrics']
+        logging.info("Cache de descargas: {} aciertos, {} fallos, {} bytes descargados, {} bytes ahorrados".format(
+            metrics['cache_hits'], metrics['cache_misses'], metrics['bytes_downloaded'], metrics['bytes_saved']))
         #######################################################################################
         #######################################################################################
         logging.debug("***********************************")
@@ -382,31 +1079,40 @@ def download_shps(data):
     logging.debug("***********************************")
     max_retries = data['max_retries']
     delay_seconds = data['delay_seconds']
+    deadline_seconds = float(data.get('download_deadline_seconds', 900))
+    deadline = time.monotonic() + deadline_seconds
     logging.debug("max_retries : {} ".format(max_retries))
     logging.debug("delay_seconds : {} ".format(delay_seconds))
-
-    data['shp_modis'] = ""
-    data['shp_vnp'] = ""
-    data['shp_noaa'] = ""
-    data['shp_noaa_21'] = ""
+    logging.debug("download_deadline_seconds : {} ".format(deadline_seconds))
+
+    # process_data espera siempre las llaves de los cuatro sensores originales
+    data_keys = ['shp_modis', 'shp_vnp', 'shp_noaa', 'shp_noaa_21']
+    for sensor in get_sensor_registry(data):
+        if sensor['data_key'] not in data_keys:
+            data_keys.append(sensor['data_key'])
+    for data_key in data_keys:
+        data[data_key] = ""
+    data['download_results'] = {}
+    data['download_metrics'] = {'cache_hits': 0, 'cache_misses': 0, 'bytes_downloaded': 0, 'bytes_saved': 0}
 
     i = 0
     while i < max_retries:
         logging.debug("try download # : {} ".format(i))
         try:
-            download_nasa_files(data)
+            download_nasa_files(data, deadline)
             logging.debug("***********************************")
-            logging.debug("shp_modis : {} ".format(data['shp_modis']))
-            logging.debug("shp_vnp : {} ".format(data['shp_vnp']))
-            logging.debug("shp_noaa : {} ".format(data['shp_noaa']))
-            logging.debug("shp_noaa_21 : {} ".format(data['shp_noaa_21']))
+            for data_key in data_keys:
+                logging.debug("{} : {} ".format(data_key, data[data_key]))
             logging.debug("***********************************")
 
         except Exception as e:
             print_error(e)
 
         # AVera - 20231211, Se ajusta el siguiente condicional para que intente nuevamento solo cuando fallan los cuatro sensores.
-        if data['shp_modis'] == "" and data['shp_vnp'] == "" and data['shp_noaa'] == "" and data['shp_noaa_21'] == "":
+        if all(data[data_key] == "" for data_key in data_keys):
+            if time.monotonic() + delay_seconds >= deadline:
+                logging.warning("Se superó el plazo de descarga de {} segundos".format(deadline_seconds))
+                break
             logging.debug("sleep begin...")
             time.sleep(delay_seconds)
             logging.debug("sleep end...")
@@ -417,14 +1123,12 @@ def download_shps(data):
     logging.debug("***********************************")
     logging.debug("** Local shps : *")
     logging.debug("***********************************")
-    logging.debug("shp_modis : {} ".format(data['shp_modis']))
-    logging.debug("shp_vnp : {} ".format(data['shp_vnp']))
-    logging.debug("shp_noaa : {} ".format(data['shp_noaa']))
-    logging.debug("shp_noaa_21 : {} ".format(data['shp_noaa_21']))
+    for data_key in data_keys:
+        logging.debug("{} : {} ".format(data_key, data[data_key]))
     logging.debug("***********************************")
 
     # AVera - 20231211, Se ajusta el siguiente condicional para que levante la excepcion solo cuando fallan los cuatro sensores.
-    if data['shp_modis'] == "" and data['shp_vnp'] == "" and data['shp_noaa'] == "" and data['shp_noaa_21'] == "":
+    if all(data[data_key] == "" for data_key in data_keys):
         raise Exception('ERROR_001 - No se pudo descargar shps de la nasa')
     logging.debug("***********************************")
 
@@ -467,221 +1171,2151 @@ def send_email(data, to, subject, message, bcc=[]):
             # msg['Bcc'] = ', '.join(bcc)
             # text = """\n{}\n""".format(message)
 
-            html = """\
-            <html>
-            <body style="font-family: "Trebuchet MS", Arial, Helvetica, sans-serif;" >
-                <p>
-                <br/>
-                {}
-                <br/>
-                </p>
-                <div>                    
-					<table>
-					<tr>
-					<td>
-					<img src="http://siatac.co/image/image_gallery?uuid=b9aa63b4-d60d-4765-9179-f24054d059da&groupId=755&t=1579281579021" height="47" width="68" float="left" class="CToWUd a6T" tabindex="0">
-					</td>
-					<td>
-					<font size = "1">Para conocer la ubicación de los puntos de calor reportados, ingrese al mapa interactivo del sistema de monitoreo (SINCHI)</font>
-					<a href="https://experience.arcgis.com/stemapp/ceb7f423780c410389ca35fc0990e7e4" target="_blank" >Aquí.</a> 
-					<br/>
-					<font size = "1">Para mayor detalle ingrese al sistema de monitoreo de puntos de calor y cicatrices de quema (SINCHI)</font>
-					<a href="http://siatac.co/web/guest/productos/monitoreo-fuegos" target="_blank" >Aquí</a>
-					</td>					
-					</tr>
-				</table>
-				<table>
-				<tr>
-				<td style="width: 68px;">
-				<img src="http://siatac.co/image/image_gallery?uuid=0d3c9e99-5a22-4ba8-8c6d-485032d8b6d7&groupId=755&t=1579281543068" height="37" width="46" float="left" class="CToWUd a6T" tabindex="0">
-				</td>
-				<td>
-				<font size = "1">Para revisar el sistema de monitoreo de puntos activos de calor en Colombia (IDEAM)</font>
-				<a href="http://puntosdecalor.ideam.gov.co/" target="_blank" >Aquí</a><br>
-				<font size = "1">Para revisar el sistema de pronostico y alertas en Colombia (IDEAM)</font>
-				<a href="http://www.pronosticosyalertas.gov.co/alertabig-portlet/html/alertabig/view.jsp" target="_blank" >Aquí</a><br>
-				<td>		
-				</tr>
-				</table>
-				<br/>
-                    <font size = "2">Para dejar de recibir este servicio puede enviar un correo a </font>
-                    <a href="mailto:siatac@sinchi.org.co" target="_blank">siatac@sinchi.org.co</a>
-                <br/><br/><br/>
-                    <img src="http://siatac.co:81/images/ui/Logo_Mail.png" 
-                height="116" width="589" class="CToWUd a6T" tabindex="0">
-                </div>
+            html = """\
+            <html>
+            <body style="font-family: "Trebuchet MS", Arial, Helvetica, sans-serif;" >
+                <p>
+                <br/>
+                {}
+                <br/>
+                </p>
+                <div>                    
+					<table>
+					<tr>
+					<td>
+					<img src="http://siatac.co/image/image_gallery?uuid=b9aa63b4-d60d-4765-9179-f24054d059da&groupId=755&t=1579281579021" height="47" width="68" float="left" class="CToWUd a6T" tabindex="0">
+					</td>
+					<td>
+					<font size = "1">Para conocer la ubicación de los puntos de calor reportados, ingrese al mapa interactivo del sistema de monitoreo (SINCHI)</font>
+					<a href="https://experience.arcgis.com/stemapp/ceb7f423780c410389ca35fc0990e7e4" target="_blank" >Aquí.</a> 
+					<br/>
+					<font size = "1">Para mayor detalle ingrese al sistema de monitoreo de puntos de calor y cicatrices de quema (SINCHI)</font>
+					<a href="http://siatac.co/web/guest/productos/monitoreo-fuegos" target="_blank" >Aquí</a>
+					</td>					
+					</tr>
+				</table>
+				<table>
+				<tr>
+				<td style="width: 68px;">
+				<img src="http://siatac.co/image/image_gallery?uuid=0d3c9e99-5a22-4ba8-8c6d-485032d8b6d7&groupId=755&t=1579281543068" height="37" width="46" float="left" class="CToWUd a6T" tabindex="0">
+				</td>
+				<td>
+				<font size = "1">Para revisar el sistema de monitoreo de puntos activos de calor en Colombia (IDEAM)</font>
+				<a href="http://puntosdecalor.ideam.gov.co/" target="_blank" >Aquí</a><br>
+				<font size = "1">Para revisar el sistema de pronostico y alertas en Colombia (IDEAM)</font>
+				<a href="http://www.pronosticosyalertas.gov.co/alertabig-portlet/html/alertabig/view.jsp" target="_blank" >Aquí</a><br>
+				<td>		
+				</tr>
+				</table>
+				<br/>
+                    <font size = "2">Para dejar de recibir este servicio puede enviar un correo a </font>
+                    <a href="mailto:siatac@sinchi.org.co" target="_blank">siatac@sinchi.org.co</a>
+                <br/><br/><br/>
+                    <img src="http://siatac.co:81/images/ui/Logo_Mail.png" 
+                height="116" width="589" class="CToWUd a6T" tabindex="0">
+                </div>
+
+            </body>
+			</html>
+                """.format(message)
+
+            # part1 = MIMEText(text, "plain")
+            part2 = MIMEText(html, "html")
+            # msg.attach(part1)
+            msg.attach(part2)
+
+            server.sendmail(
+                gmail_user, [email] + bcc, msg.as_string()
+            )
+
+            logging.debug("Email sent!")
+        except Exception as e:
+            print_error(e)
+            logging.debug("Something went wrong sending email.")
+    server.close()
+    logging.debug("***********************************")
+
+
+##################################################################
+##################################################################
+'''
+Creación de conexiones SDE a las bases de datos
+'''
+def create_sde_connections(data):
+    logging.debug("***********************************")
+    try:
+        ## Read
+        username = data['user_reader']
+        password = data['user_reader_pwd']
+        instance = data['prod_instance']
+        database_name = data['prod_database_name']
+        reader_conn = create_conn(data, username, password, instance, database_name)
+        data['reader_conn_prod_instance'] = reader_conn
+
+        username = data['pub_user_reader']
+        password = data['pub_user_reader_pwd']
+        instance = data['pub_instance']
+        database_name = data['pub_database_name']
+        reader_conn = create_conn(data, username, password, instance, database_name)
+        data['reader_conn_pub_instance'] = reader_conn
+
+        ## write
+        username = data['prod_user_edit']
+        password = data['prod_user_edit_pwd']
+        instance = data['prod_edit_instance']
+        database_name = data['prod_database_name']
+        reader_conn = create_conn(data, username, password, instance, database_name)
+        data['edit_conn_prod_instance'] = reader_conn
+
+        username = data['pub_user_edit']
+        password = data['pub_user_edit_pwd']
+        instance = data['pub_edit_instance']
+        database_name = data['pub_database_name']
+        reader_conn = create_conn(data, username, password, instance, database_name)
+        data['edit_conn_pub_instance'] = reader_conn
+    except Exception as e:
+        print_error(e)
+        raise Exception('ERROR_002 - No se pudo crear las conexiones SDE a las bases de datos')
+    logging.debug("***********************************")
+
+
+##################################################################
+##################################################################
+'''
+Cache local de las capas de referencia (reference_cache)
+
+layer_hidrocarburos, layer_dlim y layer_union_ent_ref casi nunca cambian. Con la cache
+activa se copian a reference_cache_dir/referencias.gdb y las etapas siguientes leen la copia
+local. En cada ejecución solo se consulta la huella de la capa en SDE (número de registros,
+extensión, máximo OBJECTID y última edición si la capa tiene editor tracking), la copia se
+refresca cuando la huella cambia. Si algo falla se sigue trabajando con la capa de SDE.
+'''
+REFERENCE_LAYERS = ['feature_hidrocarburos', 'feature_dlim', 'feature_union_ent_ref']
+
+
+def max_field_value(layer, field):
+    # Solo lee la primera fila ordenada en la base de datos
+    with arcpy.da.SearchCursor(layer, [field], sql_clause=(None, 'ORDER BY {} DESC'.format(field))) as cursor:
+        for row in cursor:
+            return row[0]
+    return None
+
+
+def get_reference_fingerprint(layer):
+    describe = arcpy.Describe(layer)
+    extent = describe.extent
+    fingerprint = {'count': int(arcpy.GetCount_management(layer)[0]),
+                   'extent': [round(value, 8) for value in (extent.XMin, extent.YMin, extent.XMax, extent.YMax)],
+                   'max_oid': max_field_value(layer, describe.OIDFieldName)}
+    if getattr(describe, 'editorTrackingEnabled', False) and describe.editedAtFieldName:
+        last_edit = max_field_value(layer, describe.editedAtFieldName)
+        fingerprint['last_edit'] = last_edit.strftime(WATERMARK_FORMAT) if last_edit else None
+    return fingerprint
+
+
+def cache_reference_layers(data):
+    cache_dir = data.get('reference_cache_dir') or os.path.join(data['temp_dir'], 'cache_referencias')
+    os.makedirs(cache_dir, exist_ok=True)
+    gdb_name = 'referencias.gdb'
+    gdb_path = os.path.join(cache_dir, gdb_name)
+    data['reference_cache_status'] = {}
+    for key in REFERENCE_LAYERS:
+        source = data[key]
+        name = get_last_portion(os.path.basename(source))
+        local_path = os.path.join(gdb_path, name)
+        try:
+            if not arcpy.Exists(gdb_path):
+                arcpy.CreateFileGDB_management(cache_dir, gdb_name)
+            fingerprint = get_reference_fingerprint(source)
+            if arcpy.Exists(local_path) and read_cached_fingerprint(cache_dir, name) == fingerprint:
+                status = 'cache'
+            else:
+                start_time = time.time()
+                if arcpy.Exists(local_path):
+                    arcpy.Delete_management(local_path)
+                arcpy.FeatureClassToFeatureClass_conversion(source, gdb_path, name)
+                write_cached_fingerprint(cache_dir, name, fingerprint)
+                status = 'copiada en {} segundos'.format(round(time.time() - start_time, 2))
+            data[key + '_sde'] = source
+            data[key] = local_path
+        except Exception as e:
+            print_error(e)
+            status = 'error, se usa la capa de SDE'
+        data['reference_cache_status'][name] = status
+        logging.info("Cache de referencia {}: {}".format(name, status))
+
+
+##################################################################
+##################################################################
+'''
+Validación datos de entrada SDE
+'''
+def validate_input_data(data):
+    logging.debug("***********************************")
+    logging.debug("** validate_input_data **")
+    logging.debug("***********************************")
+    try:
+        ##################################################################
+        reader_conn = data['reader_conn_prod_instance']
+
+        layer = data['layer_hidrocarburos']
+        if data["is_test"]:
+            layer = "\\" + get_last_portion(layer)
+        feature_path = reader_conn + layer
+        result = int(arcpy.GetCount_management(feature_path)[0])
+        logging.debug('{} has {} records'.format(layer, result))
+        #if result == 0:
+        #    raise Exception("No se encontraron datos en la capa {} ".format(layer))
+        data['feature_hidrocarburos'] = feature_path
+
+        layer = data['layer_union_ent_ref']
+        if data["is_test"]:
+            layer = "\\" + get_last_portion(layer)
+        feature_path = reader_conn + layer
+        result = int(arcpy.GetCount_management(feature_path)[0])
+        logging.debug('{} has {} records'.format(layer, result))
+        #if result == 0:
+        #    raise Exception("No se encontraron datos en la capa {} ".format(layer))
+        data['feature_union_ent_ref'] = feature_path
+
+        layer = data['layer_dlim']
+        if data["is_test"]:
+            layer = "\\" + get_last_portion(layer)
+        feature_path = reader_conn + layer
+        result = int(arcpy.GetCount_management(feature_path)[0])
+        logging.debug('{} has {} records'.format(layer, result))
+        #if result == 0:
+        #    raise Exception("No se encontraron datos en la capa {} ".format(layer))
+        data['feature_dlim'] = feature_path
+
+        reader_conn = data['reader_conn_pub_instance']
+
+        layer = data['layer_usuarios_emails']
+        if data["is_test"]:
+            layer = "\\" + get_last_portion(layer)
+        feature_path = reader_conn + layer
+        result = int(arcpy.GetCount_management(feature_path)[0])
+        logging.debug('{} has {} records'.format(layer, result))
+        #if result == 0:
+        #    raise Exception("No se encontraron datos en la capa {} ".format(layer))
+        data['feature_usuarios_emails'] = feature_path
+
+        ##################################################################
+        edit_conn = data['edit_conn_prod_instance']
+
+        layer = data['layer_output_prod']
+        if data["is_test"]:
+            layer = "\\" + get_last_portion(layer)
+        feature_path = edit_conn + layer
+        result = int(arcpy.GetCount_management(feature_path)[0])
+        logging.debug('{} has {} records'.format(layer, result))
+        #if result == 0:
+        #    raise Exception("No se encontraron datos en la capa {} ".format(layer))
+        data['feature_output_prod'] = feature_path
+        data['total_fuegos_historicos_prod'] = result
+
+        edit_conn = data['edit_conn_pub_instance']
+
+        layer = data['layer_output_pub']
+        if data["is_test"]:
+            layer = "\\" + get_last_portion(layer)
+        feature_path = edit_conn + layer
+        result = int(arcpy.GetCount_management(feature_path)[0])
+        logging.debug('{} has {} records'.format(layer, result))
+        #if result == 0:
+        #    raise Exception("No se encontraron datos en la capa {} ".format(layer))
+        data['feature_output_pub'] = feature_path
+        data['total_fuegos_historicos_pub'] = result
+
+        layer_sirgas = data['layer_output_pub_sirgas']
+        if data["is_test"]:
+            layer_sirgas = "\\" + get_last_portion(layer_sirgas)
+        feature_path_sirgas = edit_conn + layer_sirgas
+        result_sirgas = int(arcpy.GetCount_management(feature_path_sirgas)[0])
+        logging.debug('{} has {} records'.format(layer_sirgas, result_sirgas))
+        #if result_sirgas == 0:
+        #    raise Exception("No se encontraron datos en la capa {} ".format(layer_sirgas))
+        data['feature_output_pub_sirgas'] = feature_path_sirgas
+        data['total_fuegos_historicos_pub_sirgas'] = result_sirgas
+        ##################################################################
+        if data.get('reference_cache', False):
+            cache_reference_layers(data)
+    except Exception as e:
+        print_error(e)
+        raise Exception('ERROR_003 - Error al Validar Datos : {} '.format(e))
+
+    logging.debug("***********************************")
+
+##################################################################
+##################################################################
+'''
+Valida la existencia de un atributo
+'''
+def field_exists(layer_name, field_name):
+    if arcpy.Exists(layer_name):
+        return len(arcpy.ListFields(layer_name, field_name)) > 0
+
+##################################################################
+##################################################################
+'''
+Fecha mínima (hora de Colombia) de las detecciones que se procesan
+'''
+def get_min_acq_date(tz, max_hours=24, reference_date=None):
+    # Para procesar una fecha específica se usa reference_date (llave reference_date de config.json)
+    reference_date = reference_date or datetime.datetime.now()
+    min_date = reference_date - datetime.timedelta(hours=max_hours, minutes=0)
+    return tz.localize(min_date)
+
+
+'''
+Fecha de referencia de la ventana de 24 horas (hora de Colombia). Por defecto es el momento
+de la ejecución; con la llave reference_date ("YYYY-MM-DD HH:MM" o "YYYY-MM-DD") se
+reprocesa la ventana que termina en esa fecha, como si el proceso se ejecutara en ese momento.
+
+Returns:
+    datetime sin zona horaria, None si no se configuró reference_date
+'''
+def get_reference_date(data):
+    value = data.get('reference_date')
+    if not value:
+        return None
+    for date_format in (WATERMARK_FORMAT, "%Y-%m-%d"):
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise Exception("reference_date no tiene el formato YYYY-MM-DD HH:MM: {}".format(value))
+
+
+##################################################################
+##################################################################
+'''
+Marca de agua de la carga incremental (incremental_mode)
+
+Guarda por INSTRUMENT la fecha y hora de adquisición (UTC) más reciente que ya se
+cargó en las tablas históricas. En modo incremental solo se procesan las detecciones
+posteriores a la marca menos watermark_overlap_minutes; el traslape cubre las
+detecciones que la NASA publica con retraso y la validación contra la base de datos
+descarta las que ya existían.
+'''
+WATERMARK_FORMAT = "%Y-%m-%d %H:%M"
+
+
+def get_watermark_path(data):
+    return data.get('watermark_file') or os.path.join(data['temp_dir'], 'watermark_fuegos.json')
+
+
+def load_watermark(data):
+    try:
+        with open(get_watermark_path(data)) as f:
+            return json.load(f).get('instruments', {})
+    except (OSError, ValueError):
+        return {}
+
+
+def save_watermark(data, watermark):
+    watermark_path = get_watermark_path(data)
+    content = {'instruments': watermark,
+               'updated': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+    with open(watermark_path + '.part', 'w') as f:
+        json.dump(content, f, indent=2)
+    os.replace(watermark_path + '.part', watermark_path)
+    logging.info("Marca de agua actualizada: {}".format(watermark))
+
+
+def get_watermark_cutoffs(data, watermark):
+    overlap = datetime.timedelta(minutes=float(data.get('watermark_overlap_minutes', 60)))
+    return {instrument: datetime.datetime.strptime(value, WATERMARK_FORMAT) - overlap
+            for instrument, value in watermark.items()}
+
+
+##################################################################
+##################################################################
+'''
+Filtro de la ventana de 24 horas y campos de fecha en hora de Colombia
+
+Se leen ACQ_DATE + ACQ_TIME (UTC) de toda la capa, se convierten a minutos con numpy y se
+pasan a hora de Colombia con el desfase fijo de BOGOTA_UTC_OFFSET (Colombia no tiene horario
+de verano). En una sola pasada del UpdateCursor se borran los registros fuera de la ventana
+(anteriores a la fecha mínima, posteriores a reference_date o ya cubiertos por la marca de
+agua de su instrumento) y se llenan los campos:
+    acq_col	timestamp without time zone
+    acq_day_col	integer
+    acq_month_col	integer
+    acq_year_col	integer
+    acq_hour_col	integer
+
+Returns:
+    Nueva marca de agua por instrumento (la anterior si no está activo incremental_mode)
+'''
+BOGOTA_UTC_OFFSET = np.timedelta64(-5 * 60, 'm')
+
+
+'''
+Fecha de adquisición (UTC) y su equivalente en hora de Colombia, como datetime64[m], a partir
+de ACQ_DATE y ACQ_TIME (HHMM, se completa con ceros a la izquierda; vacío o no numérico = 0000)
+'''
+def get_acquisition_dates(acq_dates, acq_times):
+    acq_day = np.array(acq_dates, dtype='datetime64[m]').astype('datetime64[D]')
+    acq_time = np.array([str(value or '').zfill(4) for value in acq_times], dtype='U4')
+    acq_time = np.where(np.char.isdigit(acq_time), acq_time, '0000').astype(np.int64)
+    sensor_date = acq_day.astype('datetime64[m]') + (acq_time // 100) * 60 + acq_time % 100
+    return sensor_date, sensor_date + BOGOTA_UTC_OFFSET
+
+
+'''
+Registros dentro de la ventana: hora de Colombia posterior a min_date y, si se indica,
+hasta reference_date (inclusive)
+'''
+def get_acquisition_window_mask(col_date, min_date, reference_date=None):
+    keep = col_date > np.datetime64(min_date.replace(tzinfo=None), 'm')
+    if reference_date:
+        keep &= col_date <= np.datetime64(reference_date, 'm')
+    return keep
+
+
+'''
+Día, mes, año y hora (enteros) de las fechas en hora de Colombia
+'''
+def get_date_parts(col_date):
+    col_day = col_date.astype('datetime64[D]')
+    col_month = col_date.astype('datetime64[M]')
+    return ((col_day - col_month.astype('datetime64[D]')).astype(np.int64) + 1,
+            col_month.astype(np.int64) % 12 + 1,
+            col_date.astype('datetime64[Y]').astype(np.int64) + 1970,
+            ((col_date - col_day) // np.timedelta64(60, 'm')).astype(np.int64))
+
+
+def filter_acquisition_window(data, fc, max_hours=24):
+    for field, field_type in (("acq_col", "DATE"), ("acq_day_col", "SHORT"), ("acq_month_col", "SHORT"),
+                              ("acq_year_col", "SHORT"), ("acq_hour_col", "SHORT")):
+        arcpy.AddField_management(fc, field, field_type)
+
+    reference_date = get_reference_date(data)
+    min_date = get_min_acq_date(pytz.timezone('America/Bogota'), max_hours, reference_date)
+    logging.debug("min_date: {}, reference_date: {} ".format(min_date, reference_date))
+
+    # Modo incremental: se descartan las detecciones que ya cubre la marca de agua
+    incremental_mode = data.get('incremental_mode', False)
+    watermark = load_watermark(data) if incremental_mode else {}
+    watermark_cutoffs = get_watermark_cutoffs(data, watermark)
+    logging.debug("incremental_mode: {}, watermark: {} ".format(incremental_mode, watermark))
+
+    with arcpy.da.SearchCursor(fc, ['OID@', 'ACQ_DATE', 'ACQ_TIME', 'INSTRUMENT']) as cursor:
+        rows = list(cursor)
+    oids = np.array([row[0] for row in rows], dtype=np.int64)
+    instruments = np.array([row[3] or '' for row in rows], dtype=object)
+    sensor_date, col_date = get_acquisition_dates([row[1] for row in rows], [row[2] for row in rows])
+    keep = get_acquisition_window_mask(col_date, min_date, reference_date)
+    window_rows = int(np.count_nonzero(keep))
+
+    covered = np.zeros(len(rows), dtype=bool)
+    for instrument, cutoff in watermark_cutoffs.items():
+        covered |= (instruments == instrument) & (sensor_date <= np.datetime64(cutoff, 'm'))
+    watermark_rows = int(np.count_nonzero(keep & covered))
+    keep &= ~covered
+
+    new_watermark = dict(watermark)
+    if incremental_mode:
+        for instrument in np.unique(instruments[keep]):
+            latest = sensor_date[keep & (instruments == instrument)].max().astype(datetime.datetime)
+            acq_str = latest.strftime(WATERMARK_FORMAT)
+            if acq_str > new_watermark.get(instrument, ''):
+                new_watermark[instrument] = acq_str
+
+    days, months, years, hours = (parts[keep] for parts in get_date_parts(col_date))
+    values = {}
+    for oid, date, day, month, year, hour in zip(oids[keep], col_date[keep].astype(datetime.datetime),
+                                                 days, months, years, hours):
+        values[int(oid)] = [date, int(day), int(month), int(year), int(hour)]
+
+    fields = ['OID@', 'acq_col', 'acq_day_col', 'acq_month_col', 'acq_year_col', 'acq_hour_col']
+    with arcpy.da.UpdateCursor(fc, fields) as cursor:
+        for row in cursor:
+            if row[0] in values:
+                cursor.updateRow([row[0]] + values[row[0]])
+            else:
+                cursor.deleteRow()
+
+    logging.info("Ventana de {} horas: {} de {} registros".format(max_hours, window_rows, len(rows)))
+    if incremental_mode:
+        logging.info("Registros descartados por la marca de agua: {}".format(watermark_rows))
+        data['watermark_rows'] = watermark_rows
+    return new_watermark
+
+
+##################################################################
+##################################################################
+'''
+Llave canónica de una detección: los 15 campos de NASA que identifican un registro (mismos
+campos de la validación contra el histórico, ver process_data), normalizados para que el
+mismo registro dé la misma llave venga del shapefile, del CSV o de la base de datos:
+    - coordenadas y valores radiométricos se cuantizan a la precisión que publica FIRMS
+      (CANONICAL_KEY_DECIMALS) y se guardan como enteros (valor * 10^decimales). El entero q
+      corresponde al rango semiabierto [q - 0.5, q + 0.5) / 10^decimales, con los límites
+      escritos en decimal (quantum_bound), así la consulta SQL compara exactamente el mismo
+      rango sin ROUND
+    - NULL, NaN y textos vacíos son None; los campos que no existen en la capa (por ejemplo
+      si falta un sensor) también cuentan como nulos
+    - ACQ_DATE es una fecha (sin hora), ACQ_TIME es texto de 4 dígitos (HHMM)
+La usan todas las validaciones de repetidos: dentro del lote, contra el histórico (SQL, en
+lote, índice SQLite y DETECTION_ID) y el borrado del día anterior. Al cambiar la
+normalización se sube CANONICAL_KEY_VERSION: el índice SQLite se reconstruye y los
+DETECTION_ID se recalculan.
+'''
+DETECTION_KEY_FIELDS = ['LATITUDE', 'LONGITUDE', 'BRIGHTNESS', 'SCAN', 'TRACK', 'ACQ_DATE', 'ACQ_TIME',
+                        'SATELLITE', 'VERSION', 'BRIGHT_T31', 'FRP', 'DAYNIGHT', 'INSTRUMENT',
+                        'BRIGHT_TI4', 'BRIGHT_TI5']
+CANONICAL_KEY_DECIMALS = {'LATITUDE': 5, 'LONGITUDE': 5, 'BRIGHTNESS': 2, 'SCAN': 2, 'TRACK': 2,
+                          'BRIGHT_T31': 2, 'FRP': 2, 'BRIGHT_TI4': 2, 'BRIGHT_TI5': 2}
+CANONICAL_KEY_VERSION = 3
+
+
+def get_key_field_positions(fc, fields=DETECTION_KEY_FIELDS):
+    existing = {field.name.upper(): field.name for field in arcpy.ListFields(fc)}
+    present = [existing[name.upper()] for name in fields if name.upper() in existing]
+    positions = [present.index(existing[name.upper()]) if name.upper() in existing else None for name in fields]
+    return present, positions
+
+
+def canonical_date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, str):
+        return datetime.datetime.strptime(value.strip()[:10], "%Y-%m-%d").date()
+    return value
+
+
+def quantum_bound(quantum, decimals):
+    # Límite inferior del rango del entero quantum: (quantum - 0.5) / 10^decimales en texto decimal exacto
+    digits = str(abs((2 * quantum - 1) * 5)).rjust(decimals + 2, '0')
+    return '{}{}.{}'.format('-' if quantum <= 0 else '', digits[:-decimals - 1], digits[-decimals - 1:])
+
+
+def quantize(value, decimals):
+    value = float(value)
+    quantum = int(math.floor(value * 10 ** decimals + 0.5))
+    # La multiplicación en punto flotante puede caer del otro lado del límite, se corrige
+    # comparando contra los mismos límites que usa la consulta SQL
+    while value < float(quantum_bound(quantum, decimals)):
+        quantum -= 1
+    while value >= float(quantum_bound(quantum + 1, decimals)):
+        quantum += 1
+    return quantum
+
+
+def canonical_value(name, value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    if name in CANONICAL_KEY_DECIMALS:
+        return quantize(value, CANONICAL_KEY_DECIMALS[name])
+    if name == 'ACQ_DATE':
+        return canonical_date(value)
+    if name == 'ACQ_TIME':
+        value = str(int(value)) if isinstance(value, (int, float)) else str(value).strip()
+        return value.zfill(4) if value else None
+    value = str(value).strip()
+    return value or None
+
+
+def canonical_key(row, positions):
+    return tuple(canonical_value(name, row[position] if position is not None else None)
+                 for name, position in zip(DETECTION_KEY_FIELDS, positions))
+
+
+##################################################################
+##################################################################
+'''
+Borra los registros repetidos de NASA (misma llave de detección) en una sola pasada con un
+conjunto de llaves, se conserva el primer registro (menor OBJECTID) como DeleteIdentical.
+Con with_id se agrega y llena el campo DETECTION_ID y los repetidos se detectan por él.
+
+Returns:
+    Counter instrumento -> registros repetidos borrados
+'''
+def deduplicate_detections(fc, with_id=False):
+    present, positions = get_key_field_positions(fc)
+    instrument_position = positions[DETECTION_KEY_FIELDS.index('INSTRUMENT')]
+    missing = [name for name, position in zip(DETECTION_KEY_FIELDS, positions) if position is None]
+    if missing:
+        logging.debug("Campos de la llave que no existen en {}, se toman como nulos: {}".format(fc, missing))
+    fields = list(present)
+    if with_id:
+        add_detection_id_fields(fc)
+        fields += [DETECTION_ID_VERSION_FIELD, DETECTION_ID_FIELD]
+    seen = set()
+    duplicates = Counter()
+    with arcpy.da.UpdateCursor(fc, fields) as cursor:
+        for row in cursor:
+            key = canonical_key(row, positions)
+            if with_id:
+                key = detection_id(key)
+            if key in seen:
+                cursor.deleteRow()
+                duplicates[row[instrument_position] if instrument_position is not None else None] += 1
+            else:
+                seen.add(key)
+                if with_id:
+                    row[-2:] = [CANONICAL_KEY_VERSION, key]
+                    cursor.updateRow(row)
+    return duplicates
+
+
+##################################################################
+##################################################################
+'''
+Validación contra el histórico en lote (historical_check_mode = batch)
+
+En lugar de un SELECT COUNT(*) por registro, se leen con un solo SearchCursor las llaves del
+histórico en el rango de ACQ_DATE de los registros nuevos y se borran los registros cuya
+llave canónica ya está en ese conjunto.
+
+Returns:
+    Número de registros borrados
+'''
+def get_acq_date_range(fc):
+    with arcpy.da.SearchCursor(fc, ['ACQ_DATE']) as cursor:
+        dates = [row[0] for row in cursor if row[0] is not None]
+    if not dates:
+        return None, None
+    return min(dates), max(dates)
+
+
+def load_historical_keys(historical_fc, min_date, max_date):
+    historical_fields, historical_positions = get_key_field_positions(historical_fc)
+    acq_date_field = historical_fields[historical_positions[DETECTION_KEY_FIELDS.index('ACQ_DATE')]]
+    where = "{0} >= date '{1}' AND {0} < date '{2}'".format(
+        acq_date_field, min_date.strftime("%Y-%m-%d"), (max_date + datetime.timedelta(days=1)).strftime("%Y-%m-%d"))
+    with arcpy.da.SearchCursor(historical_fc, historical_fields, where) as cursor:
+        return {canonical_key(row, historical_positions) for row in cursor}
+
+
+'''
+Borra de fc los registros cuya llave (convertida con to_key) está en existing
+'''
+def delete_rows_in_keys(fc, existing, to_key=lambda key: key):
+    fields, positions = get_key_field_positions(fc)
+    deleted_rows = 0
+    with arcpy.da.UpdateCursor(fc, fields) as cursor:
+        for row in cursor:
+            if to_key(canonical_key(row, positions)) in existing:
+                cursor.deleteRow()
+                deleted_rows += 1
+    return deleted_rows
+
+
+def delete_existing_detections(fc, historical_fc):
+    min_date, max_date = get_acq_date_range(fc)
+    if min_date is None:
+        return 0
+    start_time = time.time()
+    existing = load_historical_keys(historical_fc, min_date, max_date)
+    logging.debug("Llaves del histórico entre {} y {}: {} en {} segundos".format(
+        min_date, max_date, len(existing), round(time.time() - start_time, 2)))
+    return delete_rows_in_keys(fc, existing)
+
+
+'''
+Consulta SQL de la validación por registro (historical_check_mode = sql), row tiene OBJECTID
+y los 15 campos de la llave en el orden de DETECTION_KEY_FIELDS
+'''
+HISTORICAL_TABLE_NAME = 'e2_modfun.CFgoHis_Car_Mun_Dep_Elt_Pai'
+
+
+def build_historical_count_sql(table_name, row):
+    # Los valores cuantizados se comparan con el rango de su entero (quantum_bound) para que
+    # diferencias de representación de los double no hagan ver como nuevo un registro
+    # existente; el rango permite usar los índices de esas columnas
+    conditions = []
+    for name, value in zip(DETECTION_KEY_FIELDS, canonical_key(row[1:], range(len(DETECTION_KEY_FIELDS)))):
+        if value is None:
+            conditions.append("{} is NULL".format(name))
+        elif name in CANONICAL_KEY_DECIMALS:
+            decimals = CANONICAL_KEY_DECIMALS[name]
+            conditions.append("{0} >= {1} and {0} < {2}".format(
+                name, quantum_bound(value, decimals), quantum_bound(value + 1, decimals)))
+        elif name == 'ACQ_DATE':
+            conditions.append("ACQ_DATE = TO_DATE ( '{}', 'YYYY/MM/DD' )".format(value.strftime("%Y/%m/%d")))
+        else:
+            conditions.append("{} = '{}'".format(name, value.replace("'", "''")))
+
+    return '''   
+        SELECT COUNT(*) AS f_count FROM {} where {}   
+        '''.format(table_name, ' and '.join(conditions))
+
+
+##################################################################
+##################################################################
+'''
+Identificador de la detección (detection_id)
+
+DETECTION_ID es el sha1 de la versión y el texto de la llave canónica (key_to_text):
+el mismo registro de NASA tiene siempre el mismo identificador. Se guarda en las capas de
+salida con un índice único, así la validación contra el histórico es una búsqueda por una
+sola columna indexada y el append solo inserta los identificadores que no existen.
+
+Cada registro guarda en DETECTION_ID_VERSION la versión de la llave canónica con la que se
+calculó su identificador, así la versión viaja con los datos (no depende de archivos locales)
+y los registros de otra versión se pueden encontrar con una consulta.
+'''
+DETECTION_ID_FIELD = 'DETECTION_ID'
+DETECTION_ID_LENGTH = 40
+DETECTION_ID_INDEX = 'IDX_DETECTION_ID'
+DETECTION_ID_VERSION_FIELD = 'DETECTION_ID_VERSION'
+
+
+def detection_id(key):
+    return hashlib.sha1('{}:{}'.format(CANONICAL_KEY_VERSION, key_to_text(key)).encode('utf-8')).hexdigest()
+
+
+def add_detection_id_fields(fc):
+    if not field_exists(fc, DETECTION_ID_FIELD):
+        logging.info("Agregando {} a {}".format(DETECTION_ID_FIELD, fc))
+        arcpy.AddField_management(fc, DETECTION_ID_FIELD, "TEXT", field_length=DETECTION_ID_LENGTH)
+    if not field_exists(fc, DETECTION_ID_VERSION_FIELD):
+        arcpy.AddField_management(fc, DETECTION_ID_VERSION_FIELD, "SHORT")
+
+
+def stale_detection_ids_where(only_filled=False):
+    where = "{0} IS NULL OR {0} <> {1}".format(DETECTION_ID_VERSION_FIELD, CANONICAL_KEY_VERSION)
+    if only_filled:
+        return "{} IS NOT NULL AND ({})".format(DETECTION_ID_FIELD, where)
+    return "{} IS NULL OR {}".format(DETECTION_ID_FIELD, where)
+
+
+def has_rows(fc, where):
+    with arcpy.da.SearchCursor(fc, ['OID@'], where) as cursor:
+        for _ in cursor:
+            return True
+    return False
+
+
+def backfill_detection_ids(fc):
+    fields, positions = get_key_field_positions(fc)
+    filled = 0
+    with arcpy.da.UpdateCursor(fc, fields + [DETECTION_ID_VERSION_FIELD, DETECTION_ID_FIELD],
+                               stale_detection_ids_where()) as cursor:
+        for row in cursor:
+            row[-2:] = [CANONICAL_KEY_VERSION, detection_id(canonical_key(row, positions))]
+            cursor.updateRow(row)
+            filled += 1
+    logging.info("DETECTION_ID calculado para {} registros de {}".format(filled, fc))
+    return filled
+
+
+'''
+Busca en fc los DETECTION_ID repetidos. Devuelve {DETECTION_ID: [OBJECTID, ...]} solo con
+los identificadores que aparecen más de una vez, con los OBJECTID en orden ascendente.
+'''
+def find_duplicate_detection_ids(fc):
+    oids_by_id = {}
+    with arcpy.da.SearchCursor(fc, ['OID@', DETECTION_ID_FIELD], "{} IS NOT NULL".format(DETECTION_ID_FIELD)) as cursor:
+        for oid, value in cursor:
+            oids_by_id.setdefault(value, []).append(oid)
+    return {value: sorted(oids) for value, oids in oids_by_id.items() if len(oids) > 1}
+
+
+'''
+Borra de fc los registros repetidos por DETECTION_ID, deja el de menor OBJECTID de cada uno.
+Solo se usa desde la migración con detection_id_delete_duplicates = true.
+'''
+def delete_duplicate_detection_ids(fc, duplicates):
+    to_delete = {oid for oids in duplicates.values() for oid in oids[1:]}
+    deleted_rows = 0
+    with arcpy.da.UpdateCursor(fc, ['OID@']) as cursor:
+        for row in cursor:
+            if row[0] in to_delete:
+                cursor.deleteRow()
+                deleted_rows += 1
+    return deleted_rows
+
+
+'''
+Migración de DETECTION_ID (detection_id_migrate = true), se ejecuta de forma explícita sobre
+las capas de salida:
+1. Agrega DETECTION_ID y DETECTION_ID_VERSION si no existen.
+2. Calcula el identificador de los registros que no lo tienen o que lo tienen con otra versión
+   de la llave; si hay identificadores de otra versión se borra antes el índice único, porque
+   con la llave nueva dos registros pueden quedar con el mismo identificador.
+3. Si falta el índice único, reporta en el log los DETECTION_ID repetidos con sus OBJECTID y
+   se detiene. Los repetidos solo se borran (se deja el de menor OBJECTID) con
+   detection_id_delete_duplicates = true.
+4. Crea el índice único; si no se puede crear, el error se propaga.
+'''
+def migrate_detection_ids(data):
+    for key in ('feature_output_prod', 'feature_output_pub', 'feature_output_pub_sirgas'):
+        fc = data[key]
+        logging.info("Migración de {} en {}".format(DETECTION_ID_FIELD, fc))
+        add_detection_id_fields(fc)
+        indexes = [index.name.lower() for index in arcpy.ListIndexes(fc)]
+        if DETECTION_ID_INDEX.lower() in indexes and has_rows(fc, stale_detection_ids_where(only_filled=True)):
+            logging.info("{} tiene DETECTION_ID de otra versión de la llave, se recalcula".format(fc))
+            arcpy.RemoveIndex_management(fc, [DETECTION_ID_INDEX])
+        backfill_detection_ids(fc)
+        if DETECTION_ID_INDEX.lower() in [index.name.lower() for index in arcpy.ListIndexes(fc)]:
+            continue
+        duplicates = find_duplicate_detection_ids(fc)
+        if duplicates:
+            for value, oids in sorted(duplicates.items()):
+                logging.warning("{} {} repetido en {}, OBJECTID: {}".format(DETECTION_ID_FIELD, value, fc, oids))
+            if not data.get('detection_id_delete_duplicates', False):
+                raise Exception("{} tiene {} {} repetidos (ver log), no se crea el índice único. "
+                                "Revisar los registros o ejecutar la migración con "
+                                "detection_id_delete_duplicates = true".format(fc, len(duplicates), DETECTION_ID_FIELD))
+            deleted_rows = delete_duplicate_detection_ids(fc, duplicates)
+            logging.warning("Registros repetidos por {} borrados de {}: {}".format(DETECTION_ID_FIELD, fc, deleted_rows))
+        arcpy.AddIndex_management(fc, [DETECTION_ID_FIELD], DETECTION_ID_INDEX, "UNIQUE", "NON_ASCENDING")
+
+
+'''
+Verifica que las capas de salida tengan DETECTION_ID, DETECTION_ID_VERSION y el índice único.
+No modifica las capas: si falta algo se detiene y hay que ejecutar la migración
+(detection_id_migrate = true).
+'''
+def ensure_detection_id_fields(data):
+    for key in ('feature_output_prod', 'feature_output_pub', 'feature_output_pub_sirgas'):
+        fc = data[key]
+        missing = [field for field in (DETECTION_ID_FIELD, DETECTION_ID_VERSION_FIELD) if not field_exists(fc, field)]
+        if DETECTION_ID_INDEX.lower() not in [index.name.lower() for index in arcpy.ListIndexes(fc)]:
+            missing.append(DETECTION_ID_INDEX)
+        if missing:
+            raise Exception("{} no tiene {} (ejecutar con detection_id_migrate = true)".format(fc, ', '.join(missing)))
+
+
+'''
+Indica si todos los registros de fc tienen DETECTION_ID de la versión actual de la llave.
+Mientras el histórico tenga registros sin identificador o con otra versión
+(la migración no se ha ejecutado) la validación por DETECTION_ID no los
+encontraría y se insertarían de nuevo.
+'''
+def detection_ids_ready(fc):
+    return not has_rows(fc, stale_detection_ids_where())
+
+
+'''
+Validación contra el histórico por DETECTION_ID (historical_check_mode = id): se consultan
+en el histórico solo los identificadores del lote, de a 1000 por consulta, usando el índice.
+'''
+def delete_existing_by_id(fc, historical_fc):
+    with arcpy.da.SearchCursor(fc, [DETECTION_ID_FIELD]) as cursor:
+        candidates = sorted({row[0] for row in cursor if row[0]})
+    existing = set()
+    for start in range(0, len(candidates), 1000):
+        where = "{} IN ({})".format(DETECTION_ID_FIELD,
+                                    ','.join("'{}'".format(value) for value in candidates[start:start + 1000]))
+        with arcpy.da.SearchCursor(historical_fc, [DETECTION_ID_FIELD], where) as cursor:
+            existing.update(row[0] for row in cursor)
+    deleted_rows = 0
+    with arcpy.da.UpdateCursor(fc, [DETECTION_ID_FIELD]) as cursor:
+        for row in cursor:
+            if row[0] in existing:
+                cursor.deleteRow()
+                deleted_rows += 1
+    return deleted_rows
+
+
+##################################################################
+##################################################################
+'''
+Índice local de llaves del histórico (historical_check_mode = index)
+
+Base SQLite (historical_index_path) con las llaves de layer_output_prod particionadas por
+ACQ_DATE. La validación consulta solo las llaves de las fechas de los registros nuevos, el
+índice se actualiza después de cada append y al borrar el día anterior (deleteRows), y cada
+historical_index_reconcile_days días se reconstruye desde layer_output_prod y se reporta la
+diferencia encontrada.
+'''
+def get_historical_index_path(data):
+    return data.get('historical_index_path') or os.path.join(get_index_cache_dir(data), 'historico_llaves.sqlite')
+
+
+def open_historical_index(data):
+    conn = sqlite3.connect(get_historical_index_path(data))
+    conn.execute("CREATE TABLE IF NOT EXISTS llaves (acq_date TEXT NOT NULL, llave TEXT NOT NULL, "
+                 "PRIMARY KEY (acq_date, llave)) WITHOUT ROWID")
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (nombre TEXT PRIMARY KEY, valor TEXT)")
+    return conn
+
+
+def key_to_text(key):
+    return json.dumps([value.isoformat() if isinstance(value, datetime.date) else value for value in key])
+
+
+def iter_index_entries(fc):
+    fields, positions = get_key_field_positions(fc)
+    acq_date_position = DETECTION_KEY_FIELDS.index('ACQ_DATE')
+    with arcpy.da.SearchCursor(fc, fields) as cursor:
+        for row in cursor:
+            key = canonical_key(row, positions)
+            acq_date = key[acq_date_position]
+            yield (acq_date.isoformat() if acq_date else '', key_to_text(key))
+
+
+def reconcile_historical_index(conn, historical_fc):
+    start_time = time.time()
+    conn.execute("DROP TABLE IF EXISTS llaves_nuevas")
+    conn.execute("CREATE TABLE llaves_nuevas (acq_date TEXT NOT NULL, llave TEXT NOT NULL, "
+                 "PRIMARY KEY (acq_date, llave)) WITHOUT ROWID")
+    conn.executemany("INSERT OR IGNORE INTO llaves_nuevas VALUES (?, ?)", iter_index_entries(historical_fc))
+    stale = conn.execute("SELECT COUNT(*) FROM (SELECT * FROM llaves EXCEPT SELECT * FROM llaves_nuevas)").fetchone()[0]
+    missing = conn.execute("SELECT COUNT(*) FROM (SELECT * FROM llaves_nuevas EXCEPT SELECT * FROM llaves)").fetchone()[0]
+    conn.execute("DROP TABLE llaves")
+    conn.execute("ALTER TABLE llaves_nuevas RENAME TO llaves")
+    conn.execute("INSERT OR REPLACE INTO meta VALUES ('ultima_reconciliacion', ?)",
+                 (datetime.datetime.now().strftime(WATERMARK_FORMAT), ))
+    conn.execute("INSERT OR REPLACE INTO meta VALUES ('version_llave', ?)", (str(CANONICAL_KEY_VERSION), ))
+    conn.commit()
+    total = conn.execute("SELECT COUNT(*) FROM llaves").fetchone()[0]
+    logging.info("Índice del histórico reconciliado en {} segundos: {} llaves, {} sobrantes, {} faltantes".format(
+        round(time.time() - start_time, 2), total, stale, missing))
+    return stale, missing
+
+
+def ensure_historical_index(data, conn, historical_fc):
+    row = conn.execute("SELECT valor FROM meta WHERE nombre = 'ultima_reconciliacion'").fetchone()
+    version = conn.execute("SELECT valor FROM meta WHERE nombre = 'version_llave'").fetchone()
+    max_age = datetime.timedelta(days=float(data.get('historical_index_reconcile_days', 7)))
+    if version is None or version[0] != str(CANONICAL_KEY_VERSION):
+        logging.info("Índice del histórico con otra versión de la llave ({}), se reconstruye".format(version))
+        row = None
+    if row is None or datetime.datetime.now() - datetime.datetime.strptime(row[0], WATERMARK_FORMAT) > max_age:
+        stale, missing = reconcile_historical_index(conn, historical_fc)
+        data['historical_index_drift'] = {'sobrantes': stale, 'faltantes': missing}
+
+
+def load_index_keys(conn, min_date, max_date):
+    rows = conn.execute("SELECT llave FROM llaves WHERE acq_date BETWEEN ? AND ?",
+                        (min_date.strftime("%Y-%m-%d"), max_date.strftime("%Y-%m-%d")))
+    return {row[0] for row in rows}
+
+
+def delete_indexed_detections(data, fc, historical_fc):
+    min_date, max_date = get_acq_date_range(fc)
+    conn = open_historical_index(data)
+    try:
+        ensure_historical_index(data, conn, historical_fc)
+        if min_date is None:
+            return 0
+        start_time = time.time()
+        existing = load_index_keys(conn, min_date, max_date)
+        logging.debug("Llaves del índice entre {} y {}: {} en {} segundos".format(
+            min_date, max_date, len(existing), round(time.time() - start_time, 3)))
+    finally:
+        conn.close()
+    return delete_rows_in_keys(fc, existing, key_to_text)
+
+
+def add_to_historical_index(data, fc):
+    conn = open_historical_index(data)
+    try:
+        conn.executemany("INSERT OR IGNORE INTO llaves VALUES (?, ?)", iter_index_entries(fc))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def delete_historical_index_date(data, date):
+    conn = open_historical_index(data)
+    try:
+        deleted = conn.execute("DELETE FROM llaves WHERE acq_date = ?",
+                               (canonical_date(date).isoformat(), )).rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    logging.debug("Índice del histórico: {} llaves borradas del {}".format(deleted, date.strftime("%Y-%m-%d")))
+
+
+##################################################################
+##################################################################
+'''
+Clasificar el CONFIDENCE numérico de MODIS en low / nominal / high de acuerdo a la
+documentación MODIS (mismos rangos que el codeblock de process_data)
+'''
+def modis_confidence_class(confidence_modis):
+    if confidence_modis is None:
+        return None
+    if confidence_modis < 30:
+        return 'low'
+    elif confidence_modis < 80:
+        return 'nominal'
+    elif confidence_modis <= 100:
+        return 'high'
+    return None
+
+
+##################################################################
+##################################################################
+'''
+Leer el CSV de un sensor con el esquema normalizado de detecciones
+
+Las filas se leen de una en una y se descartan antes de construir su geometría
+cuando no tienen coordenadas, cuando son anteriores a min_date o cuando quedan
+fuera de bbox (xmin, ymin, xmax, ymax).
+'''
+# Campos de FIRMS (MODIS usa BRIGHTNESS / BRIGHT_T31 y VIIRS BRIGHT_TI4 / BRIGHT_TI5)
+FIRMS_FIELDS = [('LATITUDE', 'DOUBLE'), ('LONGITUDE', 'DOUBLE'), ('BRIGHTNESS', 'DOUBLE'),
+                ('BRIGHT_TI4', 'DOUBLE'), ('SCAN', 'DOUBLE'), ('TRACK', 'DOUBLE'), ('ACQ_DATE', 'DATE'),
+                ('ACQ_TIME', 'TEXT'), ('SATELLITE', 'TEXT'), ('CONFIDENCE', 'TEXT'), ('VERSION', 'TEXT'),
+                ('BRIGHT_T31', 'DOUBLE'), ('BRIGHT_TI5', 'DOUBLE'), ('FRP', 'DOUBLE'), ('DAYNIGHT', 'TEXT')]
+# Esquema normalizado: campos de FIRMS más los que agrega el proceso
+DETECTION_FIELDS = FIRMS_FIELDS + [('INSTRUMENT', 'TEXT'), ('confidence_modis', 'DOUBLE')]
+# Campos cuyo tipo define el proceso sin importar el de los archivos de origen
+DETECTION_FIELD_OVERRIDES = {'SATELLITE': ('TEXT', 256), 'CONFIDENCE': ('TEXT', ""),
+                             'INSTRUMENT': ('TEXT', ""), 'CONFIDENCE_MODIS': ('DOUBLE', "")}
+
+
+def read_csv_header(csv_path):
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        return [column.strip() for column in next(csv.reader(f), []) if column.strip()]
+
+
+def iter_firms_csv(csv_path, sensor, min_date=None, bbox=None, stats=None):
+    tz = min_date.tzinfo if min_date is not None else None
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        header = [column.strip().lower() for column in next(reader, [])]
+        index = {column: i for i, column in enumerate(header)}
+        fields = [(name, field_type) for name, field_type in FIRMS_FIELDS if name.lower() in index]
+        # Las columnas que no son de FIRMS_FIELDS se conservan como texto
+        firms_names = [name.lower() for name, field_type in FIRMS_FIELDS]
+        fields += [(column.upper(), 'TEXT') for column in header if column and column not in firms_names]
+        for values in reader:
+            if not values:
+                continue
+            if stats is not None:
+                stats['read'] += 1
+            row = {}
+            for name, field_type in fields:
+                value = values[index[name.lower()]].strip()
+                if value == '':
+                    row[name] = None
+                elif field_type == 'DOUBLE':
+                    row[name] = float(value)
+                elif field_type == 'DATE':
+                    row[name] = datetime.datetime.strptime(value, '%Y-%m-%d')
+                else:
+                    row[name] = value
+            x, y = row.get('LONGITUDE'), row.get('LATITUDE')
+            if x is None or y is None or row.get('ACQ_DATE') is None or row.get('ACQ_TIME') is None:
+                continue
+            if bbox is not None and not (bbox[0] <= x <= bbox[2] and bbox[1] <= y <= bbox[3]):
+                continue
+            row['ACQ_TIME'] = row['ACQ_TIME'].zfill(4)
+            if min_date is not None:
+                acq_date = row['ACQ_DATE']
+                sensor_date = datetime.datetime(acq_date.year, acq_date.month, acq_date.day,
+                                                int(row['ACQ_TIME'][0:2]), int(row['ACQ_TIME'][2:4]), 0, 0)
+                if min_date >= pytz.utc.localize(sensor_date).astimezone(tz):
+                    continue
+            normalize_detection(sensor, row)
+            if stats is not None:
+                stats['kept'] += 1
+            yield (x, y), row
+
+
+'''
+Completar los campos que agrega el proceso a una detección: INSTRUMENT constante del
+sensor y, para MODIS, el CONFIDENCE numérico pasa a confidence_modis y CONFIDENCE
+queda con su clase (low / nominal / high). En VIIRS confidence_modis queda nulo.
+'''
+def normalize_detection(sensor, row):
+    row['INSTRUMENT'] = sensor['instrument']
+    if sensor['confidence'] == 'modis':
+        confidence = row.get('CONFIDENCE')
+        row['confidence_modis'] = float(confidence) if confidence is not None else None
+        row['CONFIDENCE'] = modis_confidence_class(row['confidence_modis'])
+    else:
+        row['confidence_modis'] = None
+        if row.get('CONFIDENCE') is not None:
+            row['CONFIDENCE'] = str(row['CONFIDENCE'])
+    return row
+
+
+##################################################################
+##################################################################
+'''
+Esquema de la capa normalizada, igual al que dejaba Merge_management: la unión de los campos
+de los archivos de origen en el orden en que aparecen, con el tipo del primer archivo que
+tiene el campo (los campos de un CSV toman el tipo de FIRMS_FIELDS o texto). Se completan
+los campos de DETECTION_FIELDS que no traiga ningún sensor y se aplican
+DETECTION_FIELD_OVERRIDES. Los campos de tipos que no se pueden crear con AddField se
+reportan en el log.
+
+Returns:
+    Lista de (nombre, tipo, largo)
+'''
+def get_detection_fields(sensors, data):
+    firms_types = dict(FIRMS_FIELDS)
+    detection_names = {name.upper(): name for name, field_type in DETECTION_FIELDS}
+    fields = collections.OrderedDict()
+    dropped = []
+    for sensor in sensors:
+        path = data[sensor['data_key']]
+        if path.lower().endswith('.csv'):
+            if not os.path.isfile(path):
+                continue
+            source = [(column.upper(), firms_types.get(column.upper(), 'TEXT'), "")
+                      for column in read_csv_header(path)]
+        elif arcpy.Exists(path):
+            source = []
+            for field in arcpy.ListFields(path):
+                if field.type in ('OID', 'Geometry'):
+                    continue
+                if field.type not in ADD_FIELD_TYPES:
+                    dropped.append("{}.{} ({})".format(sensor['name'], field.name, field.type))
+                    continue
+                source.append((field.name, ADD_FIELD_TYPES[field.type],
+                               field.length if field.type == 'String' else ""))
+        else:
+            continue
+        for name, field_type, field_length in source:
+            if name.upper() not in fields:
+                fields[name.upper()] = (detection_names.get(name.upper(), name), field_type, field_length)
+    for name, field_type in DETECTION_FIELDS:
+        if name.upper() not in fields:
+            fields[name.upper()] = (name, field_type, "")
+    for name, (field_type, field_length) in DETECTION_FIELD_OVERRIDES.items():
+        fields[name] = (fields[name][0], field_type, field_length)
+    if dropped:
+        logging.warning("Campos de los sensores que no se copian a la capa normalizada: {}".format(dropped))
+    return list(fields.values())
+
+
+'''
+Normalización de los sensores en una sola pasada
+
+Se crea una sola vez la capa con el esquema unificado (get_detection_fields) y cada
+sensor se lee (su shapefile con iter_shapefile_detections o su CSV con iter_firms_csv)
+hacia un único InsertCursor. INSTRUMENT, la clase de CONFIDENCE de MODIS y
+confidence_modis se calculan en la misma pasada, por lo que ya no se necesitan
+Select / AlterField / AddField / CalculateField / DeleteField por sensor ni el Merge.
+
+Antes (AVera - 20231211, ADiaz - 20240301) cada shp se copiaba a Output.gdb, se ampliaba
+SATELLITE a 256 y se agregaban INSTRUMENT / CONFIDENCE / confidence_modis con
+geoprocesos separados, y luego se unían con Merge_management.
+'''
+def normalize_sensors(data, out_name, min_date_csv=None, bbox=None):
+    sensors = [sensor for sensor in get_sensor_registry(data) if data.get(sensor['data_key'])]
+    shp_paths = [data[sensor['data_key']] for sensor in sensors
+                 if not data[sensor['data_key']].lower().endswith('.csv')]
+    spatial_reference = arcpy.SpatialReference(4326)
+    for shp_path in shp_paths:
+        if arcpy.Exists(shp_path):
+            spatial_reference = arcpy.Describe(shp_path).spatialReference
+            break
+
+    arcpy.CreateFeatureclass_management(env.workspace, out_name, "POINT", spatial_reference=spatial_reference)
+    detection_fields = get_detection_fields(sensors, data)
+    for name, field_type, field_length in detection_fields:
+        arcpy.AddField_management(out_name, name, field_type, "", "", field_length)
+    names = [name for name, field_type, field_length in detection_fields]
+    text_fields = [name for name, field_type, field_length in detection_fields if field_type == 'TEXT']
+
+    counts = collections.OrderedDict()
+    total_read = 0
+    with arcpy.da.InsertCursor(out_name, ['SHAPE@XY'] + names) as insert_cursor:
+        for sensor in sensors:
+            path = data[sensor['data_key']]
+            stats = {'read': 0, 'kept': 0}
+            if path.lower().endswith('.csv'):
+                detections = iter_firms_csv(path, sensor, min_date_csv, bbox, stats)
+            elif arcpy.Exists(path):
+                detections = iter_shapefile_detections(sensor, path, names, bbox, stats)
+            else:
+                logging.warning("{}: no existe {}".format(sensor['name'], path))
+                continue
+            for xy, row in detections:
+                # Un campo puede ser numérico en un sensor y texto en otro
+                for name in text_fields:
+                    if row.get(name) is not None and not isinstance(row[name], str):
+                        row[name] = str(row[name])
+                insert_cursor.insertRow([xy] + [row.get(name) for name in names])
+            counts[sensor['instrument']] = stats['kept']
+            total_read += stats['read']
+            logging.info("{}: {} registros leídos, {} después del prefiltro".format(sensor['name'], stats['read'],
+                                                                                   stats['kept']))
+    data['normalized_counts'] = counts
+    data['prefilter_counts'] = {'before': total_read, 'after': sum(counts.values())}
+    logging.info("Prefiltro por extensión de la Amazonía: {} registros antes, {} después".format(
+        total_read, sum(counts.values())))
+    return out_name
+
+
+##################################################################
+##################################################################
+'''
+Extensión (xmin, ymin, xmax, ymax) en grados del límite de la Amazonía (feature_dlim),
+ampliada en bbox_prefilter_buffer_degrees. Los puntos fuera de ella se descartan al
+leer los datos de los sensores, antes de la proyección y el Clip. None si
+bbox_prefilter está desactivado.
+'''
+def get_prefilter_bbox(data):
+    if not data.get('bbox_prefilter', True):
+        return None
+    describe = arcpy.Describe(data['feature_dlim'])
+    extent = describe.extent
+    if describe.spatialReference.type != 'Geographic':
+        extent = extent.projectAs(arcpy.SpatialReference(4326))
+    buffer_degrees = float(data.get('bbox_prefilter_buffer_degrees', 0.1))
+    bbox = (extent.XMin - buffer_degrees, extent.YMin - buffer_degrees,
+            extent.XMax + buffer_degrees, extent.YMax + buffer_degrees)
+    data['prefilter_bbox'] = list(bbox)
+    logging.debug("prefilter_bbox: {} ".format(bbox))
+    return bbox
+
+
+##################################################################
+##################################################################
+'''
+Leer las detecciones de un shapefile con el esquema normalizado
+
+Las columnas se cargan con load_shapefile_columns y los puntos fuera de bbox se
+descartan con una máscara de numpy antes de convertirlos a filas. Si el shapefile
+no se puede leer así se usa un SearchCursor de arcpy con el mismo filtro.
+'''
+def column_values(values):
+    if values.dtype.kind == 'f':
+        return [None if value != value else value for value in values.tolist()]
+    if values.dtype.kind == 'M':
+        return [None if value is None else datetime.datetime(value.year, value.month, value.day)
+                for value in values.tolist()]
+    return values.tolist()
+
+
+def iter_shapefile_detections(sensor, shp_path, names, bbox=None, stats=None):
+    try:
+        columns = load_shapefile_columns(shp_path)
+    except Exception as e:
+        logging.warning("{}: no se pudo leer {} con numpy, se usa SearchCursor. {}".format(sensor['name'], shp_path, e))
+        for detection in iter_cursor_detections(sensor, shp_path, names, bbox, stats):
+            yield detection
+        return
+
+    x = columns['SHAPE@X']
+    y = columns['SHAPE@Y']
+    mask = ~(np.isnan(x) | np.isnan(y))
+    if bbox is not None:
+        mask &= (x >= bbox[0]) & (x <= bbox[2]) & (y >= bbox[1]) & (y <= bbox[3])
+    if stats is not None:
+        stats['read'] += len(x)
+        stats['kept'] += int(mask.sum())
+    source_fields = {name.upper(): name for name in columns}
+    values = {name: column_values(columns[source_fields[name.upper()]][mask])
+              for name in names if name.upper() in source_fields}
+    for i, xy in enumerate(zip(x[mask].tolist(), y[mask].tolist())):
+        row = {name: column[i] for name, column in values.items()}
+        yield xy, normalize_detection(sensor, row)
+
+
+def iter_cursor_detections(sensor, shp_path, names, bbox=None, stats=None):
+    source_fields = {field.name.upper(): field.name for field in arcpy.ListFields(shp_path)}
+    read_fields = [name for name in names if name.upper() in source_fields]
+    with arcpy.da.SearchCursor(shp_path, ['SHAPE@XY'] + [source_fields[name.upper()]
+                                                         for name in read_fields]) as search_cursor:
+        for values in search_cursor:
+            if stats is not None:
+                stats['read'] += 1
+            x, y = values[0]
+            if x is None or y is None:
+                continue
+            if bbox is not None and not (bbox[0] <= x <= bbox[2] and bbox[1] <= y <= bbox[3]):
+                continue
+            if stats is not None:
+                stats['kept'] += 1
+            yield values[0], normalize_detection(sensor, dict(zip(read_fields, values[1:])))
+
+
+##################################################################
+##################################################################
+'''
+Cache de índices de capas de referencia (index_cache_dir)
+
+Las capas de referencia (límite de la Amazonía, pozos, ...) casi nunca cambian, por lo
+que sus estructuras preparadas se guardan en disco junto con la huella de la capa
+(get_layer_fingerprint) y se reconstruyen solo cuando la huella cambia.
+'''
+def get_index_cache_dir(data):
+    cache_dir = data.get('index_cache_dir') or os.path.join(data['temp_dir'], 'cache_indices')
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def get_layer_fingerprint(layer):
+    describe = arcpy.Describe(layer)
+    extent = describe.extent
+    fingerprint = {'count': int(arcpy.GetCount_management(layer)[0]),
+                   'extent': [round(value, 8) for value in (extent.XMin, extent.YMin, extent.XMax, extent.YMax)]}
+    # Suma de áreas / longitudes desde sus campos, sin leer las geometrías
+    fields = [name for name in (getattr(describe, 'areaFieldName', ''), getattr(describe, 'lengthFieldName', ''))
+              if name]
+    if fields:
+        totals = [0.0] * len(fields)
+        with arcpy.da.SearchCursor(layer, fields) as cursor:
+            for row in cursor:
+                totals = [total + (value or 0) for total, value in zip(totals, row)]
+        fingerprint['area_length'] = [round(total, 6) for total in totals]
+    return fingerprint
+
+
+def read_cached_fingerprint(cache_dir, name):
+    try:
+        with open(os.path.join(cache_dir, name + '.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_cached_fingerprint(cache_dir, name, fingerprint):
+    with open(os.path.join(cache_dir, name + '.json'), 'w') as f:
+        json.dump(fingerprint, f, indent=2)
+
+
+def load_cached_index(cache_dir, name, fingerprint):
+    index_path = os.path.join(cache_dir, name + '.npz')
+    if read_cached_fingerprint(cache_dir, name) != fingerprint:
+        return None
+    try:
+        with np.load(index_path) as index:
+            return {key: index[key] for key in index.files}
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_cached_index(cache_dir, name, fingerprint, index):
+    index_path = os.path.join(cache_dir, name + '.npz')
+    with open(index_path + '.part', 'wb') as f:
+        np.savez(f, **index)
+    os.replace(index_path + '.part', index_path)
+    write_cached_fingerprint(cache_dir, name, fingerprint)
+
+
+##################################################################
+##################################################################
+'''
+Índice de polígonos en grilla
+
+La extensión del polígono se divide en una grilla de dlim_index_cells celdas (en el eje
+más largo). Cada celda queda marcada como:
+    POLYGON_CELL_OUTSIDE / POLYGON_CELL_INSIDE: la celda no toca ningún borde, todos sus
+        puntos están fuera / dentro
+    POLYGON_CELL_BOUNDARY: algún segmento del borde toca la celda
+Además los segmentos del borde se agrupan por fila de la grilla (bandas), así la prueba
+exacta de un punto (rayo horizontal, regla par-impar por entidad) solo revisa los
+segmentos de su banda. La mayoría de los puntos se resuelven con una lectura de la grilla.
+'''
+POLYGON_CELL_OUTSIDE = 0
+POLYGON_CELL_INSIDE = 1
+POLYGON_CELL_BOUNDARY = 2
+
+
+'''
+Anillos de los polígonos de layer como lista de (índice de entidad, [(x, y), ...]), junto
+con la lista de OBJECTID de las entidades (posición = índice de entidad)
+'''
+def read_polygon_rings(layer, spatial_reference=None):
+    rings = []
+    oids = []
+    with arcpy.da.SearchCursor(layer, ['OID@', 'SHAPE@'], spatial_reference=spatial_reference) as cursor:
+        for feature_id, (oid, geometry) in enumerate(cursor):
+            oids.append(oid)
+            if geometry is None:
+                continue
+            for part in geometry:
+                ring = []
+                # Los anillos interiores vienen separados por None
+                for point in list(part) + [None]:
+                    if point is None:
+                        if len(ring) > 2:
+                            rings.append((feature_id, ring))
+                        ring = []
+                    else:
+                        ring.append((point.X, point.Y))
+    return rings, oids
+
+
+def points_in_band(segments, x, y):
+    # segments: arreglo (n, 5) x1, y1, x2, y2, entidad
+    inside = np.zeros(len(x), dtype=bool)
+    if len(segments) == 0:
+        return inside
+    x1, y1, x2, y2, feature_ids = segments.T
+    feature_ids = feature_ids.astype(np.int64)
+    for i in range(len(x)):
+        crosses = (y1 > y[i]) != (y2 > y[i])
+        if not crosses.any():
+            continue
+        sx1, sy1, sx2, sy2 = x1[crosses], y1[crosses], x2[crosses], y2[crosses]
+        x_cross = sx1 + (y[i] - sy1) * (sx2 - sx1) / (sy2 - sy1)
+        hits = feature_ids[crosses][x_cross > x[i]]
+        inside[i] = bool((np.bincount(hits) % 2).any()) if len(hits) else False
+    return inside
+
+
+'''
+Segmentos de los anillos como arreglo (n, 5): x1, y1, x2, y2, índice de entidad, en el orden
+de rings (los anillos se cierran si hace falta y se descartan segmentos de longitud cero)
+'''
+def rings_to_segments(rings):
+    segments = []
+    for feature_id, ring in rings:
+        ring = np.array(ring + [ring[0]] if ring[0] != ring[-1] else ring, dtype=np.float64)
+        segments.append(np.column_stack([ring[:-1], ring[1:], np.full(len(ring) - 1, feature_id)]))
+    segments = np.vstack(segments) if segments else np.zeros((0, 5))
+    return segments[(segments[:, 0] != segments[:, 2]) | (segments[:, 1] != segments[:, 3])]
+
+
+def build_polygon_index(rings, cells=512):
+    points = np.array([point for feature_id, ring in rings for point in ring], dtype=np.float64)
+    xmin, ymin = points.min(axis=0)
+    xmax, ymax = points.max(axis=0)
+    size = max(xmax - xmin, ymax - ymin) / cells
+    nx = max(1, int(np.ceil((xmax - xmin) / size)))
+    ny = max(1, int(np.ceil((ymax - ymin) / size)))
+
+    segments = rings_to_segments(rings)
+
+    def cell_range(low, high, origin, count):
+        first = np.clip(((low - origin) / size).astype(np.int64), 0, count - 1)
+        last = np.clip(((high - origin) / size).astype(np.int64), 0, count - 1)
+        return first, last
+
+    col_first, col_last = cell_range(np.minimum(segments[:, 0], segments[:, 2]),
+                                     np.maximum(segments[:, 0], segments[:, 2]), xmin, nx)
+    row_first, row_last = cell_range(np.minimum(segments[:, 1], segments[:, 3]),
+                                     np.maximum(segments[:, 1], segments[:, 3]), ymin, ny)
+
+    # Celdas de borde: las que cubre la extensión de cada segmento
+    states = np.full((ny, nx), POLYGON_CELL_OUTSIDE, dtype=np.int8)
+    bands = [[] for _ in range(ny)]
+    for i in range(len(segments)):
+        states[row_first[i]:row_last[i] + 1, col_first[i]:col_last[i] + 1] = POLYGON_CELL_BOUNDARY
+        for row in range(row_first[i], row_last[i] + 1):
+            bands[row].append(i)
+    band_offsets = np.zeros(ny + 1, dtype=np.int64)
+    band_offsets[1:] = np.cumsum([len(band) for band in bands])
+    band_segments = segments[np.array([i for band in bands for i in band], dtype=np.int64)]
+
+    # Celdas sin borde: se clasifican con la prueba exacta de su centro
+    for row in range(ny):
+        cols = np.nonzero(states[row] != POLYGON_CELL_BOUNDARY)[0]
+        if len(cols) == 0:
+            continue
+        centers_x = xmin + (cols + 0.5) * size
+        centers_y = np.full(len(cols), ymin + (row + 0.5) * size)
+        band = band_segments[band_offsets[row]:band_offsets[row + 1]]
+        inside = points_in_band(band, centers_x, centers_y)
+        states[row, cols[inside]] = POLYGON_CELL_INSIDE
+
+    return {'origin': np.array([xmin, ymin]), 'size': np.array([size]), 'states': states,
+            'band_offsets': band_offsets, 'band_segments': band_segments}
+
+
+def polygon_index_contains(index, x, y):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    xmin, ymin = index['origin']
+    size = index['size'][0]
+    states = index['states']
+    ny, nx = states.shape
+    cols = np.floor((x - xmin) / size)
+    rows = np.floor((y - ymin) / size)
+    valid = (cols >= 0) & (cols < nx) & (rows >= 0) & (rows < ny)
+    inside = np.zeros(len(x), dtype=bool)
+    cols = cols[valid].astype(np.int64)
+    rows = rows[valid].astype(np.int64)
+    cell_states = states[rows, cols]
+    valid_ids = np.nonzero(valid)[0]
+    inside[valid_ids[cell_states == POLYGON_CELL_INSIDE]] = True
+    # Puntos en celdas de borde: prueba exacta con los segmentos de su banda
+    boundary = cell_states == POLYGON_CELL_BOUNDARY
+    band_offsets = index['band_offsets']
+    for row in np.unique(rows[boundary]):
+        ids = valid_ids[boundary & (rows == row)]
+        band = index['band_segments'][band_offsets[row]:band_offsets[row + 1]]
+        inside[ids] = points_in_band(band, x[ids], y[ids])
+    return inside
+
+
+##################################################################
+##################################################################
+'''
+Índice del límite de la Amazonía (feature_dlim), se carga de index_cache_dir cuando la
+huella de la capa no cambió y en otro caso se construye y se guarda
+'''
+def get_dlim_index(data, spatial_reference):
+    feature_dlim = data['feature_dlim']
+    cache_dir = get_index_cache_dir(data)
+    cells = int(data.get('dlim_index_cells', 512))
+    fingerprint = get_layer_fingerprint(feature_dlim)
+    fingerprint['cells'] = cells
+    fingerprint['spatial_reference'] = spatial_reference.factoryCode
+    index = load_cached_index(cache_dir, 'dlim_index', fingerprint)
+    if index is not None:
+        logging.info("Índice de {}: cargado de la cache".format(feature_dlim))
+        return index
+    start_time = time.time()
+    rings, oids = read_polygon_rings(feature_dlim, spatial_reference)
+    index = build_polygon_index(rings, cells)
+    save_cached_index(cache_dir, 'dlim_index', fingerprint, index)
+    logging.info("Índice de {}: construido en {} segundos ({} celdas, {} de borde)".format(
+        feature_dlim, round(time.time() - start_time, 2), index['states'].size,
+        int((index['states'] == POLYGON_CELL_BOUNDARY).sum())))
+    return index
+
+
+##################################################################
+##################################################################
+'''
+Recorte de puntos al límite de la Amazonía con el índice en grilla (clip_mode = index),
+equivalente a Clip_analysis para capas de puntos
+'''
+def clip_points_with_index(data, in_fc, out_fc):
+    index = get_dlim_index(data, arcpy.Describe(in_fc).spatialReference)
+    kept, total = filter_points(in_fc, out_fc, lambda x, y, rows, names: polygon_index_contains(index, x, y))
+    logging.info("Recorte con índice: {} de {} puntos dentro de la Amazonía".format(kept, total))
+    return out_fc
+
+
+##################################################################
+##################################################################
+'''
+Copia a out_fc (nueva, con el esquema de in_fc) los puntos de in_fc para los que keep
+devuelve True. keep recibe los arreglos x, y, las filas leídas (SHAPE@XY + campos) y los
+nombres de los campos, y devuelve un arreglo booleano con un valor por fila.
+
+Returns:
+    (puntos copiados, puntos leídos)
+'''
+def filter_points(in_fc, out_fc, keep):
+    spatial_reference = arcpy.Describe(in_fc).spatialReference
+    arcpy.CreateFeatureclass_management(env.workspace, out_fc, "POINT", template=in_fc,
+                                        spatial_reference=spatial_reference)
+    names = [field.name for field in arcpy.ListFields(in_fc)
+             if field.type not in ('OID', 'Geometry', 'GlobalID') and field.editable]
+    with arcpy.da.SearchCursor(in_fc, ['SHAPE@XY'] + names) as cursor:
+        rows = [row for row in cursor if row[0][0] is not None]
+    x = np.array([row[0][0] for row in rows], dtype=np.float64)
+    y = np.array([row[0][1] for row in rows], dtype=np.float64)
+    selected = keep(x, y, rows, names)
+    with arcpy.da.InsertCursor(out_fc, ['SHAPE@XY'] + names) as cursor:
+        for row, row_selected in zip(rows, selected):
+            if row_selected:
+                cursor.insertRow(row)
+    return int(np.count_nonzero(selected)), len(rows)
+
+
+##################################################################
+##################################################################
+'''
+Exclusión de detecciones cercanas a pozos de hidrocarburos
+
+La distancia de exclusión depende del instrumento (resolución del píxel del sensor) y se toma
+de pozos_distance en el registro de sensores: 1000 metros para MODIS y 375 metros para VIIRS.
+Se puede cambiar por instrumento con la llave pozos_exclusion_meters, ej:
+{"MODIS": 1000, "VIIRS_NOAA_21": 375}
+
+Returns:
+    OrderedDict instrumento -> metros, en el orden del registro de sensores
+'''
+def get_pozos_exclusion_distances(data):
+    overrides = data.get('pozos_exclusion_meters') or {}
+    distances = collections.OrderedDict()
+    for sensor in get_sensor_registry(data):
+        instrument = sensor['instrument']
+        distance = overrides.get(instrument, sensor['pozos_distance'])
+        if distance is None:
+            raise Exception("El sensor {} no tiene pozos_distance ni {} en pozos_exclusion_meters".format(
+                sensor['name'], instrument))
+        distances[instrument] = float(distance)
+    return distances
+
+
+##################################################################
+##################################################################
+'''
+Zonas de exclusión de pozos (pozos_exclusion_mode = zones)
+
+Para cada distancia se guarda el buffer disuelto (geodésico) de layer_hidrocarburos en la
+geodatabase local index_cache_dir/cache_zonas.gdb. Las zonas se reconstruyen cuando cambia
+la huella de la capa de pozos (get_layer_fingerprint).
+'''
+def get_pozos_zone(data, distance, layer_fingerprint=None):
+    feature_hidrocarburos = data['feature_hidrocarburos']
+    cache_dir = get_index_cache_dir(data)
+    gdb_name = 'cache_zonas.gdb'
+    gdb_path = os.path.join(cache_dir, gdb_name)
+    if not arcpy.Exists(gdb_path):
+        arcpy.CreateFileGDB_management(cache_dir, gdb_name)
+
+    name = 'zona_pozos_{}m'.format(int(round(distance)))
+    zone_path = os.path.join(gdb_path, name)
+    fingerprint = dict(layer_fingerprint or get_layer_fingerprint(feature_hidrocarburos))
+    fingerprint['distance'] = distance
+    if arcpy.Exists(zone_path) and read_cached_fingerprint(cache_dir, name) == fingerprint:
+        logging.debug("Zona de exclusión de {} metros: cargada de la cache".format(distance))
+        return zone_path
+
+    start_time = time.time()
+    if arcpy.Exists(zone_path):
+        arcpy.Delete_management(zone_path)
+    arcpy.Buffer_analysis(feature_hidrocarburos, zone_path, "{:g} Meters".format(distance),
+                          "FULL", "ROUND", "ALL", "", "GEODESIC")
+    write_cached_fingerprint(cache_dir, name, fingerprint)
+    logging.info("Zona de exclusión de {} metros construida en {} segundos".format(
+        distance, round(time.time() - start_time, 2)))
+    return zone_path
+
+
+##################################################################
+##################################################################
+'''
+Índice de proximidad de pozos (pozos_exclusion_mode = proximity)
+
+Los pozos se ordenan por celda de una grilla en grados cuyo tamaño equivale, como mínimo, a
+la mayor distancia de exclusión (el ancho en longitud se corrige con el coseno de la mayor
+latitud absoluta, así la grilla es conservadora en toda la extensión). Para cada detección
+solo se revisan los pozos de su celda y de las 8 vecinas, con distancia haversine.
+El índice se guarda en index_cache_dir y se reconstruye cuando cambia la huella de la capa
+de pozos.
+'''
+EARTH_RADIUS_METERS = 6371008.8
+METERS_PER_DEGREE = EARTH_RADIUS_METERS * np.pi / 180
+
+
+def haversine_meters(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = (np.radians(value) for value in (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def build_point_grid(x, y, cell_meters, max_abs_lat):
+    cell_y = cell_meters / METERS_PER_DEGREE
+    cell_x = cell_meters / (METERS_PER_DEGREE * max(np.cos(np.radians(min(max_abs_lat, 89.0))), 1e-6))
+    origin = np.array([x.min(), y.min()]) if len(x) else np.zeros(2)
+    cols = np.floor((x - origin[0]) / cell_x).astype(np.int64)
+    rows = np.floor((y - origin[1]) / cell_y).astype(np.int64)
+    ncols = int(cols.max()) + 3 if len(x) else 1
+    keys = rows * ncols + cols
+    order = np.argsort(keys, kind='stable')
+    return {'x': x[order], 'y': y[order], 'keys': keys[order], 'origin': origin,
+            'cell': np.array([cell_x, cell_y]), 'ncols': np.array([ncols])}
+
+
+def points_near_grid(grid, x, y, distances):
+    near = np.zeros(len(x), dtype=bool)
+    if len(grid['keys']) == 0 or len(x) == 0:
+        return near
+    cell_x, cell_y = grid['cell']
+    ncols = int(grid['ncols'][0])
+    cols = np.floor((x - grid['origin'][0]) / cell_x).astype(np.int64)
+    rows = np.floor((y - grid['origin'][1]) / cell_y).astype(np.int64)
+    for row_offset in (-1, 0, 1):
+        for col_offset in (-1, 0, 1):
+            neighbour_cols = cols + col_offset
+            keys = (rows + row_offset) * ncols + neighbour_cols
+            valid = (neighbour_cols >= 0) & (neighbour_cols < ncols)
+            start = np.searchsorted(grid['keys'], keys, side='left')
+            end = np.searchsorted(grid['keys'], keys, side='right')
+            pending = np.nonzero(valid & (start < end) & ~near)[0]
+            # Cada vuelta compara cada punto pendiente con el siguiente pozo de su celda
+            while len(pending):
+                wells = start[pending]
+                hit = haversine_meters(x[pending], y[pending], grid['x'][wells], grid['y'][wells]) <= distances[pending]
+                near[pending[hit]] = True
+                start[pending] += 1
+                pending = pending[~hit & (start[pending] < end[pending])]
+    return near
+
+
+def get_pozos_grid(data, spatial_reference, cell_meters, max_abs_lat):
+    feature_hidrocarburos = data['feature_hidrocarburos']
+    cache_dir = get_index_cache_dir(data)
+    fingerprint = get_layer_fingerprint(feature_hidrocarburos)
+    fingerprint['spatial_reference'] = spatial_reference.factoryCode
+    fingerprint['cell_meters'] = cell_meters
+    fingerprint['max_abs_lat'] = round(max_abs_lat, 4)
+    grid = load_cached_index(cache_dir, 'pozos_index', fingerprint)
+    if grid is not None:
+        logging.debug("Índice de pozos: cargado de la cache")
+        return grid
+    with arcpy.da.SearchCursor(feature_hidrocarburos, ['SHAPE@XY'], spatial_reference=spatial_reference) as cursor:
+        points = np.array([xy for xy, in cursor if xy[0] is not None], dtype=np.float64).reshape(-1, 2)
+    grid = build_point_grid(points[:, 0], points[:, 1], cell_meters, max_abs_lat)
+    save_cached_index(cache_dir, 'pozos_index', fingerprint, grid)
+    logging.info("Índice de pozos construido: {} pozos".format(len(points)))
+    return grid
+
 
-            </body>
-			</html>
-                """.format(message)
+'''
+Exclusión de pozos en una sola pasada: cada detección se compara con la distancia de su
+instrumento. in_fc debe estar en coordenadas geográficas.
+'''
+def exclude_pozos_by_proximity(data, in_fc, out_fc):
+    spatial_reference = arcpy.Describe(in_fc).spatialReference
+    if spatial_reference.type != 'Geographic':
+        raise Exception("La exclusión por proximidad requiere coordenadas geográficas: {}".format(in_fc))
+    distances = get_pozos_exclusion_distances(data)
+    extent = arcpy.Describe(data['feature_hidrocarburos']).extent
+    # El índice también sirve para detecciones hasta 1 grado más al sur / norte que los pozos
+    max_abs_lat = min(90.0, max(abs(extent.YMin), abs(extent.YMax)) + 1.0)
+    grid = get_pozos_grid(data, spatial_reference, max(distances.values()), max_abs_lat)
+
+    def keep(x, y, rows, names):
+        instrument_index = names.index('INSTRUMENT') + 1
+        row_distances = np.array([distances.get(row[instrument_index], 0.0) for row in rows], dtype=np.float64)
+        return ~points_near_grid(grid, x, y, row_distances)
+
+    kept, total = filter_points(in_fc, out_fc, keep)
+    logging.info("Exclusión de pozos por proximidad: {} de {} puntos fuera de las zonas de pozos".format(kept, total))
+    return out_fc
 
-            # part1 = MIMEText(text, "plain")
-            part2 = MIMEText(html, "html")
-            # msg.attach(part1)
-            msg.attach(part2)
 
-            server.sendmail(
-                gmail_user, [email] + bcc, msg.as_string()
-            )
+##################################################################
+##################################################################
+'''
+Remueve de in_fc los puntos cercanos a pozos, por instrumento, y une el resultado en out_fc
 
-            logging.debug("Email sent!")
-        except Exception as e:
-            print_error(e)
-            logging.debug("Something went wrong sending email.")
-    server.close()
-    logging.debug("***********************************")
+pozos_exclusion_mode:
+    select: SelectLayerByLocation con la distancia de cada instrumento sobre layer_hidrocarburos
+    zones: SelectLayerByLocation contra la zona de exclusión disuelta de la cache
+    proximity: una sola pasada con el índice de proximidad de pozos (exclude_pozos_by_proximity)
+
+En select y zones se seleccionan los puntos que no están cerca de pozos (NEW_SELECTION con
+INVERT) y se copia la selección. Si no queda ningún punto seleccionado se copia una capa vacía,
+porque CopyFeatures sobre una capa sin selección copia todos los registros.
+'''
+def exclude_pozos(data, in_fc, out_fc):
+    feature_hidrocarburos = data['feature_hidrocarburos']
+    mode = data.get('pozos_exclusion_mode', 'select')
+    if mode == 'proximity':
+        return exclude_pozos_by_proximity(data, in_fc, out_fc)
+    layer_fingerprint = get_layer_fingerprint(feature_hidrocarburos) if mode == 'zones' else None
+    zones = {}
+    outputs = []
+    for instrument, distance in get_pozos_exclusion_distances(data).items():
+        instrument_lyr = "amazonia_{}_lyr".format(instrument.lower())
+        arcpy.MakeFeatureLayer_management(in_fc, instrument_lyr, "INSTRUMENT = '{}'".format(instrument))
+        if mode == 'zones':
+            if distance not in zones:
+                zones[distance] = get_pozos_zone(data, distance, layer_fingerprint)
+            arcpy.SelectLayerByLocation_management(instrument_lyr, "INTERSECT", zones[distance],
+                                                   "", "NEW_SELECTION", "INVERT")
+        else:
+            arcpy.SelectLayerByLocation_management(instrument_lyr, "INTERSECT", feature_hidrocarburos,
+                                                   "{:g} Meters".format(distance), "NEW_SELECTION", "INVERT")
+        if not arcpy.Describe(instrument_lyr).FIDSet:
+            instrument_lyr = "amazonia_{}_empty_lyr".format(instrument.lower())
+            arcpy.MakeFeatureLayer_management(in_fc, instrument_lyr, "1 = 0")
+        without_pozos_lyr = "amazonia_{}_without_pozos_lyr".format(instrument.lower())
+        arcpy.CopyFeatures_management(instrument_lyr, without_pozos_lyr, "", "0", "0", "0")
+        outputs.append(without_pozos_lyr)
+    arcpy.Merge_management(outputs, out_fc, "")
+    return out_fc
 
 
 ##################################################################
 ##################################################################
 '''
-Creación de conexiones SDE a las bases de datos
+Índice de atribución de layer_union_ent_ref (attribution_mode = index)
+
+Árbol R empaquetado con STR (Sort-Tile-Recursive) sobre las extensiones de los polígonos:
+las hojas son los polígonos ordenados por franjas en x y luego en y, agrupados de a
+STR_NODE_CAPACITY, y cada nivel superior agrupa de la misma forma los nodos del nivel de
+abajo. Los puntos bajan por el árbol nivel a nivel (todos los puntos a la vez) y los
+candidatos que quedan en las hojas se confirman con la prueba exacta par-impar sobre los
+segmentos del polígono. El índice guarda los OBJECTID, así los atributos se leen solo de
+los polígonos que tienen detecciones.
 '''
-def create_sde_connections(data):
-    logging.debug("***********************************")
-    try:
-        ## Read
-        username = data['user_reader']
-        password = data['user_reader_pwd']
-        instance = data['prod_instance']
-        database_name = data['prod_database_name']
-        reader_conn = create_conn(data, username, password, instance, database_name)
-        data['reader_conn_prod_instance'] = reader_conn
+STR_NODE_CAPACITY = 16
+
+
+def str_pack(boxes, capacity=STR_NODE_CAPACITY):
+    count = len(boxes)
+    slices = max(1, int(np.ceil(np.sqrt(np.ceil(count / capacity)))))
+    slice_size = slices * capacity
+    centers_x = (boxes[:, 0] + boxes[:, 2]) / 2
+    centers_y = (boxes[:, 1] + boxes[:, 3]) / 2
+    order = np.argsort(centers_x, kind='stable')
+    for start in range(0, count, slice_size):
+        chunk = order[start:start + slice_size]
+        order[start:start + slice_size] = chunk[np.argsort(centers_y[chunk], kind='stable')]
+    return order
+
+
+def build_str_tree(boxes, capacity=STR_NODE_CAPACITY):
+    # Las hojas quedan en el orden STR, cada nodo apunta a un rango contiguo del nivel de abajo
+    leaf_order = str_pack(boxes, capacity)
+    level_boxes = boxes[leaf_order]
+    levels = []
+    while True:
+        starts = np.arange(0, len(level_boxes), capacity)
+        node_boxes = np.column_stack([np.minimum.reduceat(level_boxes[:, 0], starts),
+                                      np.minimum.reduceat(level_boxes[:, 1], starts),
+                                      np.maximum.reduceat(level_boxes[:, 2], starts),
+                                      np.maximum.reduceat(level_boxes[:, 3], starts)])
+        counts = np.diff(np.append(starts, len(level_boxes)))
+        levels.append((node_boxes, starts, counts))
+        if len(node_boxes) == 1:
+            break
+        # Se reordenan los nodos y con ellos sus rangos de hijos
+        order = str_pack(node_boxes, capacity)
+        levels[-1] = (node_boxes[order], starts[order], counts[order])
+        level_boxes = node_boxes[order]
+    tree = {'leaf_order': leaf_order, 'leaf_boxes': boxes[leaf_order], 'levels': np.array([len(levels)])}
+    for level, (node_boxes, starts, counts) in enumerate(reversed(levels)):
+        tree['level_{}_boxes'.format(level)] = node_boxes
+        tree['level_{}_start'.format(level)] = starts
+        tree['level_{}_count'.format(level)] = counts
+    return tree
+
+
+def str_tree_candidates(tree, x, y):
+    def contains(boxes, nodes, points):
+        return ((boxes[nodes, 0] <= x[points]) & (x[points] <= boxes[nodes, 2]) &
+                (boxes[nodes, 1] <= y[points]) & (y[points] <= boxes[nodes, 3]))
+
+    points = np.arange(len(x))
+    nodes = np.zeros(len(x), dtype=np.int64)
+    keep = contains(tree['level_0_boxes'], nodes, points)
+    points, nodes = points[keep], nodes[keep]
+    levels = int(tree['levels'][0])
+    for level in range(levels):
+        starts = tree['level_{}_start'.format(level)][nodes]
+        counts = tree['level_{}_count'.format(level)][nodes]
+        # Expande cada par (punto, nodo) a sus hijos
+        points = np.repeat(points, counts)
+        offsets = np.arange(len(points)) - np.repeat(np.cumsum(counts) - counts, counts)
+        nodes = np.repeat(starts, counts) + offsets
+        child_boxes = tree['level_{}_boxes'.format(level + 1)] if level + 1 < levels else tree['leaf_boxes']
+        keep = contains(child_boxes, nodes, points)
+        points, nodes = points[keep], nodes[keep]
+    return points, tree['leaf_order'][nodes]
+
+
+def build_union_index(rings, oids):
+    segments = rings_to_segments(rings)
+    order = np.argsort(segments[:, 4], kind='stable')
+    segments = segments[order]
+    feature_ids = segments[:, 4].astype(np.int64)
+    segment_offsets = np.searchsorted(feature_ids, np.arange(len(oids) + 1))
+    boxes = np.full((len(oids), 4), np.nan)
+    for feature_id in range(len(oids)):
+        feature_segments = segments[segment_offsets[feature_id]:segment_offsets[feature_id + 1]]
+        if len(feature_segments):
+            boxes[feature_id] = [feature_segments[:, [0, 2]].min(), feature_segments[:, [1, 3]].min(),
+                                 feature_segments[:, [0, 2]].max(), feature_segments[:, [1, 3]].max()]
+    index = build_str_tree(np.nan_to_num(boxes, nan=np.inf), STR_NODE_CAPACITY)
+    index.update({'oids': np.array(oids, dtype=np.int64), 'segments': segments[:, :4],
+                  'segment_offsets': segment_offsets})
+    return index
+
+
+def points_in_feature(index, feature_id, x, y):
+    segments = index['segments'][index['segment_offsets'][feature_id]:index['segment_offsets'][feature_id + 1]]
+    inside = np.zeros(len(x), dtype=bool)
+    # Por bloques para acotar la memoria de la matriz segmentos x puntos
+    block = max(1, 2000000 // max(1, len(segments)))
+    for start in range(0, len(x), block):
+        px = x[start:start + block]
+        py = y[start:start + block]
+        x1, y1, x2, y2 = (segments[:, column][:, None] for column in range(4))
+        crosses = (y1 > py) != (y2 > py)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+        inside[start:start + block] = (np.count_nonzero(crosses & (x_cross > px), axis=0) % 2) == 1
+    return inside
 
-        username = data['pub_user_reader']
-        password = data['pub_user_reader_pwd']
-        instance = data['pub_instance']
-        database_name = data['pub_database_name']
-        reader_conn = create_conn(data, username, password, instance, database_name)
-        data['reader_conn_pub_instance'] = reader_conn
 
-        ## write
-        username = data['prod_user_edit']
-        password = data['prod_user_edit_pwd']
-        instance = data['prod_edit_instance']
-        database_name = data['prod_database_name']
-        reader_conn = create_conn(data, username, password, instance, database_name)
-        data['edit_conn_prod_instance'] = reader_conn
+'''
+Pares (punto, entidad) de los puntos que caen dentro de cada polígono del índice
 
-        username = data['pub_user_edit']
-        password = data['pub_user_edit_pwd']
-        instance = data['pub_edit_instance']
-        database_name = data['pub_database_name']
-        reader_conn = create_conn(data, username, password, instance, database_name)
-        data['edit_conn_pub_instance'] = reader_conn
-    except Exception as e:
-        print_error(e)
-        raise Exception('ERROR_002 - No se pudo crear las conexiones SDE a las bases de datos')
-    logging.debug("***********************************")
+Returns:
+    (índices de punto, índices de entidad), ordenados por punto
+'''
+def union_index_lookup(index, x, y):
+    points, features = str_tree_candidates(index, x, y)
+    matched = np.zeros(len(points), dtype=bool)
+    order = np.argsort(features, kind='stable')
+    points, features = points[order], features[order]
+    bounds = np.flatnonzero(np.diff(features)) + 1
+    for start, end in zip(np.r_[0, bounds], np.r_[bounds, len(features)]):
+        if end > start:
+            feature_points = points[start:end]
+            matched[start:end] = points_in_feature(index, features[start], x[feature_points], y[feature_points])
+    points, features = points[matched], features[matched]
+    order = np.argsort(points, kind='stable')
+    return points[order], features[order]
+
+
+def get_union_index(data, spatial_reference):
+    feature_union_ent_ref = data['feature_union_ent_ref']
+    cache_dir = get_index_cache_dir(data)
+    fingerprint = get_layer_fingerprint(feature_union_ent_ref)
+    fingerprint['spatial_reference'] = spatial_reference.factoryCode
+    index = load_cached_index(cache_dir, 'union_index', fingerprint)
+    if index is not None:
+        logging.info("Índice de {}: cargado de la cache".format(feature_union_ent_ref))
+        return index
+    start_time = time.time()
+    rings, oids = read_polygon_rings(feature_union_ent_ref, spatial_reference)
+    index = build_union_index(rings, oids)
+    save_cached_index(cache_dir, 'union_index', fingerprint, index)
+    logging.info("Índice de {}: construido en {} segundos ({} polígonos, {} segmentos)".format(
+        feature_union_ent_ref, round(time.time() - start_time, 2), len(oids), len(index['segments'])))
+    return index
 
 
 ##################################################################
 ##################################################################
 '''
-Validación datos de entrada SDE
+Atribución de los puntos de in_fc con los campos de layer_union_ent_ref, equivalente a
+Intersect_analysis([feature_union_ent_ref, in_fc], out_fc, "NO_FID", "", "INPUT") para
+puntos: cada punto sale una vez por polígono que lo contiene (los puntos fuera de todos los
+polígonos se descartan). Los atributos se leen solo de los polígonos con detecciones.
+lookup recibe los arreglos x, y y devuelve los pares (puntos, OBJECTID).
 '''
-def validate_input_data(data):
-    logging.debug("***********************************")
-    logging.debug("** validate_input_data **")
-    logging.debug("***********************************")
-    try:
-        ##################################################################
-        reader_conn = data['reader_conn_prod_instance']
+ADD_FIELD_TYPES = {'String': 'TEXT', 'Integer': 'LONG', 'SmallInteger': 'SHORT', 'Double': 'DOUBLE',
+                   'Single': 'FLOAT', 'Date': 'DATE', 'BigInteger': 'BIGINTEGER', 'GUID': 'GUID',
+                   'DateOnly': 'DATEONLY', 'TimeOnly': 'TIMEONLY', 'TimestampOffset': 'TIMESTAMPOFFSET'}
+
+
+def add_field_like(fc, field, name):
+    arcpy.AddField_management(fc, name, ADD_FIELD_TYPES[field.type], field.precision, field.scale,
+                              field.length if field.type == 'String' else "", field.aliasName)
+
+
+def attribute_points(data, in_fc, out_fc, lookup):
+    feature_union_ent_ref = data['feature_union_ent_ref']
+    spatial_reference = arcpy.Describe(in_fc).spatialReference
+    arcpy.CreateFeatureclass_management(env.workspace, out_fc, "POINT", spatial_reference=spatial_reference)
+    union_fields = [field for field in arcpy.ListFields(feature_union_ent_ref)
+                    if field.type in ADD_FIELD_TYPES and field.editable]
+    point_fields = [field.name for field in arcpy.ListFields(in_fc)
+                    if field.type in ADD_FIELD_TYPES and field.editable]
+    # Igual que Intersect: primero los campos de layer_union_ent_ref con su nombre, luego los
+    # de los puntos; los campos de los puntos con un nombre ya usado llevan el sufijo _1
+    for field in union_fields:
+        add_field_like(out_fc, field, field.name)
+    union_names = [field.name.lower() for field in union_fields]
+    out_names = []
+    for field in arcpy.ListFields(in_fc):
+        if field.name in point_fields:
+            name = field.name + '_1' if field.name.lower() in union_names else field.name
+            add_field_like(out_fc, field, name)
+            out_names.append(name)
+
+    with arcpy.da.SearchCursor(in_fc, ['SHAPE@XY'] + point_fields) as cursor:
+        rows = [row for row in cursor if row[0][0] is not None]
+    x = np.array([row[0][0] for row in rows], dtype=np.float64)
+    y = np.array([row[0][1] for row in rows], dtype=np.float64)
+    points, oids = lookup(x, y)
+
+    attributes = {}
+    oid_field = arcpy.Describe(feature_union_ent_ref).OIDFieldName
+    unique_oids = [int(oid) for oid in np.unique(oids)]
+    for start in range(0, len(unique_oids), 1000):
+        where = "{} IN ({})".format(oid_field, ','.join(str(oid) for oid in unique_oids[start:start + 1000]))
+        with arcpy.da.SearchCursor(feature_union_ent_ref, ['OID@'] + [field.name for field in union_fields],
+                                   where) as cursor:
+            for row in cursor:
+                attributes[row[0]] = row[1:]
 
-        layer = data['layer_hidrocarburos']
-        if data["is_test"]:
-            layer = "\\" + get_last_portion(layer)
-        feature_path = reader_conn + layer
-        result = int(arcpy.GetCount_management(feature_path)[0])
-        logging.debug('{} has {} records'.format(layer, result))
-        #if result == 0:
-        #    raise Exception("No se encontraron datos en la capa {} ".format(layer))
-        data['feature_hidrocarburos'] = feature_path
+    with arcpy.da.InsertCursor(out_fc, ['SHAPE@XY'] + [field.name for field in union_fields] + out_names) as cursor:
+        for point, oid in zip(points, oids):
+            cursor.insertRow(rows[point][:1] + attributes[int(oid)] + rows[point][1:])
+    logging.info("Atribución: {} puntos de {} con atributos de {} polígonos".format(
+        len(np.unique(points)), len(rows), len(unique_oids)))
+    return out_fc
 
-        layer = data['layer_union_ent_ref']
-        if data["is_test"]:
-            layer = "\\" + get_last_portion(layer)
-        feature_path = reader_conn + layer
-        result = int(arcpy.GetCount_management(feature_path)[0])
-        logging.debug('{} has {} records'.format(layer, result))
-        #if result == 0:
-        #    raise Exception("No se encontraron datos en la capa {} ".format(layer))
-        data['feature_union_ent_ref'] = feature_path
 
-        layer = data['layer_dlim']
-        if data["is_test"]:
-            layer = "\\" + get_last_portion(layer)
-        feature_path = reader_conn + layer
-        result = int(arcpy.GetCount_management(feature_path)[0])
-        logging.debug('{} has {} records'.format(layer, result))
-        #if result == 0:
-        #    raise Exception("No se encontraron datos en la capa {} ".format(layer))
-        data['feature_dlim'] = feature_path
+def attribute_points_with_index(data, in_fc, out_fc):
+    index = get_union_index(data, arcpy.Describe(in_fc).spatialReference)
 
-        reader_conn = data['reader_conn_pub_instance']
+    def lookup(x, y):
+        points, features = union_index_lookup(index, x, y)
+        return points, index['oids'][features]
 
-        layer = data['layer_usuarios_emails']
-        if data["is_test"]:
-            layer = "\\" + get_last_portion(layer)
-        feature_path = reader_conn + layer
-        result = int(arcpy.GetCount_management(feature_path)[0])
-        logging.debug('{} has {} records'.format(layer, result))
-        #if result == 0:
-        #    raise Exception("No se encontraron datos en la capa {} ".format(layer))
-        data['feature_usuarios_emails'] = feature_path
+    return attribute_points(data, in_fc, out_fc, lookup)
 
-        ##################################################################
-        edit_conn = data['edit_conn_prod_instance']
 
-        layer = data['layer_output_prod']
-        if data["is_test"]:
-            layer = "\\" + get_last_portion(layer)
-        feature_path = edit_conn + layer
-        result = int(arcpy.GetCount_management(feature_path)[0])
-        logging.debug('{} has {} records'.format(layer, result))
-        #if result == 0:
-        #    raise Exception("No se encontraron datos en la capa {} ".format(layer))
-        data['feature_output_prod'] = feature_path
-        data['total_fuegos_historicos_prod'] = result
+##################################################################
+##################################################################
+'''
+Raster de identificadores de layer_union_ent_ref (attribution_mode = raster)
+
+Grilla de attribution_raster_cell_size (unidades de la capa, grados en SIRGAS) sobre la
+extensión de la capa, guardada como arreglo .npy que se abre como memmap. Cada celda tiene:
+    >= 0: índice del único polígono que cubre toda la celda (ningún borde la toca)
+    UNION_RASTER_EMPTY: la celda no está en ningún polígono
+    UNION_RASTER_BOUNDARY: la celda toca un borde o está en varios polígonos, el punto se
+        resuelve con la prueba exacta del índice de atribución (union_index_lookup)
+El raster se llena por líneas de barrido: en el centro de cada fila se calculan los cruces
+con los segmentos de cada polígono y los tramos entre cruces pares e impares son interiores.
+'''
+UNION_RASTER_EMPTY = -1
+UNION_RASTER_BOUNDARY = -2
+
+
+def build_union_raster(index, grid_path, cell_size):
+    segments = index['segments']
+    feature_ids = np.repeat(np.arange(len(index['oids'])), np.diff(index['segment_offsets']))
+    xmin, ymin = segments[:, [0, 2]].min(), segments[:, [1, 3]].min()
+    xmax, ymax = segments[:, [0, 2]].max(), segments[:, [1, 3]].max()
+    nx = max(1, int(np.ceil((xmax - xmin) / cell_size)))
+    ny = max(1, int(np.ceil((ymax - ymin) / cell_size)))
+    grid = np.lib.format.open_memmap(grid_path, mode='w+', dtype=np.int32, shape=(ny, nx))
+    grid[:] = UNION_RASTER_EMPTY
+
+    # Cruces de cada segmento con los centros de las filas que atraviesa
+    seg_ymin = np.minimum(segments[:, 1], segments[:, 3])
+    seg_ymax = np.maximum(segments[:, 1], segments[:, 3])
+    first = np.ceil((seg_ymin - ymin) / cell_size - 0.5).astype(np.int64)
+    last = np.ceil((seg_ymax - ymin) / cell_size - 0.5).astype(np.int64) - 1
+    counts = np.maximum(0, last - first + 1)
+    crossings = [np.zeros((0, 3))]
+    for start in range(0, len(segments), 200000):
+        block = slice(start, start + 200000)
+        block_counts = counts[block]
+        pair_segments = np.repeat(np.arange(start, start + len(block_counts)), block_counts)
+        rows = np.repeat(first[block], block_counts) + (
+            np.arange(len(pair_segments)) - np.repeat(np.cumsum(block_counts) - block_counts, block_counts))
+        center_y = ymin + (rows + 0.5) * cell_size
+        x1, y1, x2, y2 = segments[pair_segments].T
+        # La condición (y1 > y) != (y2 > y) garantiza un número par de cruces por fila y polígono
+        valid = (y1 > center_y) != (y2 > center_y)
+        x_cross = x1[valid] + (center_y[valid] - y1[valid]) * (x2[valid] - x1[valid]) / (y2[valid] - y1[valid])
+        crossings.append(np.column_stack([feature_ids[pair_segments[valid]], rows[valid], x_cross]))
+    crossings = np.vstack(crossings)
+    crossings = crossings[np.lexsort((crossings[:, 2], crossings[:, 1], crossings[:, 0]))]
+    for (feature_id, row, x_start), (_, _, x_end) in zip(crossings[0::2], crossings[1::2]):
+        row = int(row)
+        col_first = max(0, int(np.ceil((x_start - xmin) / cell_size - 0.5)))
+        col_last = min(nx - 1, int(np.ceil((x_end - xmin) / cell_size - 0.5)) - 1)
+        if col_last < col_first:
+            continue
+        cells = grid[row, col_first:col_last + 1]
+        overlap = cells != UNION_RASTER_EMPTY
+        cells[overlap] = UNION_RASTER_BOUNDARY
+        cells[~overlap] = int(feature_id)
+
+    # Celdas tocadas por algún borde
+    col_first = np.clip(((np.minimum(segments[:, 0], segments[:, 2]) - xmin) / cell_size).astype(np.int64), 0, nx - 1)
+    col_last = np.clip(((np.maximum(segments[:, 0], segments[:, 2]) - xmin) / cell_size).astype(np.int64), 0, nx - 1)
+    row_first = np.clip(((seg_ymin - ymin) / cell_size).astype(np.int64), 0, ny - 1)
+    row_last = np.clip(((seg_ymax - ymin) / cell_size).astype(np.int64), 0, ny - 1)
+    for i in range(len(segments)):
+        grid[row_first[i]:row_last[i] + 1, col_first[i]:col_last[i] + 1] = UNION_RASTER_BOUNDARY
+    grid.flush()
+    return {'origin': np.array([xmin, ymin]), 'size': np.array([cell_size]), 'shape': np.array([ny, nx])}
+
+
+def union_raster_lookup(raster, grid, index, x, y):
+    xmin, ymin = raster['origin']
+    size = raster['size'][0]
+    ny, nx = grid.shape
+    cols = np.floor((x - xmin) / size)
+    rows = np.floor((y - ymin) / size)
+    valid = (cols >= 0) & (cols < nx) & (rows >= 0) & (rows < ny)
+    values = np.full(len(x), UNION_RASTER_EMPTY, dtype=np.int64)
+    values[valid] = grid[rows[valid].astype(np.int64), cols[valid].astype(np.int64)]
+    interior = np.nonzero(values >= 0)[0]
+    # Solo los puntos cerca de bordes pasan por la prueba exacta
+    boundary = np.nonzero(values == UNION_RASTER_BOUNDARY)[0]
+    boundary_points, boundary_features = union_index_lookup(index, x[boundary], y[boundary])
+    points = np.concatenate([interior, boundary[boundary_points]])
+    features = np.concatenate([values[interior], boundary_features])
+    order = np.argsort(points, kind='stable')
+    logging.debug("Raster de atribución: {} puntos interiores, {} cerca de bordes".format(
+        len(interior), len(boundary)))
+    return points[order], features[order]
+
+
+def get_union_raster(data, spatial_reference, index):
+    feature_union_ent_ref = data['feature_union_ent_ref']
+    cache_dir = get_index_cache_dir(data)
+    cell_size = float(data.get('attribution_raster_cell_size', 0.01))
+    fingerprint = get_layer_fingerprint(feature_union_ent_ref)
+    fingerprint['spatial_reference'] = spatial_reference.factoryCode
+    fingerprint['cell_size'] = cell_size
+    grid_path = os.path.join(cache_dir, 'union_raster_grid.npy')
+    raster = load_cached_index(cache_dir, 'union_raster', fingerprint)
+    if raster is None or not os.path.exists(grid_path):
+        start_time = time.time()
+        raster = build_union_raster(index, grid_path, cell_size)
+        save_cached_index(cache_dir, 'union_raster', fingerprint, raster)
+        logging.info("Raster de {}: construido en {} segundos ({} x {} celdas)".format(
+            feature_union_ent_ref, round(time.time() - start_time, 2), *raster['shape']))
+    grid = np.load(grid_path, mmap_mode='r')
+    return raster, grid
+
+
+def attribute_points_with_raster(data, in_fc, out_fc):
+    spatial_reference = arcpy.Describe(in_fc).spatialReference
+    index = get_union_index(data, spatial_reference)
+    raster, grid = get_union_raster(data, spatial_reference, index)
+
+    def lookup(x, y):
+        points, features = union_raster_lookup(raster, grid, index, x, y)
+        return points, index['oids'][features]
+
+    return attribute_points(data, in_fc, out_fc, lookup)
 
-        edit_conn = data['edit_conn_pub_instance']
 
-        layer = data['layer_output_pub']
-        if data["is_test"]:
-            layer = "\\" + get_last_portion(layer)
-        feature_path = edit_conn + layer
-        result = int(arcpy.GetCount_management(feature_path)[0])
-        logging.debug('{} has {} records'.format(layer, result))
-        #if result == 0:
-        #    raise Exception("No se encontraron datos en la capa {} ".format(layer))
-        data['feature_output_pub'] = feature_path
-        data['total_fuegos_historicos_pub'] = result
+##################################################################
+##################################################################
+'''
+Espacio de trabajo temporal de process_data (workspace_strategy)
 
-        layer_sirgas = data['layer_output_pub_sirgas']
-        if data["is_test"]:
-            layer_sirgas = "\\" + get_last_portion(layer_sirgas)
-        feature_path_sirgas = edit_conn + layer_sirgas
-        result_sirgas = int(arcpy.GetCount_management(feature_path_sirgas)[0])
-        logging.debug('{} has {} records'.format(layer_sirgas, result_sirgas))
-        #if result_sirgas == 0:
-        #    raise Exception("No se encontraron datos en la capa {} ".format(layer_sirgas))
-        data['feature_output_pub_sirgas'] = feature_path_sirgas
-        data['total_fuegos_historicos_pub_sirgas'] = result_sirgas
-        ##################################################################
-    except Exception as e:
-        print_error(e)
-        raise Exception('ERROR_003 - Error al Validar Datos : {} '.format(e))
+    disk: Output.gdb en current_day_temp_dir (comportamiento original)
+    memory: workspace memory de ArcGIS Pro, los datos intermedios no se escriben a disco
+    auto: memory, salvo que los sensores descargados sumen más de workspace_memory_max_rows
+        registros, en cuyo caso se usa disk
+
+keep_intermediates fuerza disk para conservar los datos intermedios y poder revisarlos.
+'''
+def select_temp_workspace(data):
+    strategy = data.get('workspace_strategy', 'auto')
+    if data.get('keep_intermediates', False):
+        strategy = 'disk'
+    elif strategy == 'auto':
+        max_rows = int(data.get('workspace_memory_max_rows', 500000))
+        total_rows = sum(max(0, result.get('records', 0)) for result in data.get('download_results', {}).values())
+        strategy = 'memory' if total_rows <= max_rows else 'disk'
+        logging.debug("workspace auto: {} registros descargados, límite {}".format(total_rows, max_rows))
+
+    if strategy == 'memory':
+        workspace = "memory"
+    else:
+        ## fgdb para almacenamiento temporal de datos durante la ejecución del modelo
+        fgdb_name = "Output.gdb"
+        workspace = data['current_day_temp_dir'] + '\\' + fgdb_name
+        arcpy.CreateFileGDB_management(data['current_day_temp_dir'], fgdb_name)
+    data['workspace_strategy_used'] = strategy
+    data['temp_workspace'] = workspace
+    logging.info("Espacio de trabajo temporal: {} ({})".format(workspace, strategy))
+    return workspace
 
-    logging.debug("***********************************")
 
 ##################################################################
 ##################################################################
 '''
-Valida la existencia de un atributo
+Tiempos por etapa de process_data, se guardan en data['stage_timings']
 '''
-def field_exists(layer_name, field_name):
-    if arcpy.Exists(layer_name):
-        return len(arcpy.ListFields(layer_name, field_name)) > 0
+def record_stage_time(data, stage, start_time):
+    seconds = round(time.time() - start_time, 2)
+    data.setdefault('stage_timings', collections.OrderedDict())[stage] = seconds
+    logging.debug("Etapa {}: {} segundos".format(stage, seconds))
+
+
+def log_stage_timings(data):
+    timings = data.get('stage_timings', {})
+    if not timings:
+        return
+    logging.info("Tiempos por etapa ({}):".format(data.get('workspace_strategy_used')))
+    for stage, seconds in timings.items():
+        logging.info("    {:<22} {:>8} s".format(stage, seconds))
+    logging.info("    {:<22} {:>8} s".format('total', round(sum(timings.values()), 2)))
+
 
 ##################################################################
 ##################################################################
@@ -697,7 +3331,6 @@ def process_data(data):
 
     try:
         current_day_temp_dir = data['current_day_temp_dir']
-        feature_hidrocarburos = data['feature_hidrocarburos']
         feature_dlim = data['feature_dlim']
         feature_union_ent_ref = data['feature_union_ent_ref']
 
@@ -757,13 +3390,9 @@ def process_data(data):
         logging.debug(" shp_nooa : {}  ".format(shp_nooa))
         logging.debug(" shp_nooa_21 : {}  ".format(shp_nooa_21))
 
-        ## fgdb para almacenamiento temporal de datos durante la ejecución del modelo
-        fgdb_name = "Output.gdb"
-        temp_fgdb = current_day_temp_dir + '\\' + fgdb_name
-        arcpy.CreateFileGDB_management(current_day_temp_dir, fgdb_name)
-
-        # Espacio de trabajo por default para el geoprocesamiento temporal
-        env.workspace = temp_fgdb
+        ## Espacio de trabajo por default para el geoprocesamiento temporal: Output.gdb en disco o
+        ## el workspace memory de ArcGIS Pro (workspace_strategy)
+        env.workspace = select_temp_workspace(data)
         '''
         El 23 de febrero de 2022 se solicito incluir el campo confidence,
         el proceso antes de esa fecha eliminaba el atributo usando las siguientes lineas
@@ -786,189 +3415,47 @@ def process_data(data):
 
         logging.debug("** add fields... **")
         '''
-        # Copy shapefiles inputs to workspace fgdb
-        shp_modis_1 = "shp_modis_1"
-        shp_vnp_1 = "shp_vnp_1"
-        shp_nooa_1 = "shp_nooa_1"
-        shp_nooa_21_1 = "shp_nooa_21_1"
-        merge_list = []
-
-        # AVera - 20231211, Se crea un condicional por cada shp de cada sensor para que si este existe lo tenga analisis para el resto del anlisis
-        # ADiaz - 20240301 Se altera la longitud del campo satellite para poder manejar nombres largos de las siglas del satelite que asigna la NASA
-
-        if shp_modis and arcpy.Exists(shp_modis):
-            arcpy.Select_analysis(shp_modis, "shp_modis_1")
-            # Ajuste campo satellite
-            arcpy.AlterField_management(shp_modis_1, "SATELLITE", "SATELLITEOLD")
-            arcpy.AddField_management(shp_modis_1, "SATELLITE", "TEXT", "", "", "256", "", "NULLABLE", "NON_REQUIRED",
-                                      "")
-            arcpy.CalculateField_management(shp_modis_1, "SATELLITE", "!SATELLITEOLD!", "PYTHON3", "")
-            arcpy.DeleteField_management(shp_modis_1, "SATELLITEOLD")
-            # Se adiciona el atributo INSTRUMENT a  Insumo_MODIS y se le asigna el valor MODIS
-            arcpy.AddField_management(shp_modis_1, "INSTRUMENT", "STRING")
-            expression = "'MODIS'"
-            arcpy.CalculateField_management(shp_modis_1, "INSTRUMENT", expression, "PYTHON3")
-
-            # Se cambia el nombre del atributo confidence a confidence_modis para diferenciar de confidence, donde se
-            # almacenara su valor en datos categoricos no numericos
-            arcpy.AlterField_management(shp_modis_1, 'CONFIDENCE', 'confidence_modis', 'confidence_modis')
-
-            # Se agrega el campo confidence a modis para almacenar sus valores categoricos
-            arcpy.AddField_management(shp_modis_1, "CONFIDENCE", "STRING")
-
-            # Se calcula confidense en MODIS de acuerdo a sus valores categoricos en la documentacion MODIS
-            expression = "getClass(!confidence_modis!)"
-            codeblock = """def getClass(confidence_modis):
-    confidence = confidence_modis
-    if confidence < 30:
-        return 'low'
-    elif confidence >= 30 and confidence < 80:
-        return 'nominal'
-    elif confidence >= 80 and confidence <= 100:
-        return 'high'"""
-            arcpy.CalculateField_management(shp_modis_1, "CONFIDENCE", expression, "PYTHON3",
-                                            codeblock)
-            merge_list.append(shp_modis_1)
-
-        if shp_vnp and arcpy.Exists(shp_vnp):
-            arcpy.Select_analysis(shp_vnp, "shp_vnp_1")
-            # Ajuste campo satellite
-            arcpy.AlterField_management(shp_vnp_1, "SATELLITE", "SATELLITEOLD")
-            arcpy.AddField_management(shp_vnp_1, "SATELLITE", "TEXT", "", "", "256", "", "NULLABLE", "NON_REQUIRED", "")
-            arcpy.CalculateField_management(shp_vnp_1, "SATELLITE", "!SATELLITEOLD!", "PYTHON3", "")
-            arcpy.DeleteField_management(shp_vnp_1, "SATELLITEOLD")
-
-            # Se adiciona el atributo INSTRUMENT a  Insumo_VIIRS y se le asigna el valor VIIRS_SOUMI
-            arcpy.AddField_management(shp_vnp_1, "INSTRUMENT", "STRING")
-            expression = "'VIIRS_SOUMI'"
-            arcpy.CalculateField_management(shp_vnp_1, "INSTRUMENT", expression, "PYTHON3")
-
-            # Se adiciona el atributo confidense_modis a Insumo_VIIRS para ser compatible en el merge posterior
-            arcpy.AddField_management(shp_vnp_1, "confidence_modis", "Double")
-            merge_list.append(shp_vnp_1)
-
-        if shp_nooa and arcpy.Exists(shp_nooa):
-            arcpy.Select_analysis(shp_nooa, "shp_nooa_1")
-            # Ajuste campo satellite
-            arcpy.AlterField_management(shp_nooa_1, "SATELLITE", "SATELLITEOLD")
-            arcpy.AddField_management(shp_nooa_1, "SATELLITE", "TEXT", "", "", "256", "", "NULLABLE", "NON_REQUIRED",
-                                      "")
-            arcpy.CalculateField_management(shp_nooa_1, "SATELLITE", "!SATELLITEOLD!", "PYTHON3", "")
-            arcpy.DeleteField_management(shp_nooa_1, "SATELLITEOLD")
-
-            # Se adiciona el atributo INSTRUMENT a  Insumo_VIIRS y se le asigna el valor VIIRS_NOAA
-            arcpy.AddField_management(shp_nooa_1, "INSTRUMENT", "STRING")
-            expression = "'VIIRS_NOAA'"
-            arcpy.CalculateField_management(shp_nooa_1, "INSTRUMENT", expression, "PYTHON3")
-
-            # Se adiciona el atributo confidense_modis a Insumo_VIIRS para ser compatible en el merge posterior
-            arcpy.AddField_management(shp_nooa_1, "confidence_modis", "Double")
-            merge_list.append(shp_nooa_1)
-
-        if shp_nooa_21 and arcpy.Exists(shp_nooa_21):
-            arcpy.Select_analysis(shp_nooa_21, "shp_nooa_21_1")
-            # Ajuste campo satellite
-            arcpy.AlterField_management(shp_nooa_21_1, "SATELLITE", "SATELLITEOLD")
-            arcpy.AddField_management(shp_nooa_21_1, "SATELLITE", "TEXT", "", "", "256", "", "NULLABLE", "NON_REQUIRED","")
-            arcpy.CalculateField_management(shp_nooa_21_1, "SATELLITE", "!SATELLITEOLD!", "PYTHON3", "")
-            arcpy.DeleteField_management(shp_nooa_21_1, "SATELLITEOLD")
-
-            # Se adiciona el atributo INSTRUMENT a  Insumo_VIIRS y se le asigna el valor VIIRS_NOAA
-            arcpy.AddField_management(shp_nooa_21_1, "INSTRUMENT", "STRING")
-            expression = "'VIIRS_NOAA_21'"
-            arcpy.CalculateField_management(shp_nooa_21_1, "INSTRUMENT", expression, "PYTHON3")
-
-            # Se adiciona el atributo confidense_modis a Insumo_VIIRS para ser compatible en el merge posterior
-            arcpy.AddField_management(shp_nooa_21_1, "confidence_modis", "Double")
-            merge_list.append(shp_nooa_21_1)
-
-        # Realiza merge entre Insumo_MODIS, Insumo VIIRS (+ Insumo VIIRS NOAA 21) y lo almacena en el dato intermedio
+        # Normalización de los sensores (shapefile o CSV) en una sola capa con el esquema unificado
         # Actividad 2 - Nuevo modelo
         continental_lyr = "continental_lyr"
-        arcpy.Merge_management(merge_list, continental_lyr, "")
+        stage_start = time.time()
+        normalize_sensors(data, continental_lyr,
+                          get_min_acq_date(pytz.timezone('America/Bogota'), 24, get_reference_date(data)),
+                          get_prefilter_bbox(data))
+        record_stage_time(data, 'normalizacion', stage_start)
+
+        # Filtro de las últimas 24 horas y fechas en hora de Colombia, antes de proyectar,
+        # recortar y cruzar con las entidades de referencia
+        incremental_mode = data.get('incremental_mode', False)
+        stage_start = time.time()
+        new_watermark = filter_acquisition_window(data, continental_lyr)
+        record_stage_time(data, 'filtro_24h', stage_start)
 
         # Se reproyecta el merge a Sirgas para poder hacer el clip con la capa de la amazonía
         continental_sirgas_lyr = "continental_sirgas_lyr"
         coordinate_system_sirgas = arcpy.SpatialReference(4170)
+        stage_start = time.time()
         arcpy.Project_management(continental_lyr, continental_sirgas_lyr, coordinate_system_sirgas)
+        record_stage_time(data, 'proyeccion', stage_start)
 
         # Actividad 3 - Nuevo modelo
         # Posterior a ello se hace el corte al límite de la región amazónica entre la capa
         # resultante de la actividad 2  y se filtran los datos para la Amazonia, (continental_dlim)
         amazonia_nasa_lyr = "amazonia_nasa_lyr"
-        arcpy.Clip_analysis(continental_sirgas_lyr, feature_dlim, amazonia_nasa_lyr, "")
-
-        #######################################################################################
-        ## Modis
-        #######################################################################################
-        # Modelo Anterior:
-        # Se seleccionan los datos de amazonia_nasa_lyr con el criterio INSTRUMENT = 'MODIS'
-        # y se almacenan en amazonia_modis_lyr
-        # Modelo Anterior: Se remueve de la selección anterior la intersección con POZOS
-        # a una distancia de 1000 metros
-        amazonia_modis_lyr = "amazonia_modis_lyr"
-        arcpy.MakeFeatureLayer_management(amazonia_nasa_lyr, amazonia_modis_lyr, "INSTRUMENT = 'MODIS'")
-        arcpy.SelectLayerByLocation_management(amazonia_modis_lyr, "INTERSECT", feature_hidrocarburos,
-                                               "1000 Meters", "REMOVE_FROM_SELECTION", "NOT_INVERT")
-
-        # Nuevo modelo: Se copian datos filtrados en el feature amazonia_modis_without_pozos_lyr
-        amazonia_modis_without_pozos_lyr = "amazonia_modis_without_pozos_lyr"
-        arcpy.CopyFeatures_management(amazonia_modis_lyr, amazonia_modis_without_pozos_lyr, "", "0", "0", "0")
-
-        #######################################################################################
-        ## Suomi
-        #######################################################################################
-        # Se realiza la selección de los datos con el criterio INSTRUMENT = VIIRS_SOUMI,
-        # se remueven de dicha selección
-        # los pozos a una distancia de 375  metros.
-        amazonia_vnp_lyr = "amazonia_vnp_lyr"
-        arcpy.MakeFeatureLayer_management(amazonia_nasa_lyr, amazonia_vnp_lyr, "INSTRUMENT = 'VIIRS_SOUMI'")
-        arcpy.SelectLayerByLocation_management(amazonia_vnp_lyr, "INTERSECT", feature_hidrocarburos,
-                                               "375 Meters", "REMOVE_FROM_SELECTION", "NOT_INVERT")
-
-        # Nuevo modelo: Se copian datos filtrados en el feature amazonia_vpn_without_pozos_lyr
-        amazonia_vpn_without_pozos_lyr = "amazonia_vpn_without_pozos_lyr"
-        arcpy.CopyFeatures_management(amazonia_vnp_lyr, amazonia_vpn_without_pozos_lyr, "", "0", "0", "0")
-
-        #######################################################################################
-        ## NOAA
-        #######################################################################################
-        # Se realiza la selección de los datos con el criterio INSTRUMENT = VIIRS_NOAA,
-        # se remueven de dicha selección
-        # los pozos a una distancia de 375  metros.
-        amazonia_noaa_lyr = "amazonia_noaa_lyr"
-        arcpy.MakeFeatureLayer_management(amazonia_nasa_lyr, amazonia_noaa_lyr, "INSTRUMENT = 'VIIRS_NOAA'")
-        arcpy.SelectLayerByLocation_management(amazonia_noaa_lyr, "INTERSECT", feature_hidrocarburos,
-                                               "375 Meters", "REMOVE_FROM_SELECTION", "NOT_INVERT")
-
-        # Nuevo modelo: Se copian datos filtrados en el feature amazonia_noaa_without_pozos_lyr
-        amazonia_noaa_without_pozos_lyr = "amazonia_noaa_without_pozos_lyr"
-        arcpy.CopyFeatures_management(amazonia_noaa_lyr, amazonia_noaa_without_pozos_lyr, "", "0", "0", "0")
-
-        #######################################################################################
-        ## NOAA_21
-        #######################################################################################
-        # Se realiza la selección de los datos con el criterio INSTRUMENT = VIIRS_NOAA_21,
-        # se remueven de dicha selección
-        # los pozos a una distancia de 375  metros.
-        amazonia_noaa_21_lyr = "amazonia_noaa_21_lyr"
-        arcpy.MakeFeatureLayer_management(amazonia_nasa_lyr, amazonia_noaa_21_lyr, "INSTRUMENT = 'VIIRS_NOAA_21'")
-        arcpy.SelectLayerByLocation_management(amazonia_noaa_lyr, "INTERSECT", feature_hidrocarburos,
-                                               "375 Meters", "REMOVE_FROM_SELECTION", "NOT_INVERT")
-
-        # Nuevo modelo: Se copian datos filtrados en el feature amazonia_noaa_without_pozos_lyr
-        amazonia_noaa_21_without_pozos_lyr = "amazonia_noaa_21_without_pozos_lyr"
-        arcpy.CopyFeatures_management(amazonia_noaa_21_lyr, amazonia_noaa_21_without_pozos_lyr, "", "0", "0", "0")
+        stage_start = time.time()
+        if data.get('clip_mode', 'clip') == 'index':
+            clip_points_with_index(data, continental_sirgas_lyr, amazonia_nasa_lyr)
+        else:
+            arcpy.Clip_analysis(continental_sirgas_lyr, feature_dlim, amazonia_nasa_lyr, "")
+        record_stage_time(data, 'recorte', stage_start)
+        stage_start = time.time()
 
         #######################################################################################
-        #######################################################################################
-        # Se realiza merge de las dos selecciones
-        # amazonia_modis_without_pozos_lyr, amazonia_vpn_without_pozos_lyr
-        # se copia el resultado en amazonia_without_pozos_lyr
+        # Se seleccionan los datos de amazonia_nasa_lyr por instrumento, se remueven de la
+        # selección los puntos a menos de la distancia de exclusión de los pozos (1000 metros
+        # MODIS, 375 metros VIIRS) y se unen los resultados en amazonia_without_pozos_lyr
         amazonia_without_pozos_lyr = "amazonia_without_pozos_lyr"
-        arcpy.Merge_management([amazonia_modis_without_pozos_lyr, amazonia_vpn_without_pozos_lyr,
-                                amazonia_noaa_without_pozos_lyr, amazonia_noaa_21_without_pozos_lyr],
-                               amazonia_without_pozos_lyr, "")
+        exclude_pozos(data, amazonia_nasa_lyr, amazonia_without_pozos_lyr)
 
         # se adiciona el campo FECHA_DESC de tipo string y se le asignan los valores
         # según la siguiente expresión: "def getFecha(): return time.strftime("%d/%m/%Y")"
@@ -986,6 +3473,7 @@ def process_data(data):
         codeblock = """def getFecha():
     return time.strftime("%d/%m/%Y %H:%M:%S")"""
         arcpy.CalculateField_management(amazonia_without_pozos_lyr, "FECHA_DATE", expression, "PYTHON3", codeblock)
+        record_stage_time(data, 'pozos', stage_start)
 
         #########################################################################################
 
@@ -994,73 +3482,16 @@ def process_data(data):
 
         logging.debug("** intersect... {} and {} , output: {}".format(feature_union_ent_ref, amazonia_without_pozos_lyr, fuegos_union_ent_ref_lyr ))
 
-        arcpy.Intersect_analysis([feature_union_ent_ref, amazonia_without_pozos_lyr],
-                                 fuegos_union_ent_ref_lyr, "NO_FID", "", "INPUT")
-
-        #########################################################################################
-        #########################################################################################
-        # convertir fechas y filtrar exclusivamente 24 horas
-        '''
-        acq_date	timestamp without time zone
-        acq_time	character varying
-
-        acq_col	timestamp without time zone
-        acq_day_col	integer
-        acq_month_col	integer
-        acq_year_col	integer
-        acq_hour_col	integer
-        '''
-        arcpy.AddField_management(fuegos_union_ent_ref_lyr, "acq_col", "DATE")
-        arcpy.AddField_management(fuegos_union_ent_ref_lyr, "acq_day_col", "SHORT")
-        arcpy.AddField_management(fuegos_union_ent_ref_lyr, "acq_month_col", "SHORT")
-        arcpy.AddField_management(fuegos_union_ent_ref_lyr, "acq_year_col", "SHORT")
-        arcpy.AddField_management(fuegos_union_ent_ref_lyr, "acq_hour_col", "SHORT")
-
-        fields = ['acq_date', 'acq_time', 'acq_col', 'acq_day_col', 'acq_month_col', 'acq_year_col', 'acq_hour_col']
-
-        tz = pytz.timezone('America/Bogota')
-        logging.debug(datetime.datetime.now())
-        max_hours = 24
-        logging.debug("max_hours: {} ".format(max_hours))
-        # To get data for specific date use this:
-        # specific_date = datetime.datetime(2024, 3, 12, 0, 3)
-        # min_date = specific_date  - datetime.timedelta(hours=max_hours, minutes=0)
-        min_date = datetime.datetime.now() - datetime.timedelta(hours=max_hours, minutes=0)
-        min_date = tz.localize(min_date)
-        logging.debug("min_date: {} ".format(min_date))
-
-        with arcpy.da.UpdateCursor(fuegos_union_ent_ref_lyr, fields) as cursor:
-            for row in cursor:
-                #logging.debug("**********************")
-                # logging.debug(row[0])
-                # logging.debug(row[1])
-
-                # sensor_date_str =  "{}-{}-{} {}:{}".format( row[0].year, row[0].month, row[0].day ,    row[1][0:2] ,  row[1][2:4]   )
-                # logging.debug(sensor_date_str)
-                # datetime(year, month, day, hour, minute, second, microsecond)
-                sensor_date = datetime.datetime(row[0].year, row[0].month, row[0].day, int(row[1][0:2]),
-                                                int(row[1][2:4]), 0, 0)
-                #logging.debug("sensor_date: {} ".format(sensor_date))
-
-                col_date = pytz.utc.localize(sensor_date).astimezone(tz)
-                # logging.debug(utc_time)
-                #logging.debug("col_date: {} ".format(col_date))
-                #logging.debug(min_date < col_date)
-
-                if min_date >= col_date:
-                    #logging.debug("col_date is older than min_date. Ignore row. ")
-                    cursor.deleteRow()
-                else:
-                    #logging.debug("col_date is newer than min_date. Include row. ")
-                    row[2] = col_date
-                    row[3] = col_date.day
-                    row[4] = col_date.month
-                    row[5] = col_date.year
-                    row[6] = col_date.hour
-                    cursor.updateRow(row)
-
-        #########################################################################################
-        #########################################################################################
+        stage_start = time.time()
+        attribution_mode = data.get('attribution_mode', 'intersect')
+        if attribution_mode == 'index':
+            attribute_points_with_index(data, amazonia_without_pozos_lyr, fuegos_union_ent_ref_lyr)
+        elif attribution_mode == 'raster':
+            attribute_points_with_raster(data, amazonia_without_pozos_lyr, fuegos_union_ent_ref_lyr)
+        else:
+            arcpy.Intersect_analysis([feature_union_ent_ref, amazonia_without_pozos_lyr],
+                                     fuegos_union_ent_ref_lyr, "NO_FID", "", "INPUT")
+        record_stage_time(data, 'interseccion', stage_start)
 
         data['feature_fuegos'] = fuegos_union_ent_ref_lyr
 
@@ -1074,30 +3505,23 @@ def process_data(data):
         logging.debug("**********************************************************")
         logging.debug("** DELETE DUPLICADED ROWS FROM SOURCE DATA (NASA)... ")
         logging.debug("**********************************************************")
+        stage_start = time.time()
         result = int(arcpy.GetCount_management(fuegos_union_ent_ref_lyr)[0])
         logging.debug(' Layer: {}'.format(fuegos_union_ent_ref_lyr))
         logging.debug(' Total rows before deletion of duplicated data:  {} '.format(result))
         data['total_fuegos'] = result
 
-        fields = ['LATITUDE', 'LONGITUDE', 'BRIGHTNESS', 'SCAN', 'TRACK'
-            , 'ACQ_DATE', 'ACQ_TIME', 'SATELLITE', 'VERSION'
-            , 'BRIGHT_T31', 'FRP', 'DAYNIGHT', 'INSTRUMENT'
-            , 'BRIGHT_TI4', 'BRIGHT_TI5']
-
-        # AVera - 20231211, Debido a que cuando pueda falta un sensor algunos campos no estaria disponibles
-        # Se crea este proceso para que identifique los campos faltantes y los cree con valor nulo y no se modifique la logica posterior
-        field_list = [field.name for field in arcpy.ListFields(fuegos_union_ent_ref_lyr)]
-        lista_campos_faltantes = list(set(fields) - set(field_list))
-        for field in lista_campos_faltantes:
-            arcpy.AddField_management(fuegos_union_ent_ref_lyr, field, "TEXT")
-
-        arcpy.FindIdentical_management(fuegos_union_ent_ref_lyr, "fuegos_union_ent_ref_lyr_duplicated", fields)
-
-        arcpy.DeleteIdentical_management(fuegos_union_ent_ref_lyr, fields)
+        # Los campos que no existen cuando falta un sensor se toman como nulos en la llave
+        # (deduplicate_detections), ya no se agregan a la capa
+        duplicates = deduplicate_detections(fuegos_union_ent_ref_lyr, data.get('detection_id', False))
+        data['duplicates_by_instrument'] = {str(instrument): count for instrument, count in duplicates.items()}
+        logging.info("Registros repetidos de NASA borrados: {} {}".format(sum(duplicates.values()),
+                                                                          data['duplicates_by_instrument']))
 
         result = int(arcpy.GetCount_management(fuegos_union_ent_ref_lyr)[0])
         logging.debug(' Total rows AFTER deletion of duplicated data: : {} '.format(result))
         data['total_fuegos'] = result
+        record_stage_time(data, 'duplicados', stage_start)
         logging.debug("**********************************************************")
 
         #########################################################################################
@@ -1122,9 +3546,9 @@ def process_data(data):
         logging.debug("**********************************************************")
         logging.debug("** VALIDATE EXISTING RECORDS... **")
         logging.debug("**********************************************************")
+        stage_start = time.time()
 
         edit_conn = data['edit_conn_prod_instance']
-        table_name = 'e2_modfun.CFgoHis_Car_Mun_Dep_Elt_Pai'
 
         duplicated_lyr = 'duplicated_lyr'
         feature_output_prod = data['feature_output_prod']
@@ -1135,63 +3559,50 @@ def process_data(data):
             , 'FRP', 'DAYNIGHT', 'INSTRUMENT', 'BRIGHT_TI4', 'BRIGHT_TI5']
 
         deleted_rows = 0
-        #logging.debug("using test data: {}".format(data["is_test"]))
-        if not data["is_test"]:
-            egdb_conn = arcpy.ArcSDESQLExecute(edit_conn)
-        with arcpy.da.UpdateCursor(fuegos_union_ent_ref_lyr, fields) as cursor:
-            for row in cursor:
-                #logging.debug('{0}, {1}, {2}, {3}, {4}'.format(row[0], row[1], row[2], row[3], row[4]))
-                id = row[0]
-                aq_date = " TO_DATE ( '" + row[6].strftime("%Y/%m/%d") + "', 'YYYY/MM/DD' ) "
-                brigthness = ""
-                if row[3] is None:
-                    brigthness = " is NULL"
-                else:
-                    brigthness = " = " + str(row[3])
-
-                bright_t31 = ""
-                if row[10] is None:
-                    bright_t31 = " is NULL"
-                else:
-                    bright_t31 = " = " + str(row[10])
-
-                bright_ti4 = ""
-                if row[14] is None:
-                    bright_ti4 = " is NULL"
-                else:
-                    bright_ti4 = " = " + str(row[14])
-
-                bright_ti5 = ""
-                if row[15] is None:
-                    bright_ti5 = " is NULL"
-                else:
-                    bright_ti5 = " = " + str(row[15])
-
-                where = ''' LATITUDE = {} AND LONGITUDE = {} and BRIGHTNESS  {} and  SCAN = {}  and TRACK = {}
-                    and ACQ_DATE =  {}  and ACQ_TIME = '{}' and  SATELLITE = '{}'  and VERSION = '{}'  and  BRIGHT_T31   {} 
-                    and FRP = {}  and DAYNIGHT = '{}' and  INSTRUMENT = '{}' and BRIGHT_TI4  {}  and BRIGHT_TI5  {} 
-                    '''.format(row[1], row[2], brigthness, row[4], row[5], aq_date, row[7]
-                               , row[8], row[9], bright_t31, row[11], row[12], row[13], bright_ti4, bright_ti5)
-
-                #logging.debug(" id: {}   ".format(id))
-
-                sql = '''   
-                    SELECT COUNT(*) AS f_count FROM {} where {}   
-                    '''.format(table_name, where)
-                #logging.debug("sql:    {}  ".format(sql))
-                if not data["is_test"]:
-                    egdb_return = egdb_conn.execute(sql)
-                    #logging.debug(' #  of existing records : {}'.format(egdb_return))
-                    if egdb_return > 0:
-                        #logging.debug(' Row already exists in DB  id : {} '.format(id))
-                        logging.debug("sql:    {}  ".format(sql))
-                        cursor.deleteRow()
-                        deleted_rows += 1
+        historical_check_mode = data.get('historical_check_mode', 'sql')
+        if data.get('detection_id_backfill', False):
+            logging.warning("detection_id_backfill fue reemplazada por detection_id_migrate y se ignora")
+        if data.get('detection_id_migrate', False):
+            migrate_detection_ids(data)
+        if data.get('detection_id', False):
+            ensure_detection_id_fields(data)
+        if historical_check_mode == 'id':
+            if not data.get('detection_id', False):
+                raise Exception("historical_check_mode = id requiere detection_id = true")
+            if detection_ids_ready(feature_output_prod):
+                deleted_rows = delete_existing_by_id(fuegos_union_ent_ref_lyr, feature_output_prod)
+            else:
+                logging.warning("{} tiene registros sin {} (ejecutar con detection_id_migrate = true), "
+                                "se valida por llave (batch)".format(feature_output_prod, DETECTION_ID_FIELD))
+                deleted_rows = delete_existing_detections(fuegos_union_ent_ref_lyr, feature_output_prod)
+        elif historical_check_mode == 'batch':
+            deleted_rows = delete_existing_detections(fuegos_union_ent_ref_lyr, feature_output_prod)
+        elif historical_check_mode == 'index':
+            deleted_rows = delete_indexed_detections(data, fuegos_union_ent_ref_lyr, feature_output_prod)
+        else:
+            #logging.debug("using test data: {}".format(data["is_test"]))
+            if not data["is_test"]:
+                egdb_conn = arcpy.ArcSDESQLExecute(edit_conn)
+            with arcpy.da.UpdateCursor(fuegos_union_ent_ref_lyr, fields) as cursor:
+                for row in cursor:
+                    #logging.debug('{0}, {1}, {2}, {3}, {4}'.format(row[0], row[1], row[2], row[3], row[4]))
+                    sql = build_historical_count_sql(HISTORICAL_TABLE_NAME, row)
+                    #logging.debug("sql:    {}  ".format(sql))
+                    if not data["is_test"]:
+                        egdb_return = egdb_conn.execute(sql)
+                        #logging.debug(' #  of existing records : {}'.format(egdb_return))
+                        if egdb_return > 0:
+                            #logging.debug(' Row already exists in DB  id : {} '.format(id))
+                            logging.debug("sql:    {}  ".format(sql))
+                            cursor.deleteRow()
+                            deleted_rows += 1
 
         logging.debug("Total rows before validation : {} ".format(data['total_fuegos']))
         total_after_validation = int(arcpy.GetCount_management(fuegos_union_ent_ref_lyr)[0])
         logging.debug('Total rows  to append after validation : {}, deleted: {} '.format(total_after_validation, deleted_rows))
+        record_stage_time(data, 'validacion_historica', stage_start)
 
+        stage_start = time.time()
         if total_after_validation > 0:
             #########################################################################################
             #########################################################################################
@@ -1234,9 +3645,26 @@ def process_data(data):
             logging.debug('{} has {} records after append'.format(feature_output_pub_sirgas, result_sirgas_out))
             if result != expected_new_total_fuegos_pub:
                 raise Exception("No se pudieron adicionar nuevos registros a {} ".format(feature_output_pub))
+
+        # El índice local del histórico refleja lo que quedó en layer_output_prod
+        if historical_check_mode == 'index' and not data["is_test"] and total_after_validation > 0:
+            add_to_historical_index(data, fuegos_union_ent_ref_lyr)
+        record_stage_time(data, 'append', stage_start)
+
+        # La marca de agua solo avanza cuando el append a producción terminó sin errores; en
+        # modo prueba no se carga producción y la siguiente ejecución real no debe saltarse
+        # esas detecciones
+        if incremental_mode:
+            if data["is_test"]:
+                logging.info("is_test: no se actualiza la marca de agua ({})".format(new_watermark))
+            else:
+                save_watermark(data, new_watermark)
+                data['watermark'] = new_watermark
     except Exception as e:
         print_error(e)
         raise Exception('ERROR_004 - Error al procesar Datos : {} '.format(e))
+    finally:
+        log_stage_timings(data)
 
     logging.debug("***********************************")
 
@@ -1447,16 +3875,18 @@ def get_last_portion(text):
 
 
 '''
-    Borra registros de la capa para una fecha en particular
+    Borra registros de la capa para una fecha en particular. Se usa el rango del día completo
+    (igual que la llave canónica, que compara ACQ_DATE por día) para que los registros con
+    hora distinta de 00:00:00 también se borren
 '''
 def deleteRows(feature_class, fecha_campo, fecha_obj):
     logging.debug("deleting rows in {}... field: {}, date: {}".format(feature_class, fecha_campo, fecha_obj.strftime("%Y-%m-%d")))
 
-    sql_expr = "{} = date '{}-{}-{} 00:00:00'".format(
+    fecha = canonical_date(fecha_obj)
+    sql_expr = "{0} >= date '{1} 00:00:00' AND {0} < date '{2} 00:00:00'".format(
         arcpy.AddFieldDelimiters(feature_class, fecha_campo),
-        fecha_obj.year,
-        str(fecha_obj.month).zfill(2),
-        str(fecha_obj.day).zfill(2)
+        fecha.strftime("%Y-%m-%d"),
+        (fecha + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
     )
 
     try:
@@ -1580,11 +4010,17 @@ def main(data):
             layer_output_pub = "\\" + get_last_portion(layer_output_pub)
             layer_output_pub_sirgas = "\\" + get_last_portion(layer_output_pub_sirgas)
 
-        fecha_actual = datetime.datetime.now()
-        fecha_anterior = fecha_actual - datetime.timedelta(days=1)
-        deleteRows(layer_output_prod, "acq_date", fecha_anterior)
-        deleteRows(layer_output_pub, "acq_date", fecha_anterior)
-        deleteRows(layer_output_pub_sirgas, "acq_date", fecha_anterior)
+        # En modo incremental no se borra el día anterior, solo se agregan las detecciones nuevas
+        if data.get('incremental_mode', False):
+            logging.info("incremental_mode: no se borran los registros del día anterior")
+        else:
+            fecha_actual = datetime.datetime.now()
+            fecha_anterior = fecha_actual - datetime.timedelta(days=1)
+            deleteRows(layer_output_prod, "acq_date", fecha_anterior)
+            deleteRows(layer_output_pub, "acq_date", fecha_anterior)
+            deleteRows(layer_output_pub_sirgas, "acq_date", fecha_anterior)
+            if data.get('historical_check_mode', 'sql') == 'index':
+                delete_historical_index_date(data, fecha_anterior)
     except Exception as e:
         print_error(e)
         to = list(data["admin_emails"])
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Comparación de los modos de atribución de detecciones (attribution_mode)
+Requiere: Python 3 + ArcGIS Pro
+
+Este script:
+1. Lee config/config.json y usa la capa layer_union_ent_ref de la geodatabase de pruebas
+   (local_gdb) o de la conexión SDE indicada
+2. Atribuye una capa de puntos (por ejemplo amazonia_without_pozos_lyr de una ejecución con
+   keep_intermediates) con Intersect_analysis, con el índice STR y con el raster de
+   identificadores, para cada tamaño de celda indicado
+3. Reporta los tiempos (con y sin construcción de índices) y verifica que los tres modos
+   produzcan el mismo número de registros
+
+Uso:
+    python benchmark_atribucion.py <capa_puntos> [tamaño_celda ...] [--sde <conexion.sde>]
+
+Autor: Sistema SIATAC - Instituto SINCHI
+"""
+
+import arcpy
+import os
+import sys
+import json
+import shutil
+import tempfile
+import time
+import logging
+
+import Fuegos
+
+
+def timed(function, *args):
+    """Ejecuta function y retorna (segundos, resultado)"""
+    start = time.time()
+    result = function(*args)
+    return round(time.time() - start, 3), result
+
+
+def run_mode(data, mode, points_fc, output_name):
+    """Atribuye points_fc con el modo indicado, retorna (segundos, registros)"""
+    if arcpy.Exists(output_name):
+        arcpy.Delete_management(output_name)
+    if mode == 'intersect':
+        seconds, _ = timed(arcpy.Intersect_analysis, [data['feature_union_ent_ref'], points_fc],
+                           output_name, "NO_FID", "", "INPUT")
+    elif mode == 'index':
+        seconds, _ = timed(Fuegos.attribute_points_with_index, data, points_fc, output_name)
+    else:
+        seconds, _ = timed(Fuegos.attribute_points_with_raster, data, points_fc, output_name)
+    return seconds, int(arcpy.GetCount_management(output_name)[0])
+
+
+def main():
+    """Función principal"""
+    args = sys.argv[1:]
+    if not args:
+        print(__doc__)
+        sys.exit(1)
+    sde_conn = None
+    if '--sde' in args:
+        position = args.index('--sde')
+        sde_conn = args[position + 1]
+        del args[position:position + 2]
+    points_fc = args[0]
+    cell_sizes = [float(value) for value in args[1:]] or [0.01]
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(script_dir, 'config', 'config.json')) as f:
+        data = json.load(f)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    layer = data['layer_union_ent_ref']
+    if sde_conn:
+        data['feature_union_ent_ref'] = sde_conn + layer
+    else:
+        data['feature_union_ent_ref'] = os.path.join(data['local_gdb'], Fuegos.get_last_portion(layer))
+
+    # Índices en una carpeta temporal para medir también su construcción
+    data['temp_dir'] = tempfile.mkdtemp(prefix='benchmark_atribucion_')
+    data['index_cache_dir'] = os.path.join(data['temp_dir'], 'cache_indices')
+    arcpy.env.workspace = "memory"
+    arcpy.env.overwriteOutput = True
+
+    points = int(arcpy.GetCount_management(points_fc)[0])
+    references = int(arcpy.GetCount_management(data['feature_union_ent_ref'])[0])
+    logging.info("=" * 80)
+    logging.info(f"Puntos: {points_fc} ({points} registros)")
+    logging.info(f"Entidades de referencia: {data['feature_union_ent_ref']} ({references} polígonos)")
+    logging.info("=" * 80)
+
+    results = []
+    try:
+        seconds, count = run_mode(data, 'intersect', points_fc, 'bench_intersect')
+        results.append(('intersect', '', seconds, count))
+
+        # Primera ejecución construye el índice, la segunda lo lee de la cache
+        for run in ('construcción', 'cache'):
+            seconds, count = run_mode(data, 'index', points_fc, 'bench_index')
+            results.append(('index', run, seconds, count))
+
+        for cell_size in cell_sizes:
+            data['attribution_raster_cell_size'] = cell_size
+            for run in ('construcción', 'cache'):
+                seconds, count = run_mode(data, 'raster', points_fc, 'bench_raster')
+                results.append((f'raster {cell_size}', run, seconds, count))
+    finally:
+        shutil.rmtree(data['temp_dir'], ignore_errors=True)
+
+    logging.info("-" * 80)
+    logging.info(f"{'modo':<20}{'ejecución':<15}{'segundos':>10}{'registros':>12}")
+    for mode, run, seconds, count in results:
+        logging.info(f"{mode:<20}{run:<15}{seconds:>10}{count:>12}")
+    expected = results[0][3]
+    different = [result for result in results if result[3] != expected]
+    if different:
+        logging.warning(f"[ADVERTENCIA] {len(different)} ejecuciones no coinciden con Intersect_analysis ({expected})")
+    else:
+        logging.info(f"[OK] Todos los modos producen {expected} registros")
+
+
+if __name__ == "__main__":
+    main()
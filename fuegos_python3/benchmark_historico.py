@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Comparación de los modos de validación contra el histórico (historical_check_mode)
+Requiere: Python 3 + ArcGIS Pro
+
+Este script:
+1. Lee config/config.json y crea las conexiones SDE (o usa local_gdb si is_test = true)
+2. Arma lotes de registros candidatos de 1.000, 10.000 y 100.000 filas (o los tamaños
+   indicados), la mitad tomados de layer_output_prod (existentes) y la otra mitad con la
+   latitud desplazada (nuevos)
+3. Mide para cada lote:
+   - sql: un SELECT COUNT(*) por registro con ArcSDESQLExecute (solo las primeras
+     --sql-max filas, el resto se estima de forma lineal)
+   - batch: un SearchCursor sobre layer_output_prod en el rango de ACQ_DATE
+   - index: consulta al índice SQLite de llaves (la construcción se reporta aparte)
+
+Uso:
+    python benchmark_historico.py [tamaño ...] [--sql-max 1000]
+
+Autor: Sistema SIATAC - Instituto SINCHI
+"""
+
+import arcpy
+import os
+import sys
+import json
+import shutil
+import tempfile
+import time
+import logging
+
+import Fuegos
+
+
+def read_candidates(feature_output_prod, size):
+    """Lee hasta size/2 registros recientes del histórico y agrega otros tantos desplazados"""
+    fields, positions = Fuegos.get_key_field_positions(feature_output_prod)
+    acq_date_field = fields[positions[Fuegos.DETECTION_KEY_FIELDS.index('ACQ_DATE')]]
+    rows = []
+    with arcpy.da.SearchCursor(feature_output_prod, ['OID@'] + fields,
+                               sql_clause=(None, f'ORDER BY {acq_date_field} DESC')) as cursor:
+        for row in cursor:
+            rows.append([row[0]] + [row[1 + position] if position is not None else None for position in positions])
+            if len(rows) >= size // 2:
+                break
+    if not rows:
+        raise Exception(f"No hay registros en {feature_output_prod}")
+    latitude = 1 + Fuegos.DETECTION_KEY_FIELDS.index('LATITUDE')
+    new_rows = []
+    while len(rows) + len(new_rows) < size:
+        row = list(rows[len(new_rows) % len(rows)])
+        row[latitude] = (row[latitude] or 0) + 0.00001 * (1 + len(new_rows) // len(rows))
+        new_rows.append(row)
+    return rows + new_rows
+
+
+def date_range(rows):
+    dates = [row[1 + Fuegos.DETECTION_KEY_FIELDS.index('ACQ_DATE')] for row in rows]
+    return min(dates), max(dates)
+
+
+def bench_sql(edit_conn, rows, sql_max):
+    """Segundos del loop por registro, estimados para todas las filas a partir de sql_max"""
+    egdb_conn = arcpy.ArcSDESQLExecute(edit_conn)
+    sample = rows[:sql_max]
+    start = time.time()
+    found = sum(1 for row in sample if egdb_conn.execute(
+        Fuegos.build_historical_count_sql(Fuegos.HISTORICAL_TABLE_NAME, row)) > 0)
+    seconds = time.time() - start
+    return seconds * len(rows) / len(sample), found * len(rows) // len(sample), len(sample) < len(rows)
+
+
+def bench_batch(feature_output_prod, rows):
+    positions = list(range(1, 1 + len(Fuegos.DETECTION_KEY_FIELDS)))
+    start = time.time()
+    existing = Fuegos.load_historical_keys(feature_output_prod, *date_range(rows))
+    found = sum(1 for row in rows if Fuegos.canonical_key(row, positions) in existing)
+    return time.time() - start, found
+
+
+def bench_index(data, rows):
+    positions = list(range(1, 1 + len(Fuegos.DETECTION_KEY_FIELDS)))
+    conn = Fuegos.open_historical_index(data)
+    try:
+        start = time.time()
+        existing = Fuegos.load_index_keys(conn, *date_range(rows))
+        found = sum(1 for row in rows if Fuegos.key_to_text(Fuegos.canonical_key(row, positions)) in existing)
+        return time.time() - start, found
+    finally:
+        conn.close()
+
+
+def main():
+    """Función principal"""
+    args = sys.argv[1:]
+    sql_max = 1000
+    if '--sql-max' in args:
+        position = args.index('--sql-max')
+        sql_max = int(args[position + 1])
+        del args[position:position + 2]
+    sizes = [int(value) for value in args] or [1000, 10000, 100000]
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(script_dir, 'config', 'config.json')) as f:
+        data = json.load(f)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    data['temp_dir'] = tempfile.mkdtemp(prefix='benchmark_historico_')
+    data['current_day_temp_dir'] = data['temp_dir']
+    data['index_cache_dir'] = os.path.join(data['temp_dir'], 'cache_indices')
+    layer = data['layer_output_prod']
+    if data['is_test']:
+        edit_conn = data['local_gdb']
+        layer = "\\" + Fuegos.get_last_portion(layer)
+    else:
+        Fuegos.create_sde_connections(data)
+        edit_conn = data['edit_conn_prod_instance']
+    feature_output_prod = edit_conn + layer
+
+    results = []
+    try:
+        conn = Fuegos.open_historical_index(data)
+        start = time.time()
+        Fuegos.reconcile_historical_index(conn, feature_output_prod)
+        conn.close()
+        logging.info(f"Construcción del índice SQLite: {round(time.time() - start, 2)} segundos")
+
+        for size in sizes:
+            rows = read_candidates(feature_output_prod, size)
+            if not data['is_test']:
+                seconds, found, estimated = bench_sql(edit_conn, rows, sql_max)
+                results.append((len(rows), 'sql (estimado)' if estimated else 'sql', seconds, found))
+            seconds, found = bench_batch(feature_output_prod, rows)
+            results.append((len(rows), 'batch', seconds, found))
+            seconds, found = bench_index(data, rows)
+            results.append((len(rows), 'index', seconds, found))
+    finally:
+        shutil.rmtree(data['temp_dir'], ignore_errors=True)
+
+    logging.info("-" * 80)
+    logging.info(f"{'filas':>10}  {'modo':<16}{'segundos':>12}{'ms/fila':>10}{'existentes':>12}")
+    for size, mode, seconds, found in results:
+        logging.info(f"{size:>10}  {mode:<16}{round(seconds, 3):>12}{round(1000 * seconds / size, 4):>10}{found:>12}")
+
+
+if __name__ == "__main__":
+    main()
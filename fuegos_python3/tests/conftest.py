@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""
+Configuración de pytest para las pruebas de Fuegos.py
+
+arcpy solo existe en ArcGIS Pro, las pruebas cubren las funciones de numpy y de lectura de
+archivos que no lo usan, por lo que se reemplaza por un MagicMock antes de importar Fuegos.
+"""
+
+import os
+import sys
+from unittest import mock
+
+if 'arcpy' not in sys.modules:
+    arcpy = mock.MagicMock()
+    sys.modules['arcpy'] = arcpy
+    sys.modules['arcpy.env'] = arcpy.env
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Pruebas de la ventana de 24 horas de filter_acquisition_window (get_reference_date,
+get_min_acq_date, get_acquisition_dates, get_acquisition_window_mask, get_date_parts y
+get_watermark_cutoffs)
+
+Los casos de borde (cambio de día, mes y año al pasar a hora de Colombia, límites exactos de
+la ventana) se comparan con valores calculados a mano y los casos al azar con la conversión
+de zona horaria de pytz registro por registro.
+"""
+
+import datetime
+
+import numpy as np
+import pytest
+import pytz
+
+import Fuegos
+
+
+BOGOTA = pytz.timezone('America/Bogota')
+
+
+def as_datetimes(values):
+    return [None if value is None else value.astype(datetime.datetime) for value in values]
+
+
+def test_get_reference_date():
+    assert Fuegos.get_reference_date({}) is None
+    assert Fuegos.get_reference_date({'reference_date': None}) is None
+    assert Fuegos.get_reference_date({'reference_date': '2024-03-01 06:30'}) == datetime.datetime(2024, 3, 1, 6, 30)
+    assert Fuegos.get_reference_date({'reference_date': '2024-03-01'}) == datetime.datetime(2024, 3, 1)
+    with pytest.raises(Exception, match='reference_date'):
+        Fuegos.get_reference_date({'reference_date': '01/03/2024'})
+
+
+def test_get_min_acq_date():
+    min_date = Fuegos.get_min_acq_date(BOGOTA, 24, datetime.datetime(2024, 3, 1, 6, 30))
+    assert min_date.replace(tzinfo=None) == datetime.datetime(2024, 2, 29, 6, 30)
+    assert min_date.utcoffset() == datetime.timedelta(hours=-5)
+    # Sin reference_date la ventana termina en el momento de la ejecución
+    before = datetime.datetime.now() - datetime.timedelta(hours=24)
+    min_date = Fuegos.get_min_acq_date(BOGOTA).replace(tzinfo=None)
+    assert before <= min_date <= datetime.datetime.now() - datetime.timedelta(hours=24)
+
+
+@pytest.mark.parametrize('acq_date, acq_time, utc, colombia', [
+    # Cambio de día: antes de las 05:00 UTC todavía es el día anterior en Colombia
+    (datetime.datetime(2024, 3, 5), '0459', '2024-03-05T04:59', '2024-03-04T23:59'),
+    (datetime.datetime(2024, 3, 5), '0500', '2024-03-05T05:00', '2024-03-05T00:00'),
+    # Cambio de mes en año bisiesto y cambio de año
+    (datetime.datetime(2024, 3, 1), '0001', '2024-03-01T00:01', '2024-02-29T19:01'),
+    (datetime.datetime(2023, 3, 1), '0300', '2023-03-01T03:00', '2023-02-28T22:00'),
+    (datetime.datetime(2024, 1, 1), '0000', '2024-01-01T00:00', '2023-12-31T19:00'),
+    (datetime.datetime(2023, 12, 31), '2359', '2023-12-31T23:59', '2023-12-31T18:59'),
+    # ACQ_TIME sin ceros a la izquierda, vacío o no numérico
+    (datetime.datetime(2024, 3, 5), '5', '2024-03-05T00:05', '2024-03-04T19:05'),
+    (datetime.datetime(2024, 3, 5), '105', '2024-03-05T01:05', '2024-03-04T20:05'),
+    (datetime.datetime(2024, 3, 5), None, '2024-03-05T00:00', '2024-03-04T19:00'),
+    (datetime.datetime(2024, 3, 5), 'xx', '2024-03-05T00:00', '2024-03-04T19:00'),
+    # ACQ_DATE con hora (campo DATE de la geodatabase): solo cuenta el día
+    (datetime.datetime(2024, 3, 5, 13, 45), '0600', '2024-03-05T06:00', '2024-03-05T01:00'),
+])
+def test_get_acquisition_dates_boundaries(acq_date, acq_time, utc, colombia):
+    sensor_date, col_date = Fuegos.get_acquisition_dates([acq_date], [acq_time])
+    assert sensor_date.dtype == np.dtype('datetime64[m]')
+    assert str(sensor_date[0]) == utc
+    assert str(col_date[0]) == colombia
+
+
+def test_get_date_parts_boundaries():
+    col_date = np.array(['2024-02-29T19:01', '2023-12-31T23:59', '2024-01-01T00:00', '2024-03-01T00:00'],
+                        dtype='datetime64[m]')
+    days, months, years, hours = Fuegos.get_date_parts(col_date)
+    assert days.tolist() == [29, 31, 1, 1]
+    assert months.tolist() == [2, 12, 1, 3]
+    assert years.tolist() == [2024, 2023, 2024, 2024]
+    assert hours.tolist() == [19, 23, 0, 0]
+
+
+def test_get_acquisition_window_mask_limits():
+    reference_date = datetime.datetime(2024, 3, 1, 6, 30)
+    min_date = Fuegos.get_min_acq_date(BOGOTA, 24, reference_date)
+    col_date = np.array(['2024-02-29T06:29', '2024-02-29T06:30', '2024-02-29T06:31', '2024-03-01T06:30',
+                         '2024-03-01T06:31'], dtype='datetime64[m]')
+    # min_date queda por fuera y reference_date por dentro
+    assert Fuegos.get_acquisition_window_mask(col_date, min_date, reference_date).tolist() == [
+        False, False, True, True, False]
+    assert Fuegos.get_acquisition_window_mask(col_date, min_date).tolist() == [False, False, True, True, True]
+
+
+def test_window_from_utc_acquisitions():
+    # reference_date 2024-03-01 (medianoche de Colombia): la ventana en UTC va de
+    # 2024-02-29 05:00 (excluida) a 2024-03-01 05:00 (incluida)
+    reference_date = Fuegos.get_reference_date({'reference_date': '2024-03-01'})
+    min_date = Fuegos.get_min_acq_date(BOGOTA, 24, reference_date)
+    acq_dates = [datetime.datetime(2024, 2, 29)] * 2 + [datetime.datetime(2024, 3, 1)] * 3
+    acq_times = ['0500', '0501', '0000', '0500', '0501']
+    sensor_date, col_date = Fuegos.get_acquisition_dates(acq_dates, acq_times)
+    assert Fuegos.get_acquisition_window_mask(col_date, min_date, reference_date).tolist() == [
+        False, True, True, True, False]
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_window_matches_pytz(seed):
+    rng = np.random.default_rng(seed)
+    reference_date = datetime.datetime(2024, 3, 1, 4, 0) + datetime.timedelta(minutes=int(rng.integers(0, 60 * 24 * 40)))
+    min_date = Fuegos.get_min_acq_date(BOGOTA, 24, reference_date)
+    base = reference_date - datetime.timedelta(hours=36)
+    utc_dates = [base + datetime.timedelta(minutes=int(minutes)) for minutes in rng.integers(0, 60 * 48, 3000)]
+    acq_dates = [datetime.datetime(value.year, value.month, value.day) for value in utc_dates]
+    acq_times = ['{:d}{:02d}'.format(value.hour, value.minute) for value in utc_dates]
+
+    sensor_date, col_date = Fuegos.get_acquisition_dates(acq_dates, acq_times)
+    keep = Fuegos.get_acquisition_window_mask(col_date, min_date, reference_date)
+
+    expected_col = [pytz.utc.localize(value).astimezone(BOGOTA) for value in utc_dates]
+    assert as_datetimes(sensor_date) == utc_dates
+    assert as_datetimes(col_date) == [value.replace(tzinfo=None) for value in expected_col]
+    expected_keep = [min_date < value <= BOGOTA.localize(reference_date) for value in expected_col]
+    assert keep.tolist() == expected_keep
+    assert 0 < sum(expected_keep) < len(expected_keep)
+
+    days, months, years, hours = Fuegos.get_date_parts(col_date)
+    assert list(zip(days.tolist(), months.tolist(), years.tolist(), hours.tolist())) == [
+        (value.day, value.month, value.year, value.hour) for value in expected_col]
+
+
+def test_get_watermark_cutoffs():
+    cutoffs = Fuegos.get_watermark_cutoffs({'watermark_overlap_minutes': 90},
+                                           {'MODIS': '2024-03-01 00:30', 'VIIRS_NOAA_21': '2024-01-01 01:00'})
+    assert cutoffs == {'MODIS': datetime.datetime(2024, 2, 29, 23, 0),
+                       'VIIRS_NOAA_21': datetime.datetime(2023, 12, 31, 23, 30)}
+    assert Fuegos.get_watermark_cutoffs({}, {'MODIS': '2024-03-01 00:30'}) == {
+        'MODIS': datetime.datetime(2024, 2, 29, 23, 30)}
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Pruebas de la llave canónica de detecciones (quantize / canonical_value / canonical_key /
+build_historical_count_sql): cuantización en los límites de redondeo, nulos, ACQ_TIME y
+tipos de fecha
+"""
+
+import datetime
+import decimal
+import re
+
+import numpy as np
+import pytest
+
+import Fuegos
+
+POSITIONS = list(range(len(Fuegos.DETECTION_KEY_FIELDS)))
+
+
+def detection(**values):
+    row = {'LATITUDE': -1.23456, 'LONGITUDE': -72.5, 'BRIGHTNESS': 330.12, 'SCAN': 0.39, 'TRACK': 0.36,
+           'ACQ_DATE': datetime.datetime(2026, 10, 16), 'ACQ_TIME': '0512', 'SATELLITE': 'N',
+           'VERSION': '2.0NRT', 'BRIGHT_T31': None, 'FRP': 1.2, 'DAYNIGHT': 'N', 'INSTRUMENT': 'VIIRS',
+           'BRIGHT_TI4': 330.12, 'BRIGHT_TI5': 290.5}
+    row.update(values)
+    return [row[name] for name in Fuegos.DETECTION_KEY_FIELDS]
+
+
+@pytest.mark.parametrize('quantum', [-123456, -2, -1, 0, 1, 2, 675, 9000001])
+@pytest.mark.parametrize('decimals', [2, 5])
+def test_quantum_bound_is_exact(quantum, decimals):
+    bound = decimal.Decimal(Fuegos.quantum_bound(quantum, decimals))
+    assert bound == (decimal.Decimal(quantum) - decimal.Decimal('0.5')) / 10 ** decimals
+
+
+@pytest.mark.parametrize('decimals', [2, 5])
+def test_quantize_matches_bounds(decimals):
+    rng = np.random.default_rng(decimals)
+    values = list(rng.uniform(-400.0, 400.0, 20000))
+    # Valores exactamente en los límites (q +/- 0.5) / 10^d y sus vecinos en punto flotante
+    for quantum in rng.integers(-4000000, 4000000, 5000):
+        bound = float(Fuegos.quantum_bound(int(quantum), decimals))
+        values += [bound, np.nextafter(bound, -np.inf), np.nextafter(bound, np.inf)]
+    for value in values:
+        quantum = Fuegos.quantize(value, decimals)
+        assert float(Fuegos.quantum_bound(quantum, decimals)) <= value < float(Fuegos.quantum_bound(quantum + 1, decimals))
+
+
+@pytest.mark.parametrize('value, decimals, expected', [
+    (0.005, 2, 1), (-0.005, 2, 0), (0.015, 2, 2), (2.675, 2, 268), (2.6749999, 2, 267),
+    (-3.123455, 5, -312345), (-3.1234550001, 5, -312346), (330.0, 2, 33000), (0, 2, 0)])
+def test_quantize_rounding_boundaries(value, decimals, expected):
+    # Los límites se redondean hacia arriba, igual que el rango semiabierto de la consulta SQL
+    assert Fuegos.quantize(value, decimals) == expected
+
+
+@pytest.mark.parametrize('name, value', [
+    ('LATITUDE', None), ('FRP', float('nan')), ('BRIGHT_T31', np.float64('nan')), ('SATELLITE', ''),
+    ('VERSION', '   '), ('ACQ_TIME', None), ('ACQ_TIME', ''), ('ACQ_DATE', None), ('DAYNIGHT', None)])
+def test_canonical_value_nulls(name, value):
+    assert Fuegos.canonical_value(name, value) is None
+
+
+@pytest.mark.parametrize('value', ['512', '0512', ' 512 ', 512, 512.0])
+def test_canonical_value_acq_time(value):
+    assert Fuegos.canonical_value('ACQ_TIME', value) == '0512'
+
+
+@pytest.mark.parametrize('value', [datetime.datetime(2026, 10, 16, 5, 12), datetime.date(2026, 10, 16),
+                                   '2026-10-16', '2026-10-16 00:00:00'])
+def test_canonical_value_acq_date(value):
+    assert Fuegos.canonical_value('ACQ_DATE', value) == datetime.date(2026, 10, 16)
+
+
+def test_canonical_key_ignores_representation_noise():
+    key = Fuegos.canonical_key(detection(), POSITIONS)
+    noisy = detection(LATITUDE=-1.2345600000001, BRIGHTNESS=np.float32(330.12).item(), FRP=1.19999999,
+                      ACQ_DATE=datetime.date(2026, 10, 16), ACQ_TIME=512, BRIGHT_T31=float('nan'),
+                      SATELLITE=' N ', BRIGHT_TI5=290.50000000001)
+    assert Fuegos.canonical_key(noisy, POSITIONS) == key
+    assert Fuegos.detection_id(Fuegos.canonical_key(noisy, POSITIONS)) == Fuegos.detection_id(key)
+
+
+def test_canonical_key_distinguishes_published_precision():
+    key = Fuegos.canonical_key(detection(), POSITIONS)
+    assert Fuegos.canonical_key(detection(LATITUDE=-1.23457), POSITIONS) != key
+    assert Fuegos.canonical_key(detection(FRP=1.21), POSITIONS) != key
+    assert Fuegos.canonical_key(detection(ACQ_TIME='0513'), POSITIONS) != key
+    assert Fuegos.canonical_key(detection(BRIGHT_T31=0.0), POSITIONS) != key
+
+
+def test_canonical_key_missing_fields_are_null():
+    positions = list(POSITIONS)
+    positions[Fuegos.DETECTION_KEY_FIELDS.index('BRIGHT_T31')] = None
+    positions[Fuegos.DETECTION_KEY_FIELDS.index('BRIGHT_TI4')] = None
+    # Sin posición el campo es nulo aunque la fila tenga un valor en ese lugar
+    key = Fuegos.canonical_key(detection(BRIGHT_T31=290.0), positions)
+    assert key == Fuegos.canonical_key(detection(BRIGHT_TI4=None), POSITIONS)
+
+
+def test_historical_count_sql_ranges_contain_value():
+    row = detection(LATITUDE=-3.123455, SATELLITE="O'Brien", SCAN=None)
+    sql = Fuegos.build_historical_count_sql('tabla', [1] + row)
+    assert 'ROUND' not in sql
+    assert 'SCAN is NULL' in sql
+    assert "SATELLITE = 'O''Brien'" in sql
+    assert "ACQ_TIME = '0512'" in sql
+    for name, decimals in Fuegos.CANONICAL_KEY_DECIMALS.items():
+        value = row[Fuegos.DETECTION_KEY_FIELDS.index(name)]
+        if value is None:
+            continue
+        match = re.search(r'\b{0} >= (\S+) and {0} < (\S+)'.format(name), sql)
+        assert match, name
+        assert float(match.group(1)) <= value < float(match.group(2))
+        assert decimal.Decimal(match.group(2)) - decimal.Decimal(match.group(1)) == decimal.Decimal(1) / 10 ** decimals
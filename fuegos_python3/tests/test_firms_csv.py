@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Pruebas de la lectura del CSV de FIRMS (iter_firms_csv) contra la lectura del shapefile
+(iter_shapefile_detections) de los mismos registros
+
+El mismo conjunto de detecciones se escribe como CSV (columnas en minúscula, en otro orden y
+con ACQ_TIME sin ceros a la izquierda) y como shapefile. Ambas lecturas deben entregar las
+mismas coordenadas y valores; el filtro por min_date del CSV se compara con la regla de la
+ventana de filter_acquisition_window aplicada a las filas del shapefile.
+"""
+
+import csv
+import datetime
+
+import pytest
+import pytz
+
+import Fuegos
+from test_shapefile_columns import write_shapefile
+
+
+MODIS_SENSOR = {'name': 'MODIS', 'instrument': 'MODIS', 'confidence': 'modis'}
+VIIRS_SENSOR = {'name': 'NOAA-21', 'instrument': 'VIIRS_NOAA_21', 'confidence': 'viirs'}
+
+MODIS_FIELDS = [('LATITUDE', 'N', 10, 5), ('LONGITUDE', 'N', 10, 5), ('BRIGHTNESS', 'N', 8, 2),
+                ('SCAN', 'N', 5, 2), ('TRACK', 'N', 5, 2), ('ACQ_DATE', 'D', 8, 0), ('ACQ_TIME', 'C', 4, 0),
+                ('SATELLITE', 'C', 5, 0), ('INSTRUMENT', 'C', 5, 0), ('CONFIDENCE', 'N', 3, 0),
+                ('VERSION', 'C', 6, 0), ('BRIGHT_T31', 'N', 8, 2), ('FRP', 'N', 8, 2), ('DAYNIGHT', 'C', 1, 0)]
+MODIS_CSV_COLUMNS = ['latitude', 'longitude', 'brightness', 'scan', 'track', 'acq_date', 'acq_time', 'satellite',
+                     'instrument', 'confidence', 'version', 'bright_t31', 'frp', 'daynight']
+# (LATITUDE, LONGITUDE, BRIGHTNESS, SCAN, TRACK, ACQ_DATE, ACQ_TIME, SATELLITE, INSTRUMENT, CONFIDENCE,
+#  VERSION, BRIGHT_T31, FRP, DAYNIGHT)
+MODIS_RECORDS = [
+    ('-2.50000', '-70.25000', '310.25', '1.00', '1.00', '2024-03-01', '0105', 'Aqua', 'MODIS', '85', '6.1NRT',
+     '295.10', '12.30', 'N'),
+    ('1.25000', '-71.00000', '330.00', '1.20', '1.10', '2024-02-29', '2359', 'Terra', 'MODIS', '25', '6.1NRT',
+     '299.99', '', 'D'),
+    ('3.00000', '-72.00000', '305.50', '1.50', '1.20', '2024-03-01', '1200', 'Aqua', 'MODIS', '', '6.1NRT',
+     '290.00', '5.00', 'D'),
+    ('-0.75000', '-69.50000', '340.10', '2.00', '1.40', '2024-03-01', '0501', 'Terra', 'MODIS', '50', '6.1NRT',
+     '300.00', '40.10', 'N'),
+    # Fuera de la Amazonía
+    ('-30.00000', '-60.00000', '320.00', '1.00', '1.00', '2024-03-01', '0300', 'Aqua', 'MODIS', '90', '6.1NRT',
+     '290.00', '8.00', 'N'),
+]
+
+VIIRS_FIELDS = [('LATITUDE', 'N', 10, 5), ('LONGITUDE', 'N', 10, 5), ('BRIGHT_TI4', 'N', 8, 2),
+                ('SCAN', 'N', 5, 2), ('TRACK', 'N', 5, 2), ('ACQ_DATE', 'D', 8, 0), ('ACQ_TIME', 'C', 4, 0),
+                ('SATELLITE', 'C', 3, 0), ('CONFIDENCE', 'C', 7, 0), ('VERSION', 'C', 6, 0),
+                ('BRIGHT_TI5', 'N', 8, 2), ('FRP', 'N', 8, 2), ('DAYNIGHT', 'C', 1, 0)]
+VIIRS_CSV_COLUMNS = ['latitude', 'longitude', 'bright_ti4', 'scan', 'track', 'acq_date', 'acq_time', 'satellite',
+                     'confidence', 'version', 'bright_ti5', 'frp', 'daynight']
+VIIRS_RECORDS = [
+    ('-1.10000', '-70.10000', '330.10', '0.40', '0.37', '2024-03-01', '0618', 'N21', 'nominal', '2.0NRT',
+     '290.50', '3.10', 'N'),
+    ('0.50000', '-71.50000', '367.00', '0.50', '0.40', '2024-03-01', '1742', 'N21', 'high', '2.0NRT',
+     '300.00', '', 'D'),
+    ('2.20000', '-73.30000', '310.00', '0.45', '0.39', '2024-02-29', '0001', 'N21', 'low', '2.0NRT',
+     '288.00', '1.00', 'N'),
+]
+
+BBOX = (-80.0, -10.0, -60.0, 10.0)
+
+
+def write_csv(path, columns, records):
+    # El CSV trae las columnas en otro orden, con espacios y ACQ_TIME sin ceros a la izquierda
+    order = list(reversed(range(len(columns))))
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow([' {} '.format(columns[i]) for i in order])
+        for record in records:
+            values = list(record)
+            values[columns.index('acq_time')] = values[columns.index('acq_time')].lstrip('0') or '0'
+            writer.writerow([values[i] for i in order])
+        writer.writerow([])
+
+
+def write_sensor_shapefile(base, fields, records):
+    dbf_records = []
+    for record in records:
+        values = [value.replace('-', '') if name == 'ACQ_DATE' else value
+                  for (name, field_type, length, decimals), value in zip(fields, record)]
+        dbf_records.append((False, (float(record[1]), float(record[0])), values))
+    write_shapefile(base, dbf_records, fields)
+
+
+def in_window(row, min_date):
+    # Misma regla que filter_acquisition_window: hora de Colombia posterior a min_date
+    acq_date = row['ACQ_DATE']
+    sensor_date = datetime.datetime(acq_date.year, acq_date.month, acq_date.day,
+                                    int(row['ACQ_TIME'][0:2]), int(row['ACQ_TIME'][2:4]))
+    return sensor_date - datetime.timedelta(hours=5) > min_date.replace(tzinfo=None)
+
+
+@pytest.mark.parametrize('sensor, fields, columns, records', [
+    (MODIS_SENSOR, MODIS_FIELDS, MODIS_CSV_COLUMNS, MODIS_RECORDS),
+    (VIIRS_SENSOR, VIIRS_FIELDS, VIIRS_CSV_COLUMNS, VIIRS_RECORDS),
+])
+@pytest.mark.parametrize('min_date', [
+    None,
+    pytz.timezone('America/Bogota').localize(datetime.datetime(2024, 2, 29, 18, 59)),
+    pytz.timezone('America/Bogota').localize(datetime.datetime(2024, 3, 1, 1, 0)),
+])
+def test_csv_matches_shapefile(tmp_path, sensor, fields, columns, records, min_date):
+    csv_path = str(tmp_path / 'sensor.csv')
+    write_csv(csv_path, columns, records)
+    base = str(tmp_path / 'sensor')
+    write_sensor_shapefile(base, fields, records)
+    names = [name for name, field_type in Fuegos.DETECTION_FIELDS]
+
+    csv_stats = {'read': 0, 'kept': 0}
+    csv_rows = list(Fuegos.iter_firms_csv(csv_path, sensor, min_date, BBOX, csv_stats))
+    shp_stats = {'read': 0, 'kept': 0}
+    shp_rows = list(Fuegos.iter_shapefile_detections(sensor, base + '.shp', names, BBOX, shp_stats))
+    if min_date is not None:
+        shp_rows = [(xy, row) for xy, row in shp_rows if in_window(row, min_date)]
+
+    assert csv_stats['read'] == shp_stats['read'] == len(records)
+    assert csv_stats['kept'] == len(shp_rows)
+    assert [xy for xy, row in csv_rows] == [xy for xy, row in shp_rows]
+    for (xy, csv_row), (xy, shp_row) in zip(csv_rows, shp_rows):
+        for name in names:
+            assert csv_row.get(name) == shp_row.get(name), name
+    if min_date is None:
+        # Solo se descarta el registro fuera de la extensión
+        assert len(csv_rows) == len([record for record in records if float(record[0]) > -10])
+
+
+def test_csv_row_values(tmp_path):
+    csv_path = str(tmp_path / 'modis.csv')
+    write_csv(csv_path, MODIS_CSV_COLUMNS, MODIS_RECORDS[:2])
+
+    rows = [row for xy, row in Fuegos.iter_firms_csv(csv_path, MODIS_SENSOR)]
+
+    assert rows[0]['ACQ_DATE'] == datetime.datetime(2024, 3, 1)
+    assert rows[0]['ACQ_TIME'] == '0105'
+    assert rows[0]['SATELLITE'] == 'Aqua'
+    assert rows[0]['VERSION'] == '6.1NRT'
+    assert rows[0]['BRIGHTNESS'] == 310.25
+    assert rows[0]['CONFIDENCE'] == 'high'
+    assert rows[0]['confidence_modis'] == 85.0
+    assert rows[0]['INSTRUMENT'] == 'MODIS'
+    assert rows[1]['FRP'] is None
+    assert rows[1]['CONFIDENCE'] == 'low'
+
+
+def test_csv_without_required_columns(tmp_path):
+    csv_path = tmp_path / 'sin_columnas.csv'
+    csv_path.write_text('latitude,longitude\n1,2\n', encoding='utf-8')
+    with pytest.raises(Exception, match='acq_date'):
+        Fuegos.count_csv_records(str(csv_path))
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Pruebas del índice de proximidad de pozos (build_point_grid / points_near_grid) contra la
+distancia haversine a todos los pozos
+"""
+
+import numpy as np
+import pytest
+
+import Fuegos
+
+
+def brute_force_near(wells_x, wells_y, x, y, distances):
+    near = np.zeros(len(x), dtype=bool)
+    for i in range(len(x)):
+        near[i] = (Fuegos.haversine_meters(x[i], y[i], wells_x, wells_y) <= distances[i]).any()
+    return near
+
+
+def test_haversine_meters():
+    # Un grado de latitud sobre un meridiano y un grado de longitud sobre el ecuador
+    assert Fuegos.haversine_meters(-70.0, 0.0, -70.0, 1.0) == pytest.approx(Fuegos.METERS_PER_DEGREE)
+    assert Fuegos.haversine_meters(-70.0, 0.0, -69.0, 0.0) == pytest.approx(Fuegos.METERS_PER_DEGREE)
+    assert Fuegos.haversine_meters(-70.0, 60.0, -69.0, 60.0) == pytest.approx(Fuegos.METERS_PER_DEGREE / 2, rel=1e-3)
+    assert Fuegos.haversine_meters(-70.0, -2.0, -70.0, -2.0) == 0.0
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_points_near_grid_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    wells_x = rng.uniform(-75.0, -67.0, 1500)
+    wells_y = rng.uniform(-4.0, 4.0, 1500)
+    # La mitad de las detecciones cerca de un pozo (hasta ~2 km) y el resto al azar
+    near_wells = rng.integers(0, len(wells_x), 2000)
+    x = np.concatenate([wells_x[near_wells] + rng.uniform(-0.02, 0.02, 2000), rng.uniform(-76.0, -66.0, 2000)])
+    y = np.concatenate([wells_y[near_wells] + rng.uniform(-0.02, 0.02, 2000), rng.uniform(-5.0, 5.0, 2000)])
+    # Distancia por instrumento: MODIS, VIIRS o sin exclusión
+    distances = rng.choice([1000.0, 375.0, 0.0], len(x))
+
+    max_abs_lat = max(abs(wells_y.min()), abs(wells_y.max())) + 1.0
+    grid = Fuegos.build_point_grid(wells_x, wells_y, distances.max(), max_abs_lat)
+    near = Fuegos.points_near_grid(grid, x, y, distances)
+
+    expected = brute_force_near(wells_x, wells_y, x, y, distances)
+    assert np.array_equal(near, expected)
+    assert expected.sum() > 100
+
+
+def test_points_near_grid_empty():
+    grid = Fuegos.build_point_grid(np.zeros(0), np.zeros(0), 1000.0, 5.0)
+    assert not Fuegos.points_near_grid(grid, np.array([-70.0]), np.array([0.0]), np.array([1000.0])).any()
+    grid = Fuegos.build_point_grid(np.array([-70.0]), np.array([0.0]), 1000.0, 5.0)
+    assert len(Fuegos.points_near_grid(grid, np.zeros(0), np.zeros(0), np.zeros(0))) == 0
+
+
+def test_points_near_grid_exact_distance():
+    # Pozo a 0.005 grados al este: ~556 m, dentro de 1000 m y fuera de 375 m
+    grid = Fuegos.build_point_grid(np.array([-70.005]), np.array([1.0]), 1000.0, 2.0)
+    near = Fuegos.points_near_grid(grid, np.array([-70.0, -70.0]), np.array([1.0, 1.0]), np.array([1000.0, 375.0]))
+    assert near.tolist() == [True, False]
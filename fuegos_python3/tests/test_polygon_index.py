@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Pruebas del índice de grilla de polígonos (build_polygon_index / polygon_index_contains)
+contra una prueba par-impar de fuerza bruta en Python puro
+"""
+
+import math
+
+import numpy as np
+import pytest
+
+import Fuegos
+
+
+def star(cx, cy, outer, inner, tips=7):
+    """Polígono cóncavo en forma de estrella"""
+    ring = []
+    for i in range(tips * 2):
+        radius = outer if i % 2 == 0 else inner
+        angle = math.pi * i / tips
+        ring.append((cx + radius * math.cos(angle), cy + radius * math.sin(angle)))
+    return ring
+
+
+def square(xmin, ymin, xmax, ymax):
+    return [(xmin, ymin), (xmax, ymin), (xmax, ymax), (xmin, ymax)]
+
+
+# Dos entidades: una estrella con un hueco cuadrado (mismo id) y un cuadrado aparte
+RINGS = [(0, star(-72.0, -1.0, 2.0, 0.8)),
+         (0, square(-72.3, -1.3, -71.7, -0.7)),
+         (1, square(-69.5, 0.5, -68.0, 2.5))]
+
+
+def brute_force_contains(rings, x, y):
+    """Dentro si el punto está dentro (par-impar) de alguna entidad"""
+    parity = {}
+    for feature_id, ring in rings:
+        crossings = 0
+        for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+            if (y1 > y) != (y2 > y) and x1 + (y - y1) * (x2 - x1) / (y2 - y1) > x:
+                crossings += 1
+        parity[feature_id] = parity.get(feature_id, 0) + crossings
+    return any(count % 2 == 1 for count in parity.values())
+
+
+@pytest.mark.parametrize('cells', [4, 32, 256])
+def test_polygon_index_matches_brute_force(cells):
+    rng = np.random.default_rng(cells)
+    x = rng.uniform(-75.0, -66.0, 5000)
+    y = rng.uniform(-4.0, 4.0, 5000)
+
+    index = Fuegos.build_polygon_index(RINGS, cells)
+    inside = Fuegos.polygon_index_contains(index, x, y)
+
+    expected = np.array([brute_force_contains(RINGS, px, py) for px, py in zip(x, y)])
+    assert np.array_equal(inside, expected)
+    assert expected.any() and not expected.all()
+
+
+def test_polygon_index_points_outside_grid():
+    index = Fuegos.build_polygon_index(RINGS, 32)
+    inside = Fuegos.polygon_index_contains(index, [-100.0, 0.0, -72.0], [-1.0, 50.0, -1.0])
+    # El centro de la estrella está en el hueco
+    assert inside.tolist() == [False, False, False]
+
+
+def test_polygon_index_hole_and_interior():
+    index = Fuegos.build_polygon_index(RINGS, 32)
+    inside = Fuegos.polygon_index_contains(index, [-72.0, -70.8, -68.7], [-1.0, -1.0, 1.5])
+    assert inside.tolist() == [False, True, True]
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Pruebas de exclude_pozos en los modos select y zones
+
+Las herramientas de arcpy se reemplazan por una simulación de capas en memoria que sigue las
+reglas de selección de ArcGIS: REMOVE_FROM_SELECTION sobre una capa sin selección no hace nada
+y CopyFeatures sobre una capa sin selección copia todos los registros. Las coordenadas están en
+metros y la cercanía a un pozo es la distancia euclidiana.
+"""
+
+import math
+
+import pytest
+
+import Fuegos
+
+
+class FakeGeoprocessing(object):
+
+    def __init__(self, points, wells):
+        # points: {OBJECTID: (x, y, INSTRUMENT)}, wells: [(x, y)]
+        self.features = {'in_fc': points, 'pozos': wells}
+        self.layers = {}
+        self.outputs = {}
+
+    def make_feature_layer(self, in_fc, name, where=''):
+        if where == '1 = 0':
+            oids = []
+        else:
+            instrument = where.split("'")[1]
+            oids = [oid for oid, point in self.features[in_fc].items() if point[2] == instrument]
+        self.layers[name] = {'fc': in_fc, 'oids': oids, 'selection': set()}
+
+    def near(self, point, target, distance):
+        if target.startswith('zona_'):
+            distance = float(target.split('_')[1])
+        return any(math.hypot(point[0] - x, point[1] - y) <= distance for x, y in self.features['pozos'])
+
+    def select_layer_by_location(self, name, relation, target, search_distance, selection_type, invert):
+        layer = self.layers[name]
+        distance = float(search_distance.split()[0]) if search_distance else 0.0
+        points = self.features[layer['fc']]
+        matches = {oid for oid in layer['oids'] if self.near(points[oid], target, distance)}
+        if invert == 'INVERT':
+            matches = set(layer['oids']) - matches
+        if selection_type == 'NEW_SELECTION':
+            layer['selection'] = matches
+        elif selection_type == 'REMOVE_FROM_SELECTION':
+            layer['selection'] = layer['selection'] - matches
+        else:
+            raise AssertionError(selection_type)
+
+    def describe(self, name):
+        return type('Describe', (), {'FIDSet': '; '.join(str(oid) for oid in sorted(self.layers[name]['selection']))})
+
+    def copy_features(self, name, out, *args):
+        layer = self.layers[name]
+        self.outputs[out] = sorted(layer['selection'] or layer['oids'])
+
+    def merge(self, inputs, out_fc, *args):
+        self.outputs[out_fc] = sorted(oid for name in inputs for oid in self.outputs[name])
+
+
+SENSORS = [
+    {'name': 'MODIS', 'data_key': 'shp_modis', 'url': None, 'instrument': 'MODIS', 'pozos_distance': 1000},
+    {'name': 'NOAA-21', 'data_key': 'shp_noaa_21', 'url': None, 'instrument': 'VIIRS_NOAA_21', 'pozos_distance': 375},
+]
+
+
+@pytest.fixture
+def geoprocessing(monkeypatch):
+    def install(points, wells):
+        fake = FakeGeoprocessing(points, wells)
+        monkeypatch.setattr(Fuegos.arcpy, 'MakeFeatureLayer_management', fake.make_feature_layer)
+        monkeypatch.setattr(Fuegos.arcpy, 'SelectLayerByLocation_management', fake.select_layer_by_location)
+        monkeypatch.setattr(Fuegos.arcpy, 'Describe', fake.describe)
+        monkeypatch.setattr(Fuegos.arcpy, 'CopyFeatures_management', fake.copy_features)
+        monkeypatch.setattr(Fuegos.arcpy, 'Merge_management', fake.merge)
+        monkeypatch.setattr(Fuegos, 'get_layer_fingerprint', lambda fc: {})
+        monkeypatch.setattr(Fuegos, 'get_pozos_zone',
+                            lambda data, distance, fingerprint=None: 'zona_{:g}'.format(distance))
+        return fake
+    return install
+
+
+def brute_force_kept(points, wells, distances):
+    return sorted(oid for oid, (x, y, instrument) in points.items()
+                  if all(math.hypot(x - wx, y - wy) > distances[instrument] for wx, wy in wells))
+
+
+@pytest.mark.parametrize('mode', ['select', 'zones'])
+def test_exclude_pozos_removes_points_inside_zone(geoprocessing, mode):
+    wells = [(0.0, 0.0), (5000.0, 0.0)]
+    points = {
+        1: (100.0, 0.0, 'MODIS'),            # dentro de 1000 m
+        2: (900.0, 0.0, 'MODIS'),            # dentro de 1000 m
+        3: (2000.0, 0.0, 'MODIS'),           # fuera
+        4: (300.0, 0.0, 'VIIRS_NOAA_21'),    # dentro de 375 m
+        5: (900.0, 0.0, 'VIIRS_NOAA_21'),    # fuera de 375 m, dentro de 1000 m
+        6: (5200.0, 100.0, 'VIIRS_NOAA_21'), # dentro de 375 m del segundo pozo
+        7: (-3000.0, 0.0, 'VIIRS_NOAA_21'),  # fuera
+    }
+    fake = geoprocessing(points, wells)
+    data = {'feature_hidrocarburos': 'pozos', 'pozos_exclusion_mode': mode, 'sensors': SENSORS}
+
+    assert Fuegos.exclude_pozos(data, 'in_fc', 'out_fc') == 'out_fc'
+
+    distances = Fuegos.get_pozos_exclusion_distances(data)
+    assert fake.outputs['out_fc'] == brute_force_kept(points, wells, distances) == [3, 5, 7]
+
+
+@pytest.mark.parametrize('mode', ['select', 'zones'])
+def test_exclude_pozos_all_points_inside_zone(geoprocessing, mode):
+    # Sin puntos fuera de las zonas no queda selección: el resultado debe quedar vacío
+    points = {1: (10.0, 0.0, 'MODIS'), 2: (0.0, 10.0, 'VIIRS_NOAA_21')}
+    fake = geoprocessing(points, [(0.0, 0.0)])
+    data = {'feature_hidrocarburos': 'pozos', 'pozos_exclusion_mode': mode, 'sensors': SENSORS}
+
+    Fuegos.exclude_pozos(data, 'in_fc', 'out_fc')
+
+    assert fake.outputs['out_fc'] == []
+
+
+def test_exclude_pozos_no_wells_nearby(geoprocessing):
+    points = {1: (10.0, 0.0, 'MODIS'), 2: (0.0, 10.0, 'VIIRS_NOAA_21'), 3: (0.0, 20.0, 'OTRO')}
+    fake = geoprocessing(points, [(100000.0, 0.0)])
+    data = {'feature_hidrocarburos': 'pozos', 'pozos_exclusion_mode': 'zones', 'sensors': SENSORS}
+
+    Fuegos.exclude_pozos(data, 'in_fc', 'out_fc')
+
+    # Los instrumentos que no están en el registro de sensores no pasan la exclusión
+    assert fake.outputs['out_fc'] == [1, 2]
+
+
+def test_pozos_exclusion_distances_from_registry():
+    sensors = SENSORS + [{'name': 'GOES', 'data_key': 'shp_goes', 'url': None, 'instrument': 'GOES',
+                          'confidence': 'modis', 'pozos_distance': 2000}]
+    distances = Fuegos.get_pozos_exclusion_distances({'sensors': sensors, 'pozos_exclusion_meters': {'MODIS': 500}})
+    assert list(distances.items()) == [('MODIS', 500.0), ('VIIRS_NOAA_21', 375.0), ('GOES', 2000.0)]
+
+    with pytest.raises(Exception, match='pozos_distance'):
+        Fuegos.get_pozos_exclusion_distances({'sensors': [{'name': 'GOES', 'data_key': 'shp_goes', 'url': None}]})
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Pruebas del cargador columnar de shapefiles de puntos (load_shapefile_columns)
+
+Los .shp, .shx y .dbf se escriben byte a byte con struct (registros con valores, marcas de
+borrado y geometrías nulas) y las columnas leídas se comparan con los valores usados para
+construirlos.
+"""
+
+import os
+import struct
+import zipfile
+
+import numpy as np
+import pytest
+
+import Fuegos
+
+
+FIELDS = [('LATITUDE', 'N', 10, 5), ('BRIGHTNESS', 'N', 8, 2), ('ACQ_DATE', 'D', 8, 0),
+          ('ACQ_TIME', 'C', 4, 0), ('SATELLITE', 'C', 8, 0), ('VALID', 'L', 1, 0)]
+
+
+def write_shapefile(base, records, fields=FIELDS, write_shx=True):
+    """
+    Escribe base.shp, base.shx y base.dbf. records es una lista de (borrado, (x, y) o None
+    para una geometría nula, valores en texto del .dbf)
+    """
+    record_length = 1 + sum(field[2] for field in fields)
+    header_length = 32 + 32 * len(fields) + 1
+    with open(base + '.dbf', 'wb') as f:
+        f.write(struct.pack('<BBBBIHH20x', 3, 124, 1, 1, len(records), header_length, record_length))
+        for name, field_type, length, decimals in fields:
+            f.write(struct.pack('<11sc4xBB14x', name.encode('ascii'), field_type.encode('ascii'), length, decimals))
+        f.write(b'\x0d')
+        for deleted, point, values in records:
+            f.write(b'*' if deleted else b' ')
+            for (name, field_type, length, decimals), value in zip(fields, values):
+                text = value.encode('latin-1')
+                f.write(text.rjust(length) if field_type in ('N', 'F') else text.ljust(length))
+        f.write(b'\x1a')
+
+    contents = [struct.pack('<idd', Fuegos.SHP_POINT, *point) if point else struct.pack('<i', 0)
+                for deleted, point, values in records]
+    points = [point for deleted, point, values in records if point] or [(0.0, 0.0)]
+    bbox = (min(p[0] for p in points), min(p[1] for p in points), max(p[0] for p in points), max(p[1] for p in points))
+
+    def header(file_bytes):
+        return struct.pack('>i20xi', 9994, file_bytes // 2) + struct.pack('<ii4d32x', 1000, Fuegos.SHP_POINT, *bbox)
+
+    with open(base + '.shp', 'wb') as f:
+        f.write(header(100 + sum(8 + len(content) for content in contents)))
+        offsets = []
+        for number, content in enumerate(contents, start=1):
+            offsets.append((f.tell() // 2, len(content) // 2))
+            f.write(struct.pack('>ii', number, len(content) // 2))
+            f.write(content)
+    if write_shx:
+        with open(base + '.shx', 'wb') as f:
+            f.write(header(100 + 8 * len(offsets)))
+            for offset, length in offsets:
+                f.write(struct.pack('>ii', offset, length))
+
+
+RECORDS = [
+    (False, (-70.25, -2.5), ['-2.50000', '310.25', '20240229', '0105', 'Aqua', 'T']),
+    (False, (-71.0, 1.25), ['1.25000', '', '20231231', '2359', 'Terra', 'F']),
+    (True, (-72.0, 3.0), ['3.00000', '400.00', '20240101', '1200', 'Borrado', 'T']),
+    (False, (-69.5, -0.75), ['-0.75000', '********', '', '0000', 'NOAA-21', ' ']),
+    (False, (-73.125, 4.5), ['4.50000', '1234.56', '20250301', '0830', 'Señal', 'y']),
+]
+
+
+def expected_columns(records):
+    live = [values for deleted, point, values in records if not deleted]
+    return {
+        'LATITUDE': [float(values[0]) for values in live],
+        'BRIGHTNESS': [310.25, np.nan, np.nan, 1234.56][:len(live)],
+        'ACQ_DATE': ['2024-02-29', '2023-12-31', 'NaT', '2025-03-01'][:len(live)],
+        'ACQ_TIME': [values[3] for values in live],
+        'SATELLITE': [values[4] for values in live],
+        'VALID': [True, False, False, True][:len(live)],
+        'SHAPE@X': [point[0] for deleted, point, values in records if not deleted],
+        'SHAPE@Y': [point[1] for deleted, point, values in records if not deleted],
+    }
+
+
+def assert_columns(columns, expected):
+    assert list(columns) == list(expected)
+    for name in ('LATITUDE', 'BRIGHTNESS', 'SHAPE@X', 'SHAPE@Y'):
+        assert columns[name].dtype == np.float64
+        np.testing.assert_array_equal(columns[name], np.array(expected[name], dtype=np.float64))
+    assert columns['ACQ_DATE'].dtype == np.dtype('datetime64[D]')
+    assert [str(value) for value in columns['ACQ_DATE']] == expected['ACQ_DATE']
+    assert columns['ACQ_TIME'].tolist() == expected['ACQ_TIME']
+    assert columns['SATELLITE'].tolist() == expected['SATELLITE']
+    assert columns['VALID'].tolist() == expected['VALID']
+
+
+def test_load_shapefile_columns(tmp_path):
+    base = str(tmp_path / 'MODIS_C6_1_South_America_24h')
+    write_shapefile(base, RECORDS)
+
+    columns = Fuegos.load_shapefile_columns(base + '.shp')
+
+    # El registro marcado como borrado no se carga y su geometría tampoco
+    assert_columns(columns, expected_columns(RECORDS))
+
+
+def test_load_shapefile_columns_from_zip(tmp_path):
+    base = str(tmp_path / 'J1_VIIRS_C2_South_America_24h')
+    write_shapefile(base, RECORDS)
+    zip_path = str(tmp_path / 'noaa.zip')
+    with zipfile.ZipFile(zip_path, 'w') as zip_ref:
+        for ext in ('.shp', '.shx', '.dbf'):
+            zip_ref.write(base + ext, os.path.basename(base) + ext)
+
+    columns = Fuegos.load_shapefile_columns('J1_VIIRS_C2_South_America_24h.shp', zip_path=zip_path)
+
+    assert_columns(columns, expected_columns(RECORDS))
+
+
+def test_load_shapefile_columns_selected_fields(tmp_path):
+    base = str(tmp_path / 'MODIS')
+    write_shapefile(base, RECORDS)
+
+    columns = Fuegos.load_shapefile_columns(base + '.shp', ['acq_time', 'LATITUDE'])
+
+    assert list(columns) == ['LATITUDE', 'ACQ_TIME', 'SHAPE@X', 'SHAPE@Y']
+    assert columns['ACQ_TIME'].tolist() == ['0105', '2359', '0000', '0830']
+
+
+def test_load_shapefile_columns_null_geometry_uses_shx(tmp_path):
+    records = [RECORDS[0], (False, None, RECORDS[1][2]), RECORDS[4]]
+    base = str(tmp_path / 'MODIS')
+    write_shapefile(base, records)
+
+    columns = Fuegos.load_shapefile_columns(base + '.shp')
+
+    # La geometría nula queda en nan y los registros siguientes se leen desde su offset del .shx
+    np.testing.assert_array_equal(columns['SHAPE@X'], [-70.25, np.nan, -73.125])
+    np.testing.assert_array_equal(columns['SHAPE@Y'], [-2.5, np.nan, 4.5])
+    assert columns['SATELLITE'].tolist() == ['Aqua', 'Terra', 'Señal']
+
+
+def test_load_shapefile_columns_null_geometry_without_shx(tmp_path):
+    base = str(tmp_path / 'MODIS')
+    write_shapefile(base, [RECORDS[0], (False, None, RECORDS[1][2])], write_shx=False)
+
+    with pytest.raises(Exception, match='shx'):
+        Fuegos.load_shapefile_columns(base + '.shp')
+
+
+def test_load_shapefile_columns_without_shx_fixed_size(tmp_path):
+    # Sin geometrías nulas el .shx no hace falta: todos los registros miden 28 bytes
+    base = str(tmp_path / 'MODIS')
+    write_shapefile(base, RECORDS, write_shx=False)
+
+    columns = Fuegos.load_shapefile_columns(base + '.shp')
+
+    assert_columns(columns, expected_columns(RECORDS))
+
+
+def test_load_shapefile_columns_empty(tmp_path):
+    base = str(tmp_path / 'MODIS')
+    write_shapefile(base, [])
+
+    columns = Fuegos.load_shapefile_columns(base + '.shp')
+
+    assert all(len(values) == 0 for values in columns.values())
+
+
+def test_decode_dbf_column_numbers_and_dates():
+    numbers = Fuegos.decode_dbf_column(np.array([b' 12.50', b'      ', b'******', b' -0.01', b'1e3'], dtype='S6'), 'N')
+    np.testing.assert_array_equal(numbers, [12.5, np.nan, np.nan, -0.01, 1000.0])
+
+    raw = np.array([b'19700101', b'20000229', b'21001231', b'        ', b'19991201'], dtype='S8')
+    dates = Fuegos.decode_dbf_column(raw, 'D')
+    assert [str(value) for value in dates] == ['1970-01-01', '2000-02-29', '2100-12-31', 'NaT', '1999-12-01']
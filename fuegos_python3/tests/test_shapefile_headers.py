@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Pruebas de la lectura de encabezados .dbf / .shp (read_shapefile_info)
+
+Los shapefiles de puntos se escriben byte a byte con struct y los resultados se comparan
+con los valores usados para construirlos.
+"""
+
+import os
+import struct
+import zipfile
+
+import pytest
+
+import Fuegos
+
+
+FIELDS = [('LATITUDE', 'N', 10, 5), ('ACQ_TIME', 'C', 4, 0), ('ACQ_DATE', 'D', 8, 0)]
+
+
+def write_point_shapefile(base, points, fields=FIELDS, dbf_records=None):
+    """Escribe base.shp y base.dbf con los puntos indicados y registros vacíos"""
+    record_length = 1 + sum(field[2] for field in fields)
+    header_length = 32 + 32 * len(fields) + 1
+    records = len(points) if dbf_records is None else dbf_records
+    with open(base + '.dbf', 'wb') as f:
+        f.write(struct.pack('<BBBBIHH20x', 3, 124, 1, 1, records, header_length, record_length))
+        for name, field_type, length, decimals in fields:
+            f.write(struct.pack('<11sc4xBB14x', name.encode('ascii'), field_type.encode('ascii'), length, decimals))
+        f.write(b'\x0d')
+        f.write(b' ' * record_length * records)
+        f.write(b'\x1a')
+
+    xs = [x for x, y in points] or [0.0]
+    ys = [y for x, y in points] or [0.0]
+    file_bytes = 100 + Fuegos.SHP_POINT_RECORD_SIZE * len(points)
+    with open(base + '.shp', 'wb') as f:
+        f.write(struct.pack('>i20xi', 9994, file_bytes // 2))
+        f.write(struct.pack('<ii4d32x', 1000, Fuegos.SHP_POINT, min(xs), min(ys), max(xs), max(ys)))
+        for number, (x, y) in enumerate(points, start=1):
+            f.write(struct.pack('>ii', number, 10))
+            f.write(struct.pack('<idd', Fuegos.SHP_POINT, x, y))
+
+
+@pytest.mark.parametrize('count', [0, 1, 37])
+def test_read_shapefile_info(tmp_path, count):
+    points = [(-70.0 + i * 0.1, -2.0 + i * 0.05) for i in range(count)]
+    base = str(tmp_path / 'MODIS_C6_1_South_America_24h')
+    write_point_shapefile(base, points)
+
+    info = Fuegos.read_shapefile_info(base + '.shp')
+
+    assert info['records'] == count
+    assert info['shp_records'] == count
+    assert info['shape_type'] == Fuegos.SHP_POINT
+    assert [(field['name'], field['type'], field['length'], field['decimals']) for field in info['fields']] == FIELDS
+    assert [field['offset'] for field in info['fields']] == [1, 11, 15]
+    if points:
+        assert info['bbox'] == (min(p[0] for p in points), min(p[1] for p in points),
+                                max(p[0] for p in points), max(p[1] for p in points))
+
+
+def test_read_shapefile_info_from_zip(tmp_path):
+    base = str(tmp_path / 'J1_VIIRS_C2_South_America_24h')
+    write_point_shapefile(base, [(-71.5, 0.5), (-72.5, 1.5)])
+    zip_path = str(tmp_path / 'noaa.zip')
+    with zipfile.ZipFile(zip_path, 'w') as zip_ref:
+        for ext in ('.shp', '.dbf'):
+            zip_ref.write(base + ext, os.path.basename(base) + ext)
+
+    info = Fuegos.read_shapefile_info('J1_VIIRS_C2_South_America_24h.shp', zip_path)
+
+    assert info['records'] == 2
+    assert info['shp_records'] == 2
+    assert info['bbox'] == (-72.5, 0.5, -71.5, 1.5)
+
+
+def test_read_shapefile_info_record_mismatch(tmp_path):
+    base = str(tmp_path / 'MODIS')
+    write_point_shapefile(base, [(-70.0, -2.0), (-70.1, -2.1), (-70.2, -2.2)], dbf_records=2)
+
+    info = Fuegos.read_shapefile_info(base + '.shp')
+
+    assert info['records'] == 2
+    assert info['shp_records'] == 3
+
+
+def test_read_shp_header_rejects_other_files(tmp_path):
+    path = tmp_path / 'no_es.shp'
+    path.write_bytes(b'\x00' * 100)
+    with open(str(path), 'rb') as f, pytest.raises(Exception):
+        Fuegos.read_shp_header(f)
+
+
+def test_read_dbf_header_incomplete(tmp_path):
+    path = tmp_path / 'corto.dbf'
+    path.write_bytes(b'\x03' * 10)
+    with open(str(path), 'rb') as f, pytest.raises(Exception):
+        Fuegos.read_dbf_header(f)
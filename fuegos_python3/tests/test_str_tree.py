@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Pruebas del árbol STR y del índice de atribución (build_str_tree / str_tree_candidates /
+build_union_index / union_index_lookup) contra comparaciones de fuerza bruta
+"""
+
+import numpy as np
+import pytest
+
+import Fuegos
+
+
+def random_boxes(rng, count):
+    xmin = rng.uniform(-75.0, -67.0, count)
+    ymin = rng.uniform(-4.0, 4.0, count)
+    return np.column_stack([xmin, ymin, xmin + rng.uniform(0.01, 1.5, count), ymin + rng.uniform(0.01, 1.5, count)])
+
+
+def random_polygons(rng, count):
+    """Triángulos y cuadriláteros al azar que se superponen, algunos con un hueco"""
+    rings = []
+    for feature_id in range(count):
+        cx, cy = rng.uniform(-75.0, -67.0), rng.uniform(-4.0, 4.0)
+        sides = int(rng.integers(3, 7))
+        angles = np.sort(rng.uniform(0, 2 * np.pi, sides))
+        radius = rng.uniform(0.1, 1.2, sides)
+        rings.append((feature_id, [(cx + r * np.cos(a), cy + r * np.sin(a)) for a, r in zip(angles, radius)]))
+        if feature_id % 5 == 0:
+            hole = 0.05
+            rings.append((feature_id, [(cx - hole, cy - hole), (cx + hole, cy - hole),
+                                       (cx + hole, cy + hole), (cx - hole, cy + hole)]))
+    return rings
+
+
+def brute_force_pairs(rings, x, y):
+    """Pares (punto, entidad) con el punto dentro (par-impar) de la entidad"""
+    parity = {}
+    for feature_id, ring in rings:
+        for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+            if y1 == y2:
+                continue
+            crosses = (y1 > y) != (y2 > y)
+            x_cross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+            parity[feature_id] = parity.get(feature_id, 0) + (crosses & (x_cross > x)).astype(np.int64)
+    return {(int(point), feature_id) for feature_id, counts in parity.items()
+            for point in np.nonzero(counts % 2 == 1)[0]}
+
+
+@pytest.mark.parametrize('count, capacity', [(1, 16), (40, 4), (700, 16)])
+def test_str_tree_candidates_match_box_containment(count, capacity):
+    rng = np.random.default_rng(count)
+    boxes = random_boxes(rng, count)
+    x = rng.uniform(-76.0, -65.0, 3000)
+    y = rng.uniform(-5.0, 6.0, 3000)
+
+    tree = Fuegos.build_str_tree(boxes, capacity)
+    points, leaves = Fuegos.str_tree_candidates(tree, x, y)
+
+    inside = ((boxes[None, :, 0] <= x[:, None]) & (x[:, None] <= boxes[None, :, 2]) &
+              (boxes[None, :, 1] <= y[:, None]) & (y[:, None] <= boxes[None, :, 3]))
+    expected = set(zip(*[values.tolist() for values in np.nonzero(inside)]))
+    assert set(zip(points.tolist(), leaves.tolist())) == expected
+    assert len(points) == len(expected)
+
+
+def test_str_pack_is_a_permutation():
+    boxes = random_boxes(np.random.default_rng(7), 500)
+    order = Fuegos.str_pack(boxes)
+    assert sorted(order.tolist()) == list(range(500))
+
+
+def test_union_index_lookup_matches_brute_force():
+    rng = np.random.default_rng(17)
+    rings = random_polygons(rng, 300)
+    oids = list(range(1000, 1300))
+    x = rng.uniform(-76.0, -66.0, 4000)
+    y = rng.uniform(-5.0, 5.0, 4000)
+
+    index = Fuegos.build_union_index(rings, oids)
+    points, features = Fuegos.union_index_lookup(index, x, y)
+
+    assert set(zip(points.tolist(), features.tolist())) == brute_force_pairs(rings, x, y)
+    assert np.all(np.diff(points) >= 0)
+    assert index['oids'][features].min() >= 1000
+
+
+def test_union_index_feature_without_rings():
+    # La entidad 1 no tiene anillos (geometría vacía), nunca debe aparecer
+    rings = [(0, [(0.0, 0.0), (1.0, 0.0), (1.0, 1.0), (0.0, 1.0)]),
+             (2, [(0.5, 0.5), (2.0, 0.5), (2.0, 2.0), (0.5, 2.0)])]
+    index = Fuegos.build_union_index(rings, [10, 11, 12])
+    points, features = Fuegos.union_index_lookup(index, np.array([0.25, 0.75, 1.5, 3.0]),
+                                                 np.array([0.25, 0.75, 1.5, 3.0]))
+    assert list(zip(points.tolist(), index['oids'][features].tolist())) == [(0, 10), (1, 10), (1, 12), (2, 12)]
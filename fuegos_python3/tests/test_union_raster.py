@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Pruebas del raster de identificadores (build_union_raster / union_raster_lookup): cada celda
+interior o vacía se verifica con puntos de muestra dentro de la celda y la atribución con el
+raster se compara con la del índice (union_index_lookup)
+"""
+
+import numpy as np
+import pytest
+
+import Fuegos
+
+from test_str_tree import brute_force_pairs, random_polygons
+
+
+def cell_samples(raster, rows, cols, per_side=4):
+    """Puntos de una grilla de per_side x per_side dentro de cada celda (sin tocar sus bordes)"""
+    xmin, ymin = raster['origin']
+    size = raster['size'][0]
+    offsets = (np.arange(per_side) + 0.5) / per_side
+    dx, dy = [values.ravel() for values in np.meshgrid(offsets, offsets)]
+    x = xmin + (cols[:, None] + dx[None, :]) * size
+    y = ymin + (rows[:, None] + dy[None, :]) * size
+    return x.ravel(), y.ravel(), np.repeat(np.arange(len(rows)), len(dx))
+
+
+@pytest.fixture(scope='module')
+def polygons():
+    rng = np.random.default_rng(18)
+    rings = random_polygons(rng, 60)
+    index = Fuegos.build_union_index(rings, list(range(500, 560)))
+    return rings, index
+
+
+@pytest.mark.parametrize('cell_size', [0.05, 0.2])
+def test_union_raster_cells(tmp_path, polygons, cell_size):
+    rings, index = polygons
+    grid_path = str(tmp_path / 'raster.npy')
+    raster = Fuegos.build_union_raster(index, grid_path, cell_size)
+    grid = np.load(grid_path, mmap_mode='r')
+    assert tuple(raster['shape']) == grid.shape
+
+    rows, cols = np.nonzero(grid != Fuegos.UNION_RASTER_BOUNDARY)
+    x, y, cells = cell_samples(raster, rows, cols)
+    features_by_sample = {}
+    for point, feature_id in brute_force_pairs(rings, x, y):
+        features_by_sample.setdefault(point, set()).add(feature_id)
+    for sample, cell in enumerate(cells):
+        value = int(grid[rows[cell], cols[cell]])
+        expected = set() if value == Fuegos.UNION_RASTER_EMPTY else {value}
+        assert features_by_sample.get(sample, set()) == expected
+    assert (grid >= 0).any()
+
+
+@pytest.mark.parametrize('cell_size', [0.03, 0.1, 0.5])
+def test_union_raster_lookup_matches_index(tmp_path, polygons, cell_size):
+    rings, index = polygons
+    grid_path = str(tmp_path / 'raster.npy')
+    raster = Fuegos.build_union_raster(index, grid_path, cell_size)
+    grid = np.load(grid_path, mmap_mode='r')
+    rng = np.random.default_rng(int(cell_size * 100))
+    x = rng.uniform(-76.0, -66.0, 5000)
+    y = rng.uniform(-5.0, 5.0, 5000)
+
+    points, features = Fuegos.union_raster_lookup(raster, grid, index, x, y)
+    index_points, index_features = Fuegos.union_index_lookup(index, x, y)
+
+    assert set(zip(points.tolist(), features.tolist())) == set(zip(index_points.tolist(), index_features.tolist()))
+    assert set(zip(points.tolist(), features.tolist())) == brute_force_pairs(rings, x, y)
+    assert np.all(np.diff(points) >= 0)